@@ -0,0 +1,164 @@
+"""\
+Background statistics of image layers, exactly or approximated for quick-look use.
+
+All methods return mean, median and stddev of each layer after iterative sigma clipping,
+like `astropy.stats.sigma_clipped_stats(layers, axis=(1, 2))`. Nan and inf values are ignored.
+
+exact
+    `sigma_clipped_stats` over every pixel, several passes and copies of the layers.
+
+subsample
+    `sigma_clipped_stats` over a regular grid of about `sample_size` pixels per layer, i.e. a single strided copy.
+    For a background of n sampled pixels, the errors are about stddev / sqrt(n) for mean and median and
+    stddev / sqrt(2 n) for stddev, i.e. less than 0.3% of stddev for the default 2**18 pixels.
+    Background structures smaller than the grid spacing may be missed.
+
+histogram
+    Sigma clipping of a histogram, see `bayer.histogram`. Integer data is counted per value in a single pass,
+    so the results are exact. Floating point data is counted in `bins` equally sized bins in two passes.
+    Values are rounded to the nearest bin, so mean and median are off by at most
+    half a bin width, (max - min) / (2 * (bins - 1)), and stddev is off by at most a bin width.
+
+Layers larger than memory can be read in bands of rows by `chunked_background_stats`, with the same results
+as the subsample and histogram methods.
+"""
+
+from bayer.histogram import finite_range, histogram_stats, histograms
+from bayer.utils import lazy_import
+
+np = lazy_import('numpy')
+
+METHODS = 'exact', 'subsample', 'histogram'
+
+
+def background_stats(layers, sigma_lower=3.0, sigma_upper=3.0, cenfunc='median', maxiters=5, method='exact',
+                     sample_size=2 ** 18, bins=2 ** 16):
+    """\
+    Sigma clipped mean, median and stddev of each layer.
+
+    Parameters
+    ----------
+    layers: array_like of shape (num_layers, rows, columns)
+
+    sigma_lower, sigma_upper: number
+        Clipping bounds in units of stddev around the center
+
+    cenfunc: str
+        'median' or 'mean', the center used for clipping
+
+    maxiters: int
+        Maximum number of clipping iterations, clipping stops earlier if nothing changes
+
+    method: str
+        one of `METHODS`, see the module documentation for their accuracy
+
+    sample_size: int
+        Approximate number of pixels per layer used by the subsample method
+
+    bins: int
+        Number of histogram bins used by the histogram method for floating point layers
+
+    Return
+    ------
+    three arrays of shape (num_layers,) containing mean, median and stddev
+    """
+    assert method in METHODS, f'unknown method {method}'
+    assert cenfunc in ('median', 'mean')
+    assert np.ndim(layers) == 3
+
+    if method == 'histogram':
+        # each layer gets bins of its own width
+        stats = [histogram_stats(*histograms(layer, bins=bins), sigma_lower, sigma_upper, cenfunc, maxiters)
+                 for layer in layers]
+        return tuple(np.concatenate(s) for s in zip(*stats))
+
+    from astropy.stats import sigma_clipped_stats
+
+    if method == 'subsample':
+        layers = subsample(layers, sample_size)
+    else:
+        layers = np.asarray(layers)
+
+    return sigma_clipped_stats(layers, sigma_lower=sigma_lower, sigma_upper=sigma_upper, cenfunc=cenfunc,
+                               maxiters=maxiters, axis=(1, 2))
+
+
+def chunked_background_stats(read_rows, shape, chunk_rows, sigma_lower=3.0, sigma_upper=3.0, cenfunc='median',
+                             maxiters=5, method='histogram', sample_size=2 ** 18, bins=2 ** 16):
+    """\
+    Same as `background_stats` for layers read in bands of rows, e.g. memory-mapped images larger than memory.
+
+    The subsample method only reads the sampled rows, the histogram method reads all bands twice.
+    The exact method needs all pixels at once and is not supported.
+
+    Parameters
+    ----------
+    read_rows: callable
+        `read_rows(start, stop)` returns the rows start:stop of all layers, an array of shape
+        (num_layers, stop - start, columns)
+
+    shape: tuple of int
+        num_layers, rows and columns of all layers
+
+    chunk_rows: int
+        Number of rows read at once by the histogram method
+
+    For the other parameters and the return value see `background_stats`.
+    """
+    assert method in ('subsample', 'histogram'), f'method {method} is not supported for chunked layers'
+    assert cenfunc in ('median', 'mean')
+
+    num_layers, rows, columns = shape
+
+    if method == 'subsample':
+        from astropy.stats import sigma_clipped_stats
+
+        step = _subsample_step(rows, columns, sample_size)
+        # copies, so the whole rows are released at once
+        samples = np.concatenate([np.array(read_rows(row, row + 1)[:, :, step // 2::step])
+                                  for row in range(step // 2, rows, step)], axis=1)
+        return sigma_clipped_stats(samples, sigma_lower=sigma_lower, sigma_upper=sigma_upper, cenfunc=cenfunc,
+                                   maxiters=maxiters, axis=(1, 2))
+
+    def bands():
+        for start in range(0, rows, chunk_rows):
+            yield read_rows(start, min(start + chunk_rows, rows))
+
+    # the first pass finds the range of each layer, so the bins of all bands are the same
+    ranges = [(np.inf, -np.inf)] * num_layers
+    for band in bands():
+        ranges = [(min(lowest, band_lowest), max(highest, band_highest))
+                  for (lowest, highest), (band_lowest, band_highest) in zip(ranges, map(finite_range, band))]
+
+    values, counts = [None] * num_layers, [0] * num_layers
+    for band in bands():
+        for index, layer in enumerate(band):
+            values[index], layer_counts = histograms(layer, bins=bins, value_range=ranges[index])
+            counts[index] = counts[index] + layer_counts
+
+    stats = [histogram_stats(v, c, sigma_lower, sigma_upper, cenfunc, maxiters) for v, c in zip(values, counts)]
+    return tuple(np.concatenate(s) for s in zip(*stats))
+
+
+def add_background_argument(parser):
+    parser.add_argument('--background', choices=METHODS, default='exact',
+                        help='estimator of the background statistics, the approximations are faster, '
+                             'default=%(default)s')
+
+
+def subsample(layers, sample_size):
+    """\
+    Copy at most sample_size pixels of each layer on a regular grid.
+
+    Odd grid steps avoid sampling a single color of a not de-bayered mosaic.
+    """
+    __, rows, columns = np.shape(layers)
+    step = _subsample_step(rows, columns, sample_size)
+    return np.array(layers[:, step // 2::step, step // 2::step])
+
+
+def _subsample_step(rows, columns, sample_size):
+    step = max(1, int(np.ceil(np.sqrt(rows * columns / sample_size))))
+    if step > 1 and step % 2 == 0:
+        step += 1
+    return step
@@ -1,39 +1,97 @@
-import math
 import warnings
 from functools import cached_property
 
-import numpy as np
-from astropy.stats import sigma_clipped_stats
+from bayer.background import METHODS, background_stats, chunked_background_stats
+from bayer.precision import working_dtype
+from bayer.profiling import timed
+from bayer.to_rgb import LazyLayers
+from bayer.utils import lazy_import
+
+np = lazy_import('numpy')
 
 
 class FastExtraction:
 
-    def __init__(self, image_layers, sigma=3, clipping=10):
+    def __init__(self, image_layers, sigma=3, clipping=10, rotation_order=3, roi_margin=None, background='exact',
+                 chunk_rows=None):
         """\
         Parameters
         ----------
         image_layers: array_like of shape (num_layers, rows, columns)
+            Converted into the working precision, see `bayer.precision`
         sigma: number
             Used for sigma clipping of the image background
         clipping: number
             After sigma clipping the layers are cut at mean + clipping * stddev
+        rotation_order: int
+            Spline interpolation order used for de-rotation, 0 to 5
+        roi_margin: int
+            If given, only the bounding box of the spectrum plus this margin is de-rotated, see `roi`.
+            By default, the whole image is de-rotated.
+        background: str
+            Estimator of the background statistics, 'exact', 'subsample' or 'histogram'.
+            See `bayer.background` for the accuracy of the approximations.
+        chunk_rows: int
+            If given, the layers, e.g. memory-mapped or `LazyLayers` larger than memory, are kept as they are
+            and read in bands of this many rows. Background statistics, moments and the bounding box of the
+            spectrum are reduced band by band and only the bounding box, see `roi`, is de-rotated like with
+            `roi_margin`. Without it, the margin grows with the rotation angle. The background must be estimated
+            by 'subsample' or 'histogram'.
         """
 
         assert image_layers is not None and np.ndim(image_layers) == 3
         assert sigma > 0
         assert clipping > 0
-
-        self.layers = np.asarray(image_layers)
+        assert 0 <= rotation_order <= 5
+        assert roi_margin is None or roi_margin >= 0
+        assert background in METHODS
+        assert chunk_rows is None or chunk_rows > 0
+        assert chunk_rows is None or background != 'exact', 'exact background statistics need all pixels at once'
+
+        if chunk_rows:
+            self.layers = image_layers if isinstance(image_layers, LazyLayers) else np.asarray(image_layers)
+        else:
+            self.layers = np.asarray(image_layers, dtype=working_dtype())
         self.sigma = sigma
         self.clipping = clipping
+        self.rotation_order = rotation_order
+        self.roi_margin = roi_margin
+        self.background = background
+        self.chunk_rows = chunk_rows
 
     @cached_property
+    @timed
     def clipped_layers(self):
         return self._clip_image(self.layers, self.background_mean + self.background_stddev * self.clipping)
 
     @cached_property
+    @timed
     def _background_stats(self):
-        return sigma_clipped_stats(self.layers, sigma_upper=self.sigma, sigma_lower=1000, cenfunc='mean', axis=(1, 2))
+        if self.chunk_rows:
+            return chunked_background_stats(self._read_rows, self.layers.shape, self.chunk_rows,
+                                            sigma_upper=self.sigma, sigma_lower=1000, cenfunc='mean',
+                                            method=self.background)
+        return background_stats(self.layers, sigma_upper=self.sigma, sigma_lower=1000, cenfunc='mean',
+                                method=self.background)
+
+    def _read_rows(self, start, stop):
+        """The rows start:stop of all layers in the working precision, only used with chunk_rows."""
+        if isinstance(self.layers, LazyLayers):
+            return self.layers.rows(start, stop).decode()
+        return np.asarray(self.layers[:, start:stop], dtype=working_dtype())
+
+    def _clipped_bands(self):
+        """Yield the first row and the clipped rows of each band of chunk_rows rows, see `clipped_layers`."""
+        threshold = self.background_mean + self.background_stddev * self.clipping
+        __, rows, __ = self.layers.shape
+        for start in range(0, rows, self.chunk_rows):
+            yield start, self._clip_image(self._read_rows(start, min(start + self.chunk_rows, rows)), threshold)
+
+    @cached_property
+    @timed
+    def _clipped_projections(self):
+        """Row sums, x-weighted row sums and column sums of the clipped layers, reduced band by band."""
+        return _projections(self._clipped_bands(), self.layers.shape)
 
     @property
     def background_mean(self):
@@ -65,17 +123,82 @@ class FastExtraction:
         return np.rad2deg(self.de_rotation_angles_rad)
 
     @cached_property
+    @timed
     def de_rotation_angles_rad(self):
-        return np.array([self._calculate_de_rotation_angle(layer) for layer in self.clipped_layers])
+        if self.chunk_rows:
+            return _de_rotation_angles(_moments(*self._clipped_projections))
+        return _de_rotation_angles(image_moments(self.clipped_layers))
 
     @cached_property
+    @timed
+    def roi(self):
+        """\
+        Row and column slices of the spectrum's bounding box extended by `roi_margin`.
+
+        The box is the smallest interval of rows and of columns containing 99% of the clipped layers' flux,
+        so a few hot pixels do not widen it. Without `roi_margin`, the margin of chunked layers grows with
+        the rotation angle, so the ends of a tilted spectrum cut off by the box are de-rotated as well.
+        """
+        __, rows, columns = self.layers.shape
+
+        if self.chunk_rows:
+            row_sums, __, column_sums = self._clipped_projections
+            row_profile, column_profile = row_sums.sum(axis=0), column_sums.sum(axis=0)
+        else:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                row_profile = np.nansum(self.clipped_layers, axis=(0, 2))
+                column_profile = np.nansum(self.clipped_layers, axis=(0, 1))
+
+        def _bounds(profile, size):
+            if not np.nansum(profile) > 0:
+                return 0, size - 1
+            return _find_smallest_interval(profile, area_percentage=0.99)
+
+        row_bounds, column_bounds = _bounds(row_profile, rows), _bounds(column_profile, columns)
+
+        if self.roi_margin is not None or not self.chunk_rows:
+            margin = self.roi_margin or 0
+        else:
+            extent = max(row_bounds[1] - row_bounds[0], column_bounds[1] - column_bounds[0])
+            sine = np.max(np.abs(np.sin(self.de_rotation_angles_rad)))
+            margin = int(np.ceil(sine * extent)) + self.rotation_order
+
+        def _slice(bounds, size):
+            first, last = bounds
+            return slice(max(0, first - margin), min(size, last + 1 + margin))
+
+        return _slice(row_bounds, rows), _slice(column_bounds, columns)
+
+    @cached_property
+    @timed
     def de_rotated_layers(self):
         from scipy.ndimage import rotate
 
+        layers = self.layers
+        if self.chunk_rows:
+            layers = self._read_roi()
+        elif self.roi_margin is not None:
+            rows, columns = self.roi
+            layers = layers[:, rows, columns]
+
         angle_deg = np.mean(self.de_rotation_angles_deg)
-        return rotate(self.layers, angle_deg, axes=(1, 2), mode='constant', cval=np.nan)
+        return rotate(layers, angle_deg, axes=(1, 2), order=self.rotation_order, mode='constant', cval=np.nan,
+                      output=layers.dtype)
+
+    def _read_roi(self):
+        """Copy the bounding box of the spectrum band by band, the only part of chunked layers read at once."""
+        rows, columns = self.roi
+        roi = None
+        for start in range(rows.start, rows.stop, self.chunk_rows):
+            band = self._read_rows(start, min(start + self.chunk_rows, rows.stop))[:, :, columns]
+            if roi is None:
+                roi = np.empty((len(band), rows.stop - rows.start, band.shape[2]), dtype=band.dtype)
+            roi[:, start - rows.start:start - rows.start + band.shape[1]] = band
+        return roi
 
     @cached_property
+    @timed
     def clipped_de_rotated_layers(self):
         mean, median, stddev = self._background_stats
         return self._clip_image(self.de_rotated_layers, mean + stddev * self.clipping)
@@ -89,42 +212,168 @@ class FastExtraction:
         """
         assert image.ndim == 2
 
-        indices_y, indices_x = np.indices(image.shape)
+        [angle] = _de_rotation_angles(image_moments([image]))
+        return angle
 
-        m00 = np.nansum(image)
-        m10 = np.nansum(image * indices_x)
-        m01 = np.nansum(image * indices_y)
-        m11 = np.nansum(image * indices_x * indices_y)
-        m20 = np.nansum(image * indices_x * indices_x)
-        m02 = np.nansum(image * indices_y * indices_y)
 
-        avg_x = m10 / m00
-        avg_y = m01 / m00
-        mu_11_ = m11 / m00 - avg_x * avg_y
-        mu_20_ = m20 / m00 - avg_x ** 2
-        mu_02_ = m02 / m00 - avg_y ** 2
+# size of the scratch buffer used by image_moments
+_MOMENTS_BUFFER_BYTES = 2 ** 23
 
-        angle = 0.5 * np.arctan2(2 * mu_11_, mu_20_ - mu_02_)
 
-        while angle > math.pi / 2:
-            angle -= math.pi
+def image_moments(layers):
+    """\
+    Calculate the raw image moments m00, m10, m01, m11, m20 and m02 of all layers in a single pass.
 
-        while angle < -math.pi / 2:
-            angle += math.pi
+    Instead of coordinate grids, the image is reduced to row sums, column sums and x-weighted row sums,
+    band by band in a fixed scratch buffer. Nan values count as zero.
+    Float32 layers are reduced in float32, only the per-row and per-column sums are kept in float64.
 
-        return angle
+    Coordinates are measured from the image center, which reduces cancellation when deriving
+    central moments. Central moments and thus the orientation do not depend on this choice.
+
+    Parameters
+    ----------
+    layers: array_like of shape (num_layers, rows, columns)
+
+    Return
+    ------
+    array of shape (num_layers, 6) containing m00, m10, m01, m11, m20 and m02
+    """
+    layers = np.asarray(layers)
+    assert layers.ndim == 3
+    num_layers, rows, columns = layers.shape
+
+    itemsize = _projection_dtype(layers.dtype).itemsize
+    band_rows = max(1, min(rows, _MOMENTS_BUFFER_BYTES // (num_layers * columns * itemsize)))
+    bands = ((start, layers[:, start:start + band_rows]) for start in range(0, rows, band_rows))
+
+    return _moments(*_projections(bands, layers.shape))
+
+
+def _projection_dtype(dtype):
+    return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+
+
+def _projections(bands, shape):
+    """\
+    Row sums, x-weighted row sums and column sums of layers of shape (num_layers, rows, columns) given in bands.
+
+    bands yields the first row and the rows of all layers of each band, none larger than the first one.
+    Each band is copied into a scratch buffer,
+    where nan values become zero. Float32 bands are reduced in float32, the sums are kept in float64.
+    """
+    num_layers, rows, columns = shape
+
+    row_sums = np.empty((num_layers, rows))
+    row_x_sums = np.empty((num_layers, rows))
+    column_sums = np.zeros((num_layers, columns))
+
+    buffer = x = None
+    for start, band in bands:
+        band_rows = np.shape(band)[1]
+        if buffer is None:
+            dtype = _projection_dtype(band.dtype)
+            buffer = np.empty((num_layers, band_rows, columns), dtype=dtype)
+            x = np.arange(columns, dtype=dtype) - dtype.type((columns - 1) / 2)
+        scratch = buffer[:, :band_rows]
+        np.copyto(scratch, band, casting='unsafe')
+        np.nan_to_num(scratch, copy=False, nan=0.0, posinf=np.inf, neginf=-np.inf)
+
+        row_sums[:, start:start + band_rows] = scratch.sum(axis=2)
+        row_x_sums[:, start:start + band_rows] = scratch @ x
+        column_sums += scratch.sum(axis=1)
+
+    return row_sums, row_x_sums, column_sums
 
 
-def find_slit_in_images(rgb, background_mean, scale=1.5):
+def _moments(row_sums, row_x_sums, column_sums):
+    """The moments returned by image_moments from the projections returned by _projections."""
+    __, rows = row_sums.shape
+    __, columns = column_sums.shape
+    # the coordinates are exact in float32 as well
+    x = np.arange(columns, dtype=np.float64) - (columns - 1) / 2
+    y = np.arange(rows, dtype=np.float64) - (rows - 1) / 2
 
-    __, size_y, __ = rgb.shape
-    wo_background = rgb - np.reshape(background_mean, (-1, 1, 1))
+    m00 = row_sums.sum(axis=1)
+    m10 = column_sums @ x
+    m01 = row_sums @ y
+    m11 = row_x_sums @ y
+    m20 = column_sums @ np.square(x, dtype=np.float64)
+    m02 = row_sums @ np.square(y)
+
+    return np.stack([m00, m10, m01, m11, m20, m02], axis=1)
+
+
+def _de_rotation_angles(moments):
+    """Orientation of each layer in [-pi/2, pi/2] from the moments returned by image_moments."""
+    m00, m10, m01, m11, m20, m02 = np.transpose(moments)
+
+    avg_x = m10 / m00
+    avg_y = m01 / m00
+    mu_11_ = m11 / m00 - avg_x * avg_y
+    mu_20_ = m20 / m00 - avg_x ** 2
+    mu_02_ = m02 / m00 - avg_y ** 2
+
+    # arctan2 returns values within [-pi, pi], so the angles are within [-pi/2, pi/2]
+    return 0.5 * np.arctan2(2 * mu_11_, mu_20_ - mu_02_)
+
+
+@timed
+def find_slit_in_images(rgb, background_mean, scale=1.5, subpixel=False, clip_negative=False):
+    """\
+    Find the first and last row of the slit in a de-rotated image.
+
+    See `find_slits_in_profiles` for the parameters.
+    """
+    [miny], [maxy] = find_slits_in_profiles([slit_profile(rgb, background_mean)], scale, subpixel, clip_negative)
+    return miny, maxy
+
+
+def slit_profile(rgb, background_mean):
+    """\
+    Mean of each row over all layers and columns after subtracting the background; nan values are ignored.
+
+    Unlike `np.nanmean(rgb - background_mean, axis=(0, 2))`, this neither copies the image nor subtracts
+    the background pixel by pixel.
+    """
+    rgb = np.asarray(rgb)
+    valid = ~np.isnan(rgb)
+    counts = np.count_nonzero(valid, axis=2)
+    sums = np.sum(rgb, axis=2, where=valid, dtype=np.float64)
+    sums -= np.reshape(background_mean, (-1, 1)) * counts
 
     # In some rows all values maybe nan, this can be ignored
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=RuntimeWarning)
-        slit_function = np.nanmean(wo_background, axis=(0, 2))
-    miny, maxy = _find_smallest_interval(slit_function)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(sums, axis=0) / np.sum(counts, axis=0)
+
+
+def find_slits_in_profiles(profiles, scale=1.5, subpixel=False, clip_negative=False):
+    """\
+    Find the slit in a batch of slit profiles, e.g. from many frames of a time series.
+
+    Parameters
+    ----------
+    profiles: array_like of shape (num_profiles, size_y)
+        see `slit_profile`
+
+    scale: number
+        Factor widening the smallest interval containing 95% of the profile
+
+    subpixel: bool
+        Return fractional rows instead of rounding outwards to whole rows
+
+    clip_negative: bool
+        Count rows darker than the background as zero instead of reducing the sum of an interval
+
+    Return
+    ------
+    two arrays of shape (num_profiles,) containing first and last row of each slit
+    """
+    profiles = np.asarray(profiles)
+    assert profiles.ndim == 2
+    __, size_y = profiles.shape
+
+    miny, maxy = _find_smallest_interval(profiles, subpixel=subpixel, clip_negative=clip_negative)
 
     if scale != 1.0:
         center = (miny + maxy) / 2
@@ -133,8 +382,9 @@ def find_slit_in_images(rgb, background_mean, scale=1.5):
         miny = center - scale * width
         maxy = center + scale * width
 
-    miny = math.floor(miny)
-    maxy = math.ceil(maxy)
+    if not subpixel:
+        miny = np.floor(miny).astype(int)
+        maxy = np.ceil(maxy).astype(int)
 
     miny = np.clip(miny, 0, size_y - 1)
     maxy = np.clip(maxy, 0, size_y - 1)
@@ -142,33 +392,106 @@ def find_slit_in_images(rgb, background_mean, scale=1.5):
     return miny, maxy
 
 
-def _find_smallest_interval(data, area_percentage=0.95):
+# values of all profiles searched at once by _find_smallest_interval
+_SEARCH_SIZE = 2 ** 20
+
+
+def _find_smallest_interval(data, area_percentage=0.95, subpixel=False, clip_negative=False):
     """
     For a given array, find the smallest interval containing more than 95% of the data.
-    """
-    assert np.ndim(data) == 1
 
-    sum_data = np.nansum(data)
+    The interval (a, b) covers data[a + 1:b + 1] and nan values count as zero. The result is that of a
+    two-pointer search: the end b only moves forward while the start a advances, see `_smallest_intervals`.
+    With clip_negative=True, negative values count as zero as well.
+    For more than one dimension, the last axis is searched and arrays of starts and ends are returned.
+
+    With subpixel=True the surplus above 95% is trimmed from both ends, assuming the
+    values are spread evenly within each row.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    assert data.ndim >= 1
+    if data.ndim == 1:
+        a, b = _find_smallest_interval(data[np.newaxis], area_percentage, subpixel, clip_negative)
+        return a[0], b[0]
+
+    batch_shape = data.shape[:-1]
+    data = np.reshape(data, (-1, data.shape[-1]))
+    data = np.nan_to_num(data, nan=0.0)
+    if clip_negative:
+        data = np.clip(data, 0, None)
+    num_profiles, size = data.shape
+
+    cumulative_data_sum = np.cumsum(data, axis=1)
+    sum_data = np.sum(data, axis=1)
     target_sum = sum_data * area_percentage
-    assert 0 < target_sum < sum_data
+    assert np.all(0 < target_sum) and np.all(target_sum < sum_data)
+
+    starts, ends = _smallest_intervals(cumulative_data_sum, target_sum)
 
-    # simplifies the area calculation below
-    cumulative_data_sum = np.nancumsum(data)
+    if not subpixel:
+        return np.reshape(starts, batch_shape), np.reshape(ends, batch_shape)
 
-    smallest_interval_size = len(data)
-    smallest_interval = None, None
+    rows = np.arange(num_profiles)
+    surplus = cumulative_data_sum[rows, ends] - cumulative_data_sum[rows, starts] - target_sum
+    first = data[rows, np.minimum(starts + 1, size - 1)]
+    last = data[rows, ends]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        starts = starts + np.clip(np.nan_to_num(surplus / 2 / first), 0, 1)
+        ends = ends - np.clip(np.nan_to_num(surplus / 2 / last), 0, 1)
 
-    a = 0
-    b = 1
-    while a < b < len(data):
-        interval_sum = cumulative_data_sum[b] - cumulative_data_sum[a]
+    return np.reshape(starts, batch_shape), np.reshape(ends, batch_shape)
 
-        if interval_sum < target_sum:
-            b += 1
-        else:  # interval_sum >= target_sum
-            if b - a < smallest_interval_size:
-                smallest_interval_size = b - a
-                smallest_interval = a, b
-            a += 1
 
-    return smallest_interval
+def _smallest_intervals(cumulative_data_sum, target_sum):
+    """\
+    Starts and ends of the smallest intervals found by a two-pointer search, for blocks of profiles at once.
+
+    Starting with a = 0 and b = 1, the search advances b while cumulative[b] < cumulative[a] + target and
+    a otherwise, until b reaches the end or a reaches b. This is the merge of the sequences cumulative[1:]
+    and cumulative + target, and merging two sequences takes the same steps as merging their running maxima.
+    These are sorted even if negative values make the cumulative sums decrease, so each end b is the position
+    of its start a in the merge. The whole profile is returned if no interval reaches the target.
+    """
+    num_profiles, size = cumulative_data_sum.shape
+    starts = np.zeros(num_profiles, dtype=int)
+    ends = np.full(num_profiles, size - 1)
+    if size < 2:
+        return starts, ends
+
+    block = max(1, _SEARCH_SIZE // size)
+    for first in range(0, num_profiles, block):
+        cumulative = cumulative_data_sum[first:first + block]
+        running_ends = np.maximum.accumulate(cumulative[:, 1:], axis=1)
+        running_targets = np.maximum.accumulate(cumulative + target_sum[first:first + block, np.newaxis], axis=1)
+        ends_of_starts = 1 + _searchsorted_rows(running_ends, running_targets)
+
+        # the search stops after the first start catching up with its end
+        a = np.arange(size)
+        caught_up = ends_of_starts <= a + 1
+        visited = np.cumsum(caught_up, axis=1) - caught_up == 0
+
+        # intervals leaving the profile are never the smallest
+        widths = np.where(visited & (ends_of_starts < size), ends_of_starts - a, size)
+        smallest = np.argmin(widths, axis=1)
+        rows = np.arange(len(smallest))
+        found = widths[rows, smallest] < size
+        starts[first:first + block] = np.where(found, smallest, 0)
+        ends[first:first + block] = np.where(found, ends_of_starts[rows, smallest], size - 1)
+
+    return starts, ends
+
+
+def _searchsorted_rows(sorted_rows, values):
+    """\
+    `np.searchsorted(sorted_rows[i], values[i], side='left')` for every row i of two 2d arrays.
+
+    Each row of values has to be sorted as well. Stable sorting merges both rows in linear time,
+    values before equal sorted values, the number of sorted values before each value is its index.
+    """
+    num_rows, size = values.shape
+    merged = np.concatenate([values, sorted_rows], axis=1)
+    order = np.argsort(merged, axis=1, kind='stable')
+
+    positions = np.empty_like(order)
+    np.put_along_axis(positions, order, np.broadcast_to(np.arange(merged.shape[1]), merged.shape), axis=1)
+    return positions[:, :size] - np.arange(size)
@@ -0,0 +1,202 @@
+"""\
+Histograms of image channels and the statistics derived from them.
+
+Sensor data are 12 to 16 bit integers. Their histogram counts each integer value with `np.bincount`,
+all channels in a single pass over the native data without any float copy. Statistics derived from such a
+histogram are exact. Floating point data is counted in equally sized bins, see `bayer.background`
+for the resulting accuracy.
+
+Background statistics, saturation and the histogram of the bright pixels are all derived from the same counts.
+"""
+
+from bayer.utils import lazy_import
+
+np = lazy_import('numpy')
+
+# pixels processed at once
+_CHUNK_SIZE = 2 ** 20
+
+
+def histograms(data, pattern=None, bins=2 ** 16, value_range=None):
+    """\
+    Count the pixel values of each channel.
+
+    Parameters
+    ----------
+    data: array_like of shape (rows, columns) or (num_layers, rows, columns)
+        Integer or floating point pixel values, nan and inf are ignored
+
+    pattern: array_like of int
+        Channel of each pixel of a 2d mosaic cell, e.g. [[0, 1], [1, 2]] for an RGGB bayer matrix.
+        By default, each layer is a channel.
+
+    bins: int
+        Number of bins for floating point data, integer data is counted per value
+
+    value_range: (number, number)
+        Lowest and highest bin of floating point data, values outside are ignored.
+        By default, the range of the finite values, which needs another pass over the data.
+        Bands of a larger image counted with the range of the whole image add up to its histogram.
+
+    Return
+    ------
+    values of shape (num_values,) and counts of shape (num_channels, num_values)
+    """
+    data = np.asarray(data)
+    if data.ndim == 2 and pattern is not None:
+        pattern = np.asarray(pattern, dtype=np.intp)
+        num_channels = pattern.max() + 1
+        cell_rows, cell_columns = pattern.shape
+        rows, columns = data.shape
+        # bands start at the first row of a cell, so they share the same channel grid
+        band_rows = max(cell_rows, _CHUNK_SIZE // max(1, columns) // cell_rows * cell_rows)
+        grid = np.tile(pattern, (-(-min(band_rows, rows) // cell_rows), -(-columns // cell_columns)))[:, :columns]
+        bands = [(band, grid[:len(band)]) for __, band in _bands(data, band_rows)]
+    else:
+        assert pattern is None
+        data = data[np.newaxis] if data.ndim == 2 else data
+        assert data.ndim == 3
+        num_channels = len(data)
+        bands = [(band, channel) for channel, layer in enumerate(data) for __, band in _bands(layer)]
+
+    if np.issubdtype(data.dtype, np.integer):
+        lowest, num_values, width = _integer_range(data, bands)
+    else:
+        lowest, num_values, width = _float_range(bands, bins, value_range)
+
+    counts = np.zeros(num_channels * num_values, dtype=np.int64)
+    if num_values:
+        for band, channel in bands:
+            if width is None:
+                indices = np.subtract(band, lowest, dtype=np.intp)
+            else:
+                valid = np.isfinite(band)
+                if value_range is not None:
+                    valid &= (band >= lowest) & (band <= value_range[1])
+                band, channel = band[valid], channel[valid] if np.ndim(channel) else channel
+                indices = np.rint((band - lowest) / width).astype(np.intp)
+            indices += np.multiply(channel, num_values, dtype=np.intp)
+            counts += np.bincount(indices.ravel(), minlength=counts.size)
+
+    values = lowest + (width or 1) * np.arange(num_values, dtype=np.float64)
+    return values, counts.reshape(num_channels, num_values)
+
+
+def histogram_stats(values, counts, sigma_lower=3.0, sigma_upper=3.0, cenfunc='median', maxiters=5):
+    """\
+    Sigma clipped mean, median and stddev of each channel of a histogram.
+
+    The clipping is that of `astropy.stats.sigma_clipped_stats`, i.e. clipped values are never accepted again.
+
+    Parameters
+    ----------
+    values, counts:
+        as returned by `histograms`, counts may also be a single channel of shape (num_values,)
+
+    Return
+    ------
+    mean, median and stddev, each of shape (num_channels,) or scalars for a single channel
+    """
+    assert cenfunc in ('median', 'mean')
+
+    counts = np.asarray(counts)
+    if counts.ndim == 2:
+        stats = [histogram_stats(values, c, sigma_lower, sigma_upper, cenfunc, maxiters) for c in counts]
+        return tuple(np.array(s) for s in zip(*stats))
+
+    first, last = 0, len(values)
+    for __ in range(maxiters + 1):
+        mean, median, stddev = _weighted_stats(values[first:last], counts[first:last])
+        center = median if cenfunc == 'median' else mean
+
+        new_first = max(first, np.searchsorted(values, center - sigma_lower * stddev, side='left'))
+        new_last = min(last, np.searchsorted(values, center + sigma_upper * stddev, side='right'))
+        if (new_first, new_last) == (first, last):
+            break
+        first, last = new_first, new_last
+
+    return mean, median, stddev
+
+
+def saturated_fraction(values, counts, level):
+    """Fraction of the pixels of each channel at or above level."""
+    counts = np.asarray(counts)
+    total = np.sum(counts, axis=-1)
+    saturated = np.sum(counts[..., values >= level], axis=-1)
+    return np.divide(saturated, total, out=np.full(np.shape(total), np.nan), where=total > 0)
+
+
+def clipped_histogram(values, counts, threshold, bins=100):
+    """\
+    Rebin the values at or above threshold, like `np.histogram(data[data >= threshold], bins)`.
+
+    Return
+    ------
+    counts of shape (bins,) and bin edges of shape (bins + 1,)
+    """
+    selected = (values >= threshold) & (counts > 0)
+    return np.histogram(values[selected], bins=bins, weights=counts[selected])
+
+
+def _bands(layer, band_rows=None):
+    """Yield start row and rows of a 2d layer in bands of about _CHUNK_SIZE pixels."""
+    rows, columns = layer.shape
+    band_rows = band_rows or max(1, _CHUNK_SIZE // max(1, columns))
+    for start in range(0, rows, band_rows):
+        yield start, layer[start:start + band_rows]
+
+
+def _integer_range(data, bands):
+    """Return lowest value, number of values and None as bin width of integer data."""
+    if data.dtype.itemsize <= 2:
+        # a fixed range avoids a first pass over the data
+        info = np.iinfo(data.dtype)
+        return int(info.min), int(info.max) - int(info.min) + 1, None
+
+    if not data.size:
+        return 0, 0, None
+    lowest = min(int(band.min()) for band, __ in bands if band.size)
+    highest = max(int(band.max()) for band, __ in bands if band.size)
+    return lowest, highest - lowest + 1, None
+
+
+def _float_range(bands, bins, value_range=None):
+    """Return lowest value, number of bins and bin width of floating point data, the first pass over the data."""
+    assert bins > 1
+
+    if value_range is not None:
+        lowest, highest = map(float, value_range)
+    else:
+        lowest, highest = finite_range(band for band, __ in bands)
+
+    if lowest > highest:
+        return 0.0, 0, 1.0
+
+    return lowest, bins, (highest - lowest) / (bins - 1) or 1.0
+
+
+def finite_range(bands):
+    """Lowest and highest finite value of all bands, inf and -inf if there is none."""
+    lowest, highest = np.inf, -np.inf
+    for band in bands:
+        finite = band[np.isfinite(band)]
+        if finite.size:
+            lowest = min(lowest, float(finite.min()))
+            highest = max(highest, float(finite.max()))
+    return lowest, highest
+
+
+def _weighted_stats(values, counts):
+    total = np.sum(counts)
+    if not total:
+        return np.nan, np.nan, np.nan
+
+    mean = np.dot(values, counts) / total
+    stddev = np.sqrt(np.dot(np.square(values - mean), counts) / total)
+
+    # the median of an even number of values is the mean of the two central ones
+    cumulative = np.cumsum(counts)
+    lower = values[np.searchsorted(cumulative, (total + 1) // 2)]
+    upper = values[np.searchsorted(cumulative, total // 2 + 1)]
+
+    return mean, (lower + upper) / 2, stddev
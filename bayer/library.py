@@ -0,0 +1,150 @@
+"""\
+On-disk library of master darks and flats.
+
+Masters are indexed by the header keywords that decide whether a master fits a light.
+Each master also records a fingerprint of its input files and stacking parameters so
+it is only rebuilt when the inputs change.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+
+logger = logging.getLogger(__name__)
+
+DARK = 'dark'
+FLAT = 'flat'
+
+# Keywords a master has to share with a light; flats do not depend on exposure, temperature or gain.
+MATCH_KEYWORDS = {
+    DARK: ('EXPTIME', 'CCD-TEMP', 'GAIN', 'BAYERPAT', 'XBINNING', 'YBINNING', 'NAXIS1', 'NAXIS2'),
+    FLAT: ('BAYERPAT', 'XBINNING', 'YBINNING', 'NAXIS1', 'NAXIS2'),
+}
+
+INDEX_FILENAME = 'index.json'
+
+
+class MasterLibrary:
+
+    def __init__(self, folder, temperature_tolerance=1.0):
+        """\
+        Parameters
+        ----------
+        folder: str
+            The folder containing the masters and the index; it is created if missing
+        temperature_tolerance: number
+            Maximum difference of CCD-TEMP in degrees Celsius between a dark and a light
+        """
+        self.folder = folder
+        self.temperature_tolerance = temperature_tolerance
+
+        os.makedirs(folder, exist_ok=True)
+        self._index_filename = os.path.join(folder, INDEX_FILENAME)
+        if os.path.exists(self._index_filename):
+            with open(self._index_filename) as f:
+                self._entries = json.load(f)['masters']
+        else:
+            self._entries = []
+
+    def up_to_date(self, kind, fingerprint):
+        """Return the path of the master built from the same inputs or None."""
+        for entry in self._entries:
+            if entry['kind'] == kind and entry['fingerprint'] == fingerprint:
+                path = self._path(entry)
+                if os.path.exists(path):
+                    return path
+        return None
+
+    def path_for(self, kind, fingerprint):
+        """Where a new master of this kind and these inputs is to be stored."""
+        return os.path.join(self.folder, f'master-{kind}-{fingerprint[:16]}.fits')
+
+    def add(self, kind, header, fingerprint, path):
+        """\
+        Register a master written to `path` and replace older masters having the same keywords.
+
+        Older masters are only deleted if they lie inside the library folder,
+        masters written elsewhere using --output are just dropped from the index.
+        """
+        keys = header_keys(kind, header)
+        for entry in [e for e in self._entries if e['kind'] == kind and e['keys'] == keys]:
+            old_path = self._path(entry)
+            if old_path != os.path.abspath(path) and self._contains(old_path) and os.path.exists(old_path):
+                logger.info(f'remove outdated {kind} {old_path}')
+                os.remove(old_path)
+            self._entries.remove(entry)
+
+        self._entries.append(dict(kind=kind, keys=keys, fingerprint=fingerprint,
+                                  filename=os.path.relpath(path, self.folder)))
+        self._save()
+
+    def find(self, kind, header):
+        """Return the path of the master best matching a light's header or None."""
+        wanted = header_keys(kind, header)
+
+        candidates = []
+        for entry in self._entries:
+            if entry['kind'] != kind:
+                continue
+            distance = self._distance(entry['keys'], wanted)
+            if distance is not None and os.path.exists(self._path(entry)):
+                candidates.append((distance, self._path(entry)))
+
+        if not candidates:
+            return None
+        return min(candidates)[1]
+
+    def _distance(self, keys, wanted):
+        """None if the keys do not match, otherwise the temperature difference."""
+        distance = 0.0
+        for name, value in wanted.items():
+            other = keys.get(name)
+            if name == 'CCD-TEMP' and value is not None and other is not None:
+                distance = abs(float(value) - float(other))
+                if distance > self.temperature_tolerance:
+                    return None
+            elif name == 'EXPTIME' and value is not None and other is not None:
+                if not _is_close(float(value), float(other)):
+                    return None
+            elif value != other:
+                return None
+        return distance
+
+    def _path(self, entry):
+        return os.path.abspath(os.path.join(self.folder, entry['filename']))
+
+    def _contains(self, path):
+        folder = os.path.realpath(self.folder)
+        return os.path.commonpath([folder, os.path.realpath(path)]) == folder
+
+    def _save(self):
+        tmp_filename = self._index_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(dict(masters=self._entries), f, indent=2)
+        os.replace(tmp_filename, self._index_filename)
+
+
+def header_keys(kind, header):
+    """Extract the keywords relevant for matching masters of `kind` from a fits header."""
+    return {name: header.get(name) for name in MATCH_KEYWORDS[kind]}
+
+
+def fingerprint(filenames, **parameters):
+    """\
+    Hash input files and stacking parameters.
+
+    Files are identified by absolute path, size and modification time, so touching
+    or replacing any input, or changing the input set, changes the fingerprint.
+    """
+    digest = hashlib.sha1()
+    for filename in sorted(os.path.abspath(fn) for fn in filenames):
+        stat = os.stat(filename)
+        digest.update(f'{filename}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode('UTF-8'))
+    digest.update(json.dumps(parameters, sort_keys=True).encode('UTF-8'))
+    return digest.hexdigest()
+
+
+def _is_close(a, b, rel_tol=1e-6):
+    return abs(a - b) <= rel_tol * max(abs(a), abs(b))
@@ -0,0 +1,44 @@
+"""\
+Working precision of the floating point images processed by this package.
+
+Images are converted to the working dtype once while reading them and all later stages, de-bayering,
+calibration, background statistics and de-rotation, keep it. Sums over many pixels still accumulate in float64.
+
+float32 is the default. Its 24 bit mantissa exceeds the 16 bit of raw sensor data and it halves the memory
+traffic compared to float64. Use the environment variable ALGOL_BAYER_PRECISION=float64, `set_working_dtype`
+or the scripts' --precision option for float64 reference results.
+"""
+
+import os
+
+from bayer.utils import lazy_import
+
+np = lazy_import('numpy')
+
+PRECISION_VARIABLE = 'ALGOL_BAYER_PRECISION'
+PRECISIONS = 'float32', 'float64'
+DEFAULT_PRECISION = 'float32'
+
+
+def working_dtype():
+    """The floating point type of images, float32 unless chosen otherwise."""
+    precision = os.environ.get(PRECISION_VARIABLE) or DEFAULT_PRECISION
+    assert precision in PRECISIONS, f'{PRECISION_VARIABLE} must be one of {", ".join(PRECISIONS)}'
+    return np.dtype(precision)
+
+
+def set_working_dtype(precision):
+    """Change the working precision, also for subprocesses, e.g. the workers of `bayer_extract_spectra`."""
+    precision = np.dtype(precision).name
+    assert precision in PRECISIONS, f'precision must be one of {", ".join(PRECISIONS)}'
+    os.environ[PRECISION_VARIABLE] = precision
+
+
+def add_precision_argument(parser):
+    parser.add_argument('--precision', choices=PRECISIONS,
+                        help=f'floating point type of the images, by default ${PRECISION_VARIABLE} or {DEFAULT_PRECISION}')
+
+
+def apply_precision_argument(args):
+    if args.precision:
+        set_working_dtype(args.precision)
@@ -0,0 +1,147 @@
+"""\
+Instrumentation of the processing stages.
+
+Nothing is measured unless records are collected, see `collect` and `profiled`.
+Then `record` measures a unit of work, usually a single file, and `stage` or `timed` measure the steps within.
+A record is a dict like
+
+    {"file": "light.fits", "seconds": 1.2, "stages": {"_calibrate_light.read": 0.3, ...},
+     "bytes_read": 16777216, "peak_rss": 512000000}
+
+Stage times exclude the time of nested stages, so they add up to at most the record's seconds.
+`bytes_read` is the size of the input files opened within the record and
+`peak_rss` the high-water mark of the process's resident memory when the record ends.
+"""
+
+import contextlib
+import functools
+import json
+import os.path
+import sys
+import threading
+import time
+
+# stack of lists receiving the finished records
+_collectors = []
+
+# the record and the nested stages of the current thread
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def collect():
+    """Collect all records finished within the context in the yielded list."""
+    records = []
+    _collectors.append(records)
+    try:
+        yield records
+    finally:
+        _collectors.remove(records)
+
+
+def add(records):
+    """Add records collected elsewhere, e.g. in another process."""
+    if _collectors:
+        _collectors[-1].extend(records)
+
+
+@contextlib.contextmanager
+def record(filename, **fields):
+    """Measure a unit of work within the current thread."""
+    if not _collectors:
+        yield None
+        return
+
+    current = dict(file=filename, **fields, seconds=None, stages={}, bytes_read=0, peak_rss=None)
+    previous = getattr(_local, 'record', None), getattr(_local, 'stages', None)
+    _local.record, _local.stages = current, []
+
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current['seconds'] = time.perf_counter() - start
+        current['peak_rss'] = peak_rss()
+        _local.record, _local.stages = previous
+        if _collectors:
+            _collectors[-1].append(current)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Add the time spent within the context to the current record."""
+    current = getattr(_local, 'record', None)
+    if current is None:
+        yield
+        return
+
+    _local.stages.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = _local.stages.pop()
+        if _local.stages:
+            _local.stages[-1] += elapsed
+        current['stages'][name] = current['stages'].get(name, 0.0) + elapsed - nested
+
+
+def timed(function):
+    """Decorator measuring each call as a stage named after the function."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with stage(function.__qualname__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def read(filename):
+    """Count the size of filename as read by the current record."""
+    current = getattr(_local, 'record', None)
+    if current is not None:
+        current['bytes_read'] += os.path.getsize(filename)
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes or None if unknown."""
+    try:
+        import resource
+    except ImportError:  # e.g. on windows
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def add_profile_argument(parser):
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help="append a json record of durations, bytes read and peak memory per file to FILE, "
+                             "'-' for stdout")
+
+
+@contextlib.contextmanager
+def profiled(output_filename, command):
+    """Collect records within the context and append them as json lines to output_filename if given."""
+    if not output_filename:
+        yield
+        return
+
+    with collect() as records:
+        try:
+            yield
+        finally:
+            write(records, output_filename, command=command)
+
+
+def write(records, output_filename, **fields):
+    """Append each record merged with fields as a single json line."""
+    lines = [json.dumps(dict(fields, **r)) + '\n' for r in records]
+    if output_filename == '-':
+        sys.stdout.writelines(lines)
+    else:
+        with open(output_filename, 'a') as f:
+            f.writelines(lines)
@@ -0,0 +1,154 @@
+"""\
+Cache of decoded raw images, e.g. CR2 or NEF files.
+
+Decoding a raw file with LibRaw takes much longer than reading the decoded bayer matrix again.
+So `imread` stores `raw_image_visible` as a memory-mappable .npy sidecar together with a small .json file
+containing `raw_pattern`, `color_desc` and `white_level`.
+
+The cache is opt-in, it is only used if the environment variable ALGOL_BAYER_CACHE_DIR names its folder,
+e.g. ~/.cache/algol-bayer. Sidecars are keyed by path, size and modification time of the raw file.
+If the cache grows beyond ALGOL_BAYER_CACHE_MIB mebibytes, by default 2048, the least recently used
+sidecars are removed. ALGOL_BAYER_CACHE_MIB=0 disables the cache again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path
+import tempfile
+
+from bayer.utils import lazy_import
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_VARIABLE = 'ALGOL_BAYER_CACHE_DIR'
+CACHE_SIZE_VARIABLE = 'ALGOL_BAYER_CACHE_MIB'
+DEFAULT_CACHE_MIB = 2048
+
+
+class DecodedRaw:
+    """The parts of a `rawpy.RawPy` used by this package, usable in place of it, e.g. by `rawpy_to_rgb`."""
+
+    def __init__(self, raw_image_visible, raw_pattern, color_desc, white_level):
+        self.raw_image_visible = raw_image_visible
+        self.raw_pattern = np.asarray(raw_pattern)
+        self.color_desc = color_desc
+        self.white_level = white_level
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def imread(filename):
+    """\
+    Same as `rawpy.imread` but decoded from the cache, if possible.
+
+    Return
+    ------
+    DecodedRaw, its raw_image_visible is read-only
+    """
+    max_bytes = cache_size()
+    if not max_bytes:
+        return _decode(filename)
+
+    folder = cache_dir()
+    key = _key(filename)
+    raw = _load(folder, key)
+    if raw is not None:
+        logger.debug(f'{filename} found in {folder}')
+        return raw
+
+    raw = _decode(filename)
+    try:
+        _store(folder, key, filename, raw)
+        _evict(folder, max_bytes)
+    except OSError as e:
+        logger.warning(f'cannot cache {filename}: {e}')
+    return raw
+
+
+def cache_dir():
+    """Folder of the cache or None if caching is not enabled."""
+    return os.environ.get(CACHE_DIR_VARIABLE) or None
+
+
+def cache_size():
+    """Maximum size of the cache in bytes, 0 if caching is not enabled."""
+    if not cache_dir():
+        return 0
+    return int(float(os.environ.get(CACHE_SIZE_VARIABLE, DEFAULT_CACHE_MIB)) * 2 ** 20)
+
+
+def _decode(filename):
+    import rawpy
+
+    with rawpy.imread(filename) as raw:
+        raw_image = np.array(raw.raw_image_visible)
+        raw_image.setflags(write=False)
+        return DecodedRaw(raw_image, np.array(raw.raw_pattern), bytes(raw.color_desc), int(raw.white_level))
+
+
+def _key(filename):
+    stat = os.stat(filename)
+    identity = f'{os.path.abspath(filename)}\0{stat.st_size}\0{stat.st_mtime_ns}'
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+def _load(folder, key):
+    image_filename = os.path.join(folder, key + '.npy')
+    meta_filename = os.path.join(folder, key + '.json')
+    try:
+        with open(meta_filename) as f:
+            meta = json.load(f)
+        raw_image = np.load(image_filename, mmap_mode='r')
+        # the modification time tells the least recently used sidecars
+        os.utime(image_filename)
+        os.utime(meta_filename)
+    except (OSError, ValueError):
+        return None
+
+    return DecodedRaw(raw_image, meta['raw_pattern'], meta['color_desc'].encode('ascii'), meta['white_level'])
+
+
+def _store(folder, key, filename, raw):
+    os.makedirs(folder, exist_ok=True)
+
+    # concurrent readers must never see a partially written sidecar, the .json file is written last
+    with tempfile.NamedTemporaryFile(dir=folder, suffix='.tmp', delete=False) as f:
+        np.save(f, raw.raw_image_visible)
+    os.replace(f.name, os.path.join(folder, key + '.npy'))
+
+    meta = dict(source=os.path.abspath(filename), raw_pattern=np.asarray(raw.raw_pattern).tolist(),
+                color_desc=raw.color_desc.decode('ascii'), white_level=raw.white_level)
+    with tempfile.NamedTemporaryFile('w', dir=folder, suffix='.tmp', delete=False) as f:
+        json.dump(meta, f)
+    os.replace(f.name, os.path.join(folder, key + '.json'))
+
+
+def _evict(folder, max_bytes):
+    """Remove the least recently used sidecars until the cache is not larger than max_bytes."""
+    entries = []
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.npy'):
+            key = entry.name[:-len('.npy')]
+            meta_filename = os.path.join(folder, key + '.json')
+            size = entry.stat().st_size + (os.path.getsize(meta_filename) if os.path.exists(meta_filename) else 0)
+            entries.append((entry.stat().st_mtime_ns, size, key))
+
+    total = sum(size for __, size, __ in entries)
+    for __, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        for suffix in '.json', '.npy':
+            try:
+                os.remove(os.path.join(folder, key + suffix))
+            except FileNotFoundError:
+                pass
+        total -= size
+        logger.debug(f'removed {key} from {folder}')
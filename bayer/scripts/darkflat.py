@@ -1,19 +1,35 @@
 '''\
 Apply dork and flat images to one or more light images.
 '''
+import contextlib
 import glob
+import os.path
+import shutil
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os.path import basename, splitext, split
 from argparse import ArgumentParser
 
-import numpy as np
-from astropy.io import fits
+from bayer import profiling
+from bayer.compression import add_compression_arguments, write_fits
+from bayer.library import DARK, FLAT, MasterLibrary, fingerprint
+from bayer.precision import add_precision_argument, apply_precision_argument, working_dtype
+from bayer.stacking import RunningMean, sigma_clipped_mean
+from bayer.to_rgb import decode_images, fits_images, fits_scaling, open_fits, scale_to_float
+from bayer.utils import add_prefetch_argument, lazy_import, prefetch
 
 import logging
 
+np = lazy_import('numpy')
+
 DEFAULT_INFIX_DF = '-df'
 DEFAULT_INFIX_D = '-d'
 
+# Upper bound of temporaries an averaging algorithm creates, measured in float64 copies of its input.
+# Sigma clipping additionally keeps a boolean mask of the accepted input values.
+_AVERAGE_TEMPORARIES = 6
+
 program_name = sys.argv[0] if sys.argv and sys.argv[0] else basename(__file__)
 logger = logging.getLogger(program_name)
 
@@ -24,34 +40,74 @@ def apply_darks_and_flats():
         Apply a master-dark and optionally also a master-flat to a list of fits file.""")
 
     parser.add_argument('lights', nargs='+')
-    parser.add_argument('--master-dark', required=True)
+    parser.add_argument('--master-dark', help='required unless --library is used')
     parser.add_argument('--master-flat', required=False)
     parser.add_argument('--output-folder', '-o', default='.', help='default=%(default)s')
     parser.add_argument('--infix', help=f'defaults to either {DEFAULT_INFIX_D} or {DEFAULT_INFIX_DF}')
     parser.add_argument('--output-format', choices=['f4', 'u2', 'auto'], default='auto', help='default=%(default)s')
     parser.add_argument('--overwrite', default=False, action='store_true', help='Allow overwriting output')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of lights calibrated in parallel, default=%(default)s')
+    add_prefetch_argument(parser)
+    add_compression_arguments(parser)
+    _add_library_argument(parser, 'take masters matching each light from this library if not given explicitly')
+    profiling.add_profile_argument(parser)
+    add_precision_argument(parser)
     args = parser.parse_args()
+    apply_precision_argument(args)
 
-    lights = _load_from_pattern(args.lights)
-    input_filenames = _filenames(args.lights)
+    if not args.master_dark and not args.library:
+        parser.error('either --master-dark or --library is required')
 
-    master_dark = _load_from_pattern(args.master_dark)
-    assert master_dark.shape[0] == 1
-    output = lights - master_dark
+    with profiling.profiled(args.profile_json, 'fits_apply_darks_and_flats'):
+        _apply_darks_and_flats(args)
 
-    if args.master_flat:
-        master_flat = _load_from_pattern(args.master_flat)
-        assert master_flat.shape[0] == 1
-        output = output / master_flat
-        infix = args.infix or DEFAULT_INFIX_DF
-    else:
-        infix = args.infix or DEFAULT_INFIX_D
 
-    output = _format_array(output, args.output_format)
-
-    output_filenames = [create_output_filename(fn, args.output_folder, infix) for fn in input_filenames]
-    for o, inp, out in zip([output[i] for i in range(output.shape[0])], input_filenames, output_filenames):
-        _write_fits_using_header(o, inp, out, args.overwrite)
+def _apply_darks_and_flats(args):
+    input_filenames = _filenames(args.lights)
+    if not input_filenames:
+        raise SystemExit(f'no files for pattern "{args.lights}"')
+
+    library = MasterLibrary(args.library) if args.library else None
+
+    # each master is loaded once and shared by all lights using it
+    masters = {}
+
+    def shared_master(pattern):
+        if pattern not in masters:
+            with profiling.record(pattern, master=True):
+                masters[pattern] = load_master(pattern)
+        return masters[pattern]
+
+    tasks = []
+    for input_filename in input_filenames:
+        dark_pattern, flat_pattern = find_masters(input_filename, args.master_dark, args.master_flat, library)
+        master_dark = shared_master(dark_pattern)
+        if flat_pattern:
+            master_flat = shared_master(flat_pattern)
+            infix = args.infix or DEFAULT_INFIX_DF
+        else:
+            master_flat = None
+            infix = args.infix or DEFAULT_INFIX_D
+        output_filename = create_output_filename(input_filename, args.output_folder, infix)
+        tasks.append((input_filename, output_filename, master_dark, master_flat))
+
+    def calibrate(task, light):
+        with profiling.record(task[0]):
+            _calibrate_light(*task, args.output_format, args.overwrite, args.compress, args.tile_size, light)
+
+    # Lights are read ahead while the worker threads calibrate and write the previous ones.
+    # The worker threads share the read-only masters; numpy releases the GIL while calibrating.
+    jobs = max(1, args.jobs)
+    lights = prefetch(_read_light, [task[0] for task in tasks], args.prefetch)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        calibrating = deque()
+        for task, (__, light) in zip(tasks, lights):
+            calibrating.append(executor.submit(calibrate, task, light))
+            while len(calibrating) > jobs:
+                calibrating.popleft().result()
+        while calibrating:
+            calibrating.popleft().result()
 
 
 def create_master_dark():
@@ -60,18 +116,58 @@ def create_master_dark():
         Create a master dark, flat-dark or bias from a list of files.""")
 
     parser.add_argument('darks', nargs='+')
-    parser.add_argument('--algorithm', choices=['mean', 'median', 'sigma3'], default='sigma3',
-                        help='default=%(default)s')
-    parser.add_argument('--output', '-o', default='master-dark.fits', help='default=%(default)s')
+    _add_algorithm_arguments(parser)
+    parser.add_argument('--output', '-o', help='default=master-dark.fits or a new file in --library')
     parser.add_argument('--output-format', choices=['f4', 'u2', 'auto'], default='auto', help='default=%(default)s')
     parser.add_argument('--overwrite', default=False, action='store_true', help='Allow overwriting output')
+    add_compression_arguments(parser)
+    _add_memory_limit_argument(parser)
+    _add_library_argument(parser, 'store the master in this library; skip stacking if the darks did not change')
+    profiling.add_profile_argument(parser)
+    add_precision_argument(parser)
     args = parser.parse_args()
+    apply_precision_argument(args)
+
+    with profiling.profiled(args.profile_json, 'fits_create_master_dark'):
+        _create_master_dark(args)
+
+
+def _create_master_dark(args):
+    input_filenames = _filenames(args.darks)
+    if not input_filenames:
+        raise SystemExit(f'no files for pattern "{args.darks}"')
+
+    if args.library:
+        library = MasterLibrary(args.library)
+        input_fingerprint = fingerprint(input_filenames, algorithm=args.algorithm, output_format=args.output_format,
+                                        precision=working_dtype().name, **_sigma_arguments(args),
+                                        **_compression_arguments(args))
+        if _reuse_master(library, DARK, input_fingerprint, args.output, args.overwrite):
+            return
+        output_filename = args.output or library.path_for(DARK, input_fingerprint)
+    else:
+        library = None
+        output_filename = args.output or 'master-dark.fits'
+
+    with profiling.record(output_filename, inputs=len(input_filenames)):
+        header = _stack_darks(args, output_filename)
 
-    darks = _load_from_pattern(args.darks)
-    output = _average(darks, args.algorithm)
+    if library:
+        library.add(DARK, header, input_fingerprint, output_filename)
+
+
+def _stack_darks(args, output_filename):
+    """Write the master dark and return the header of the first dark, it is read only once."""
+    if args.memory_limit:
+        output, header = _average_from_pattern(args.darks, args.algorithm, _mib_to_bytes(args.memory_limit),
+                                               return_header=True, **_sigma_arguments(args))
+    else:
+        darks, header = _load_from_pattern(args.darks, args.jobs, return_header=True)
+        output = _average(darks, args.algorithm, **_sigma_arguments(args))
     output = _format_array(output, args.output_format)
 
-    _write_fits_using_header(output, _filenames(args.darks)[0], args.output, args.overwrite)
+    _write_fits_using_header(output, header.copy(), output_filename, args.overwrite, args.compress, args.tile_size)
+    return header
 
 
 def create_master_flat():
@@ -80,49 +176,278 @@ def create_master_flat():
         Create a master flat from a list of flats and a master dark.""")
 
     parser.add_argument('flats', nargs='+')
-    parser.add_argument('--algorithm', choices=['mean', 'median', 'sigma3'], default='sigma3',
-                        help='default=%(default)s')
-    parser.add_argument('--master-flat-dark', required=True)
-    parser.add_argument('--output', '-o', default='./master-flat.fits', help='default=%(default)s')
+    _add_algorithm_arguments(parser)
+    parser.add_argument('--master-flat-dark', help='required unless --library is used')
+    parser.add_argument('--output', '-o', help='default=./master-flat.fits or a new file in --library')
     parser.add_argument('--output-format', choices=['f4', 'auto'], default='auto', help='default=%(default)s')
     parser.add_argument('--overwrite', default=False, action='store_true', help='Allow overwriting output')
+    add_compression_arguments(parser)
+    _add_memory_limit_argument(parser)
+    _add_library_argument(parser, 'store the master in this library and take the flat-dark from it if not given; '
+                                  'skip stacking if neither flats nor flat-dark did change')
+    profiling.add_profile_argument(parser)
+    add_precision_argument(parser)
     args = parser.parse_args()
+    apply_precision_argument(args)
+
+    if not args.master_flat_dark and not args.library:
+        parser.error('either --master-flat-dark or --library is required')
+
+    with profiling.profiled(args.profile_json, 'fits_create_master_flat'):
+        _create_master_flat(args)
+
+
+def _create_master_flat(args):
+    input_filenames = _filenames(args.flats)
+    if not input_filenames:
+        raise SystemExit(f'no files for pattern "{args.flats}"')
+    first_filename = input_filenames[0]
+
+    if args.library:
+        library = MasterLibrary(args.library)
+        flat_dark_pattern, __ = find_masters(first_filename, args.master_flat_dark, None, library)
+        input_fingerprint = fingerprint(input_filenames + _filenames(flat_dark_pattern), algorithm=args.algorithm,
+                                        output_format=args.output_format, precision=working_dtype().name,
+                                        **_sigma_arguments(args), **_compression_arguments(args))
+        if _reuse_master(library, FLAT, input_fingerprint, args.output, args.overwrite):
+            return
+        output_filename = args.output or library.path_for(FLAT, input_fingerprint)
+    else:
+        library = None
+        flat_dark_pattern = args.master_flat_dark
+        output_filename = args.output or './master-flat.fits'
+
+    with profiling.record(output_filename, inputs=len(input_filenames)):
+        header = _stack_flats(args, flat_dark_pattern, output_filename)
+
+    if library:
+        library.add(FLAT, header, input_fingerprint, output_filename)
+
 
-    first_filename = _filenames(args.flats)[0]
-    flats = _load_from_pattern(args.flats)
-    master_dark = _load_from_pattern(args.master_flat_dark)
+def _stack_flats(args, flat_dark_pattern, output_filename):
+    """Write the master flat and return the header of the first flat, it is read only once."""
+    master_dark = _load_from_pattern(flat_dark_pattern)
     assert master_dark.shape[0] == 1
-    flats = flats - master_dark
-    output = _average(flats, args.algorithm)
-    output = _normalize_flat(output, first_filename)
+    if args.memory_limit:
+        output, header = _average_from_pattern(args.flats, args.algorithm, _mib_to_bytes(args.memory_limit),
+                                               offset=master_dark[0], return_header=True, **_sigma_arguments(args))
+    else:
+        flats, header = _load_from_pattern(args.flats, args.jobs, return_header=True)
+        flats = flats - master_dark
+        output = _average(flats, args.algorithm, **_sigma_arguments(args))
+    output = _normalize_flat(output, header)
     output = _format_array(output, args.output_format)
 
-    _write_fits_using_header(output, first_filename, args.output, args.overwrite)
+    _write_fits_using_header(output, header.copy(), output_filename, args.overwrite, args.compress, args.tile_size)
+    return header
+
 
+def accumulate_master_dark():
+    logging.basicConfig(level=logging.INFO)
+    parser = ArgumentParser(description="""\
+        Add darks to a running master dark without stacking the previously added darks again.""")
 
-def _normalize_flat(flat, filename):
+    parser.add_argument('darks', nargs='+')
+    parser.add_argument('--state', help='running mean and variance of all darks added so far, created if missing; '
+                                        'default=OUTPUT with suffix .state.fits')
+    parser.add_argument('--output', '-o', default='master-dark.fits', help='default=%(default)s')
+    parser.add_argument('--output-format', choices=['f4', 'u2', 'auto'], default='auto', help='default=%(default)s')
+    parser.add_argument('--sigma-lower', type=float,
+                        help='reject values below mean - sigma_lower * stddev of the darks added so far')
+    parser.add_argument('--sigma-upper', type=float,
+                        help='reject values above mean + sigma_upper * stddev of the darks added so far')
+    parser.add_argument('--min-frames', type=int, default=3,
+                        help='never reject any of the first darks of a pixel, default=%(default)s')
+    parser.add_argument('--overwrite', default=False, action='store_true',
+                        help='Allow overwriting an output not written using the state')
+    add_compression_arguments(parser)
+    profiling.add_profile_argument(parser)
+    args = parser.parse_args()
+
+    input_filenames = _filenames(args.darks)
+    if not input_filenames:
+        raise SystemExit(f'no files for pattern "{args.darks}"')
+
+    state_filename = args.state or splitext(args.output)[0] + '.state.fits'
+    with profiling.profiled(args.profile_json, 'fits_accumulate_master_dark'):
+        with profiling.record(args.output, inputs=len(input_filenames)):
+            _accumulate_darks(input_filenames, state_filename, args)
+
+
+def _accumulate_darks(input_filenames, state_filename, args):
+    """Add the darks to the state and write the master, the output of earlier calls is always overwritten."""
+    if os.path.exists(state_filename):
+        running_mean, header = RunningMean.load(state_filename)
+        if args.sigma_lower is not None or args.sigma_upper is not None:
+            logger.warning(f'use the clipping parameters stored in {state_filename}')
+    elif os.path.exists(args.output) and not args.overwrite:
+        raise SystemExit(f'{args.output} already exists')
+    else:
+        running_mean, header = None, None
+
+    added = 0
+    for filename in input_filenames:
+        profiling.read(filename)
+        with open_fits(filename) as hdu_list:
+            # the accumulators are float64 anyway
+            images = fits_images(hdu_list, dtype=np.float64, mosaic=True)
+            source = os.path.abspath(filename)
+            sources = [source] if len(images) == 1 else [f'{source}[{index}]' for index in range(len(images))]
+            for image, source in zip(images, sources):
+                if running_mean is not None and source in running_mean.sources:
+                    continue
+                if image.shape[0] != 1:
+                    raise SystemExit(f'{filename} contains an image of more than one layer')
+                if running_mean is None:
+                    header = _image_header(hdu_list)
+                    running_mean = RunningMean(image.shape[1:], args.sigma_lower, args.sigma_upper, args.min_frames)
+                running_mean.add(image.decode()[0], source)
+                added += 1
+
+    logger.info(f'added {added} darks, {running_mean.frames} in total')
+    if not added and os.path.exists(args.output):
+        return
+
+    running_mean.save(state_filename, header)
+
+    output = _format_array(running_mean.mean, args.output_format)
+    header = header.copy()
+    header['NCOMBINE'] = (running_mean.frames, 'number of darks averaged')
+    _write_fits_using_header(output, header, args.output, True, args.compress, args.tile_size)
+    logger.info(f'wrote {args.output}')
+
+
+def _add_library_argument(parser, help):
+    parser.add_argument('--library', metavar='FOLDER', help=help)
+
+
+def _reuse_master(library, kind, input_fingerprint, output_filename, overwrite):
+    """Return True if the library already contains a master built from the same inputs."""
+    existing = library.up_to_date(kind, input_fingerprint)
+    if not existing:
+        return False
+
+    logger.info(f'master {kind} {existing} is up to date')
+    if output_filename and os.path.abspath(output_filename) != existing:
+        if os.path.exists(output_filename) and not overwrite:
+            raise SystemExit(f'{output_filename} already exists')
+        shutil.copyfile(existing, output_filename)
+    return True
+
+
+def find_masters(light_filename, dark_pattern, flat_pattern, library):
+    """\
+    Use explicitly given masters or find matching ones in the library.
+
+    Raises SystemExit if the library contains no matching master dark.
+    """
+    if library and not (dark_pattern and flat_pattern):
+        with open_fits(light_filename) as hdu_list:
+            header = _image_header(hdu_list)
+        if not dark_pattern:
+            dark_pattern = library.find(DARK, header)
+            if not dark_pattern:
+                raise SystemExit(f'no matching master dark for {light_filename} in {library.folder}')
+        if not flat_pattern:
+            flat_pattern = library.find(FLAT, header)
+    return dark_pattern, flat_pattern
+
+
+def load_master(pattern):
+    """Load a single read-only master, raises SystemExit if the pattern matches no file or more than one master."""
+    master = _load_from_pattern(pattern)
+    if master.shape[0] != 1:
+        raise SystemExit(f'pattern "{pattern}" yields more than one master')
+    master = master[0]
+    master.setflags(write=False)
+    return master
+
+
+def _calibrate_light(input_filename, output_filename, master_dark, master_flat, output_format, overwrite,
+                     compress=False, tile_size=None, light=None):
+    """\
+    Load a single light, apply the masters and write the result before the next light is loaded.
+
+    `light` is a future of `_read_light(input_filename)`, e.g. read ahead by `prefetch`.
+    The read stage then only measures the time waiting for it.
+    """
+    profiling.read(input_filename)
+    with profiling.stage('_calibrate_light.read'):
+        output, header = light.result() if light else _read_light(input_filename)
+
+    with profiling.stage('_calibrate_light.calibrate'):
+        np.subtract(output, master_dark, out=output, casting='unsafe')
+        if master_flat is not None:
+            np.true_divide(output, master_flat, out=output, casting='unsafe')
+
+    output = _format_array(output, output_format)
+    _write_fits_using_header(output, header, output_filename, overwrite, compress, tile_size)
+    logger.info(f'wrote {output_filename}')
+
+
+def _read_light(input_filename):
+    """Return the first image of a light in the working precision and its header, it is opened only once."""
+    with open_fits(input_filename) as hdu_list:
+        hdu = _image_hdu(hdu_list)
+        return scale_to_float(hdu.data, *fits_scaling(hdu)), _image_header(hdu_list)
+
+
+def _add_algorithm_arguments(parser):
+    parser.add_argument('--algorithm', choices=['mean', 'median', 'sigma3'], default='sigma3',
+                        help='default=%(default)s')
+    parser.add_argument('--sigma-lower', type=float, default=3.0,
+                        help='lower sigma3 rejection bound in units of stddev, default=%(default)s')
+    parser.add_argument('--sigma-upper', type=float, default=3.0,
+                        help='upper sigma3 rejection bound in units of stddev, default=%(default)s')
+    parser.add_argument('--max-iters', type=int, default=3,
+                        help='maximum number of sigma3 rejection iterations, default=%(default)s')
+
+
+def _sigma_arguments(args):
+    return dict(sigma_lower=args.sigma_lower, sigma_upper=args.sigma_upper, max_iters=args.max_iters)
+
+
+def _compression_arguments(args):
+    # uncompressed masters keep the fingerprints they had before compression was an option
+    return dict(compress=True, tile_size=args.tile_size) if args.compress else {}
+
+
+def _add_memory_limit_argument(parser):
+    parser.add_argument('--memory-limit', metavar='MiB', type=float,
+                        help='stack memory-mapped files in bands of rows using about this much memory; '
+                             'by default all files are loaded at once')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of images, e.g. of cubes or multi-extension files, decoded in parallel '
+                             'unless --memory-limit is given, default=%(default)s')
+
+
+def _mib_to_bytes(mib):
+    return int(mib * 2 ** 20)
+
+
+@profiling.timed
+def _normalize_flat(flat, header):
     """Praxis has shown, that flats are never white. For RGB flats we want to normalize by channel."""
     assert flat.ndim == 2
-    with fits.open(filename) as hdu_list:
-        header = hdu_list[0].header
-        is_bayer = header.get('BAYERPAT') is not None
-        if is_bayer:
-            assert header.get('NAXIS') == 2
-            # ignore the last odd row or column
-            rows, columns = flat.shape
-            rows = rows // 2 * 2
-            columns = columns // 2 * 2
-            for row, column in (0, 0), (0, 1), (1, 0), (1, 1):
-                mean = np.nanmean(flat[row:rows:2, column:columns:2])
-                flat[row:rows:2, column:columns:2] = flat[row:rows:2, column:columns:2] / mean
-        else:
-            rows, columns = flat.shape
-            rows = rows // 2 * 2
-            columns = columns // 2 * 2
-            flat = flat / np.nanmean(flat[0:rows, 0:columns])
-        return flat
+    is_bayer = header.get('BAYERPAT') is not None
+    if is_bayer:
+        assert header.get('NAXIS') == 2
+        # ignore the last odd row or column
+        rows, columns = flat.shape
+        rows = rows // 2 * 2
+        columns = columns // 2 * 2
+        for row, column in (0, 0), (0, 1), (1, 0), (1, 1):
+            mean = np.nanmean(flat[row:rows:2, column:columns:2])
+            flat[row:rows:2, column:columns:2] = flat[row:rows:2, column:columns:2] / mean
+    else:
+        rows, columns = flat.shape
+        rows = rows // 2 * 2
+        columns = columns // 2 * 2
+        flat = flat / np.nanmean(flat[0:rows, 0:columns])
+    return flat
 
 
+@profiling.timed
 def _format_array(output, output_format):
     if output_format == 'auto':
         # convert double to single float
@@ -133,14 +458,15 @@ def _format_array(output, output_format):
     return output
 
 
-def _write_fits_using_header(data, input_filename, output_filename, overwrite):
-    with fits.open(input_filename) as hdu_list:
-        header = hdu_list[0].header
-        header.add_comment(f'darks and/or flats by {program_name}; see https://pypi.org/project/algol-bayer/')
-        fits.writeto(output_filename, data, header=header, overwrite=overwrite)
+@profiling.timed
+def _write_fits_using_header(data, header, output_filename, overwrite, compress=False, tile_size=None):
+    """Write data with a header kept from reading the input, the input is not opened again."""
+    header.add_comment(f'darks and/or flats by {program_name}; see https://pypi.org/project/algol-bayer/')
+    write_fits(output_filename, data, header=header, compress=compress, tile_size=tile_size, overwrite=overwrite)
 
 
-def _average(input, algorithm):
+@profiling.timed
+def _average(input, algorithm, sigma_lower=3.0, sigma_upper=3.0, max_iters=3):
     assert input.ndim == 3
     if algorithm == 'mean':
         output = np.nanmean(input, axis=0)
@@ -148,18 +474,55 @@ def _average(input, algorithm):
         output = np.nanmedian(input, axis=0)
     else:
         assert algorithm == 'sigma3'
-        clipped = input
-        for i in range(3):
-            mean = np.nanmean(clipped, axis=0)
-            stddev = np.nanstd(clipped, axis=0)
-            clipped = np.where(np.logical_and(mean - 3 * stddev <= input, input <= mean + 3 * stddev), input, np.nan)
-
-        output = np.nanmean(clipped, axis=0)
+        output = sigma_clipped_mean(input, sigma_lower, sigma_upper, max_iters)
 
     assert output.ndim == 2
     return output
 
 
+@profiling.timed
+def _average_from_pattern(pattern, algorithm, memory_limit, offset=None, return_header=False, **sigma_arguments):
+    """\
+    Same as `_average(_load_from_pattern(pattern) - offset, algorithm)` but out-of-core.
+
+    All images are opened memory-mapped and averaged in bands of rows that fit into `memory_limit` bytes
+    together with the output and `offset`. Tile-compressed images cannot be read by rows and raise SystemExit.
+    Each output pixel only depends on the same pixel of the input frames, so the result is bit-identical.
+    With `return_header` also return the header of the first image, see `_open_images`.
+    """
+    filenames = _filenames(pattern)
+    if not filenames:
+        raise SystemExit(f'no files for pattern "{pattern}"')
+
+    with contextlib.ExitStack() as stack:
+        images, header = _open_images(filenames, stack, pattern, by_rows=True)
+        __, rows, columns = images[0].shape
+        output = np.empty((rows, columns), dtype=working_dtype())
+        reserved = output.nbytes + (offset.nbytes if offset is not None else 0)
+        band_rows = _band_rows(len(images), columns, memory_limit - reserved)
+        logger.info(f'average {len(images)} images in bands of {band_rows} rows')
+
+        buffer = np.empty((len(images), min(band_rows, rows), columns), dtype=working_dtype())
+        for start in range(0, rows, band_rows):
+            stop = min(start + band_rows, rows)
+            band = buffer[:, :stop - start]
+            for frame, image in zip(band, images):
+                # only the rows of the band are read from the memory-mapped files
+                scale_to_float(image.raw[0, start:stop], image.bscale, image.bzero, out=frame)
+            if offset is not None:
+                np.subtract(band, offset[start:stop], out=band, casting='unsafe')
+
+            output[start:stop] = _average(band, algorithm, **sigma_arguments)
+
+    return (output, header) if return_header else output
+
+
+def _band_rows(num_frames, columns, memory_limit):
+    """Number of rows averaged at once, the temporaries and the mask of accepted values fit into memory_limit."""
+    bytes_per_value = np.dtype(np.float64).itemsize * _AVERAGE_TEMPORARIES + np.dtype(bool).itemsize
+    return max(1, int(memory_limit // (num_frames * columns * bytes_per_value)))
+
+
 def _filenames(patterns):
     if isinstance(patterns, str):
         patterns = [patterns]
@@ -173,12 +536,72 @@ def _filenames(patterns):
     return result
 
 
-def _load_from_pattern(pattern):
+@profiling.timed
+def _load_from_pattern(pattern, jobs=1, return_header=False):
+    """\
+    Load all single layer images of all files matching pattern, see `_open_images`, into one stack.
+
+    With `return_header` also return the header of the first image.
+    """
     filenames = _filenames(pattern)
     if not filenames:
         raise SystemExit(f'no files for pattern "{pattern}"')
-    # TODO load more than one image per file?
-    return np.asarray([fits.open(fn)[0].data for fn in filenames])
+
+    with contextlib.ExitStack() as stack:
+        images, header = _open_images(filenames, stack, pattern)
+        output = decode_images(images, jobs)[:, 0]
+
+    return (output, header) if return_header else output
+
+
+def _open_images(filenames, stack, pattern, by_rows=False):
+    """\
+    List the images of all files, each image hdu and each plane of a cube is an image.
+
+    The files are opened memory-mapped within stack, nothing is decoded yet.
+    Bayer matrices are not de-bayered, since darks and flats are applied before de-bayering.
+    With `by_rows`, raise SystemExit for tile-compressed files, accessing their data decompresses whole images.
+
+    Return
+    ------
+    the images and a copy of the header of the first one
+    """
+    from astropy.io import fits
+
+    images = []
+    header = None
+    for fn in filenames:
+        profiling.read(fn)
+        hdu_list = stack.enter_context(open_fits(fn))
+        if by_rows and any(isinstance(hdu, fits.CompImageHDU) for hdu in hdu_list):
+            raise SystemExit(f'{fn} is tile-compressed and cannot be read by rows, use it without --memory-limit')
+        file_images = fits_images(hdu_list, mosaic=True)
+        if not file_images:
+            logger.warning(f'{fn} contains no images')
+        elif header is None:
+            header = _image_header(hdu_list)
+        images += file_images
+
+    if not images:
+        raise SystemExit(f'files for pattern "{pattern}" contain no images')
+    shape = images[0].shape
+    if shape[0] != 1 or any(image.shape != shape for image in images):
+        raise SystemExit(f'files for pattern "{pattern}" do not share the same 2d image shape')
+
+    return images, header
+
+
+def _image_hdu(hdu_list):
+    """The first hdu containing an image, e.g. the extension of a tile-compressed file, or the primary one."""
+    return next((hdu for hdu in hdu_list if hdu.is_image and hdu.header.get('NAXIS', 0) >= 2), hdu_list[0])
+
+
+def _image_header(hdu_list):
+    """Copy the header of `_image_hdu` without BZERO and BSCALE, they belong to the raw integer data."""
+    header = _image_hdu(hdu_list).header.copy()
+    for key in 'BZERO', 'BSCALE':
+        header.remove(key, ignore_missing=True)
+    return header
 
 
 def create_output_filename(input_filename, folder, infix):
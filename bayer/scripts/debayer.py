@@ -1,17 +1,22 @@
 """\
 For a bayer-masked raw fits file, e.g. generated using an astro color camera and kstars,
 convert the raw image into a 3 layer RGB fits image.
+Cubes and multi-extension files become a file with an RGB image per hdu.
 """
 
 import glob
 import logging
+import os.path
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os.path import basename, splitext
 
-import numpy as np
-from astropy.io import fits
+from bayer.compression import add_compression_arguments, write_fits
+from bayer.to_rgb import fits_images, open_fits
+from bayer.utils import lazy_import
 
-from bayer.to_rgb import fits_to_layers
+np = lazy_import('numpy')
 
 logger = logging.getLogger(__name__)
 
@@ -36,20 +41,59 @@ def main():
 
     output_filenames = [args.output] if args.output else [create_output_filename(fn) for fn in input_filenames]
 
-    for input_filename, output_filename in zip(input_filenames, output_filenames):
-        _debayer_fits_file(input_filename, output_filename)
-
-
-def _debayer_fits_file(input_filename, output_filename):
-    with fits.open(input_filename) as hdu_list:
-        hdu = hdu_list[0]  # only convert the first
-        if len(hdu_list) > 1:
-            logger.warning(f'ignore all but the first hdu in "{input_filename}"')
-
-        header = hdu.header
-
-        layers = fits_to_layers(hdu)
-        layers = np.asarray(layers, dtype='f')  # float 32
+    filenames = list(zip(input_filenames, output_filenames))
+    if args.skip_existing:
+        filenames = [(inp, out) for inp, out in filenames if not os.path.exists(out)]
+        logger.info(f'skip {len(input_filenames) - len(filenames)} files having an output already')
+
+    _debayer_fits_files(filenames, max(1, args.jobs), args.compress, args.tile_size)
+
+
+def _debayer_fits_files(filenames, jobs, compress=False, tile_size=None):
+    """\
+    Debayer pairs of input and output filenames in a pipeline.
+
+    `jobs` threads read and debayer images while a single thread writes the results.
+    Each image of a cube or a multi-extension file is a job of its own and becomes an hdu of the output file.
+    About 2 * jobs images are in memory at the same time.
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as workers, ThreadPoolExecutor(max_workers=1) as writer:
+        debayering = deque()
+        writing = deque()
+
+        def write_next():
+            output_filename, index, future = debayering.popleft()
+            writing.append(writer.submit(_write_debayered, output_filename, index, *future.result(),
+                                         compress=compress, tile_size=tile_size))
+            while len(writing) > jobs:
+                writing.popleft().result()
+
+        for input_filename, output_filename in filenames:
+            with open_fits(input_filename) as hdu_list:
+                num_images = len(fits_images(hdu_list))
+            if not num_images:
+                logger.warning(f'{input_filename} contains no images')
+
+            for index in range(num_images):
+                debayering.append((output_filename, index, workers.submit(_read_and_debayer, input_filename, index)))
+                if len(debayering) > jobs:
+                    write_next()
+
+        while debayering:
+            write_next()
+        while writing:
+            writing.popleft().result()
+
+
+def _read_and_debayer(input_filename, index=0):
+    """Debayer the image `index` of `fits_images` and return its layers and header."""
+    with open_fits(input_filename) as hdu_list:
+        # float 32
+        images = [(hdu, image) for hdu in hdu_list for image in fits_images([hdu], dtype='f')]
+        hdu, image = images[index]
+        header = hdu.header.copy()
+
+        layers = np.asarray(image)
         assert layers.ndim == 3
         assert layers.shape[0] == 3
         # NAXIS*, BITPIX, BZERO and BSCALE will be derived from layers
@@ -73,7 +117,13 @@ def _debayer_fits_file(input_filename, output_filename):
 
         header.add_comment(f'De-bayered by {basename(__file__)}; see https://pypi.org/project/algol-bayer/')
 
-        fits.writeto(output_filename, data=layers, header=header)
+    return layers, header
+
+
+def _write_debayered(output_filename, index, layers, header, compress=False, tile_size=None):
+    """Write the first image into a new file, append the others as image extensions."""
+    write_fits(output_filename, layers, header=header, compress=compress, tile_size=tile_size, append=index > 0)
+    logger.info(f'wrote {output_filename}' + (f'[{index}]' if index else ''))
 
 
 def create_output_filename(input_filename):
@@ -83,6 +133,11 @@ def create_output_filename(input_filename):
 
 def _create_argument_parser():
     parser = ArgumentParser(description=__doc__)
-    parser.add_argument('filename', nargs='+', help='one or more fits files containing a single raw color image each')
+    parser.add_argument('filename', nargs='+', help='one or more fits files containing raw color images')
     parser.add_argument('--output', '-o', nargs='?', help='one fits files containing a single RGB color image')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of images read and debayered in parallel, default=%(default)s')
+    parser.add_argument('--skip-existing', default=False, action='store_true',
+                        help='skip input files whose output file already exists')
+    add_compression_arguments(parser)
     return parser
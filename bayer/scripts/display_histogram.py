@@ -4,47 +4,67 @@ import logging
 import os.path
 from argparse import ArgumentParser
 
-import matplotlib.pyplot as plt
-import numpy as np
-from astropy.stats import sigma_clipped_stats
+from bayer.background import METHODS
+from bayer.histogram import clipped_histogram, histogram_stats, histograms, saturated_fraction
+from bayer.utils import add_prefetch_argument, lazy_import, multi_glob, prefetch
 
-from bayer.to_rgb import rawpy_to_rgb
-from bayer.utils import multi_glob
+plt = lazy_import('matplotlib.pyplot')
 
 
 def main_raw():
-    import rawpy
-
     parser = _create_argument_parser('one or more raw files containing bayer matrices')
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
+    _warn_about_background(args)
 
-    for filename in multi_glob(args.filename):
-        with rawpy.imread(filename) as raw:
-            rgb = rawpy_to_rgb(raw)
-            max_range = raw.white_level
-
-        _plot_histogram(os.path.basename(filename), rgb, max_range, args.sigma, args.clipping)
+    # the histograms of the next files are counted while a plot is shown
+    for filename, future in prefetch(_raw_histograms, multi_glob(args.filename), args.prefetch):
+        values, counts, max_range = future.result()
+        _plot_histogram(os.path.basename(filename), values, counts, max_range, args.sigma, args.clipping)
 
 
 def main_fits():
-    from astropy.io import fits
-
     parser = _create_argument_parser('one or more fits files containing images')
 
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
+    _warn_about_background(args)
+
+    # the histograms of the next files are counted while a plot is shown
+    for filename, future in prefetch(_fits_histograms, multi_glob(args.filename), args.prefetch):
+        image_histograms = future.result()
+        if not image_histograms:
+            logging.error(f"{filename} contains no images")
+
+        for values, counts, white_level in image_histograms:
+            _plot_histogram(os.path.basename(filename), values, counts, white_level, args.sigma, args.clipping)
+
 
-    for filename in multi_glob(args.filename):
-        with fits.open(filename) as hdu_list:
-            images = [hdu.data for hdu in hdu_list if hdu.header.get("NAXIS", 0) == 2]
-            if not images:
-                logging.error(f"{filename} contains no images")
+def _raw_histograms(filename):
+    """Return values and counts of each color of a raw file and its white level."""
+    from bayer import raw_cache
 
-            for image in images:
-                _plot_histogram(os.path.basename(filename), np.asarray([image]), 2 ** 16, args.sigma, args.clipping)
+    with raw_cache.imread(filename) as raw:
+        assert all((c in raw.color_desc for c in b'RGB')), 'not a RBG raw image'
+        # the channel of each pixel of the bayer matrix, e.g. [[0, 1], [1, 2]] for RGGB
+        pattern = [[b'RGB'.index(raw.color_desc[index]) for index in row] for row in raw.raw_pattern]
+        values, counts = histograms(raw.raw_image_visible, pattern)
+        return values, counts, raw.white_level
+
+
+def _fits_histograms(filename):
+    """Return values, counts and white level of each image of a fits file."""
+    from bayer.to_rgb import fits_images, open_fits
+
+    result = []
+    with open_fits(filename) as hdu_list:
+        for image in fits_images(hdu_list, mosaic=True):
+            # count the unscaled integers and scale the values afterwards
+            values, counts = histograms(image.raw)
+            result.append((values * image.bscale + image.bzero, counts, image.white_level))
+    return result
 
 
 def _create_argument_parser(filename_help=None):
@@ -53,24 +73,37 @@ def _create_argument_parser(filename_help=None):
     parser.add_argument('--sigma', '-s', default=3.0, type=float, help='sigma used for clipping')
     parser.add_argument('--clipping', '-c', default=10.0, type=float,
                         help='clip background at mean + clipping * stddev')
+    parser.add_argument('--background', choices=METHODS,
+                        help='deprecated and ignored, the background statistics are exact and taken from the histograms')
+    add_prefetch_argument(parser)
     return parser
 
 
-def _plot_histogram(title, layers, max_range, sigma, clipping):
+def _warn_about_background(args):
+    if args.background:
+        logging.warning('--background is deprecated and ignored, the background statistics are taken from the histograms')
+
+
+def _plot_histogram(title, values, counts, max_range, sigma, clipping):
+    """Plot the pixels above the background of each channel, all derived from the channels' histograms."""
     fig = plt.figure()
     fig.canvas.manager.set_window_title(title)
 
-    num_layers, __, __ = layers.shape
+    num_channels = len(counts)
 
     ax = fig.add_subplot()
-    if num_layers == 3:
+    if num_channels == 3:
         colors = 'rgb'
     else:
-        colors = 'k' * num_layers
-
-    for color, layer in zip(colors, [layers[i] for i in range(num_layers)]):
-        (mean, median, stddev) = sigma_clipped_stats(layer, sigma=sigma)
-        hist = np.histogram(layer[layer >= (mean + clipping * stddev)], bins=100)
+        colors = 'k' * num_channels
+
+    means, medians, stddevs = histogram_stats(values, counts, sigma_lower=sigma, sigma_upper=sigma)
+    saturated = saturated_fraction(values, counts, max_range)
+    for color, channel_counts, mean, median, stddev, fraction in zip(colors, counts, means, medians, stddevs,
+                                                                     saturated):
+        logging.info(f'{title} {color}: background mean {mean:.1f}, median {median:.1f}, stddev {stddev:.1f}, '
+                     f'{fraction:.3%} saturated')
+        hist = clipped_histogram(values, channel_counts, mean + clipping * stddev, bins=100)
 
         ax.plot(hist[1][1:], hist[0], color)
 
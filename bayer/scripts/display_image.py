@@ -6,12 +6,12 @@ import logging
 import os.path
 from argparse import ArgumentParser
 
-import matplotlib
-import matplotlib.pyplot as plt
-import numpy as np
+from bayer.to_rgb import rawpy_to_rgb, fits_image_indices, fits_images, open_fits
+from bayer.utils import add_prefetch_argument, lazy_import, multi_glob, prefetch
 
-from bayer.to_rgb import rawpy_to_rgb, fits_to_layers
-from bayer.utils import multi_glob
+np = lazy_import('numpy')
+plt = lazy_import('matplotlib.pyplot')
+cm = lazy_import('matplotlib.cm')
 
 
 def main():
@@ -20,30 +20,51 @@ def main():
 
     logging.basicConfig(level=logging.INFO)
 
-    for filename in multi_glob(args.filename):
-        if filename.upper().endswith('FIT') or filename.upper().endswith('FITS'):
-            import astropy.io.fits as fits
+    # the next images are decoded while an image is shown, one at a time even for cubes
+    for (filename, index), future in prefetch(_read_image, _image_indices(multi_glob(args.filename)), args.prefetch):
+        image, white_level = future.result()
+        if index is None:
+            logging.error(f"{filename} contains no images")
+            continue
 
-            with fits.open(filename) as hdu_list:
-                images = [fits_to_layers(hdu) for hdu in hdu_list if hdu]
-                if not images:
-                    logging.error(f"{filename} contains no images")
+        _plot_file(filename, image, args.scale, white_level)
 
-                for image in images:
-                    _plot_file(filename, image, args.scale, None)
 
-        else:  # assume raw image
-            import rawpy
+def _image_indices(filenames):
+    """Yield filename and index of each image of fits files, see `fits_image_indices`, and of raw files."""
+    for filename in filenames:
+        if _is_fits(filename):
+            yield from fits_image_indices([filename])
+        else:
+            yield filename, 0
 
-            for filename in multi_glob(args.filename):
-                with rawpy.imread(filename) as raw:
-                    _plot_file(filename, rawpy_to_rgb(raw), args.scale, raw.white_level)
+
+def _read_image(item):
+    """Return the layers of an image in a fits or raw file and the white level, if known."""
+    filename, index = item
+    if index is None:
+        return None, None
+
+    if _is_fits(filename):
+        with open_fits(filename) as hdu_list:
+            return np.asarray(fits_images(hdu_list)[index]), None
+
+    else:  # assume raw image
+        from bayer import raw_cache
+
+        with raw_cache.imread(filename) as raw:
+            return rawpy_to_rgb(raw), raw.white_level
+
+
+def _is_fits(filename):
+    return filename.upper().endswith('FIT') or filename.upper().endswith('FITS')
 
 
 def _create_argument_parser():
     parser = ArgumentParser(description='Display fits or raw color or gray level images')
     parser.add_argument('filename', nargs='+', help='one or more files containing images')
     parser.add_argument('--scale', default=False, action='store_true', help='scale image')
+    add_prefetch_argument(parser)
     return parser
 
 
@@ -71,7 +92,7 @@ def _plot_file(filename, image, scale, white_level=None):
     ax = fig.add_subplot(1, 1, 1)
     ax.get_xaxis().set_visible(False)
     ax.get_yaxis().set_visible(False)
-    ax.imshow(image, cmap=matplotlib.cm.gray)
+    ax.imshow(image, cmap=cm.gray)
 
     plt.show()
     plt.close(fig)
@@ -6,50 +6,85 @@ import logging
 import os.path
 import warnings
 from argparse import ArgumentParser
+from itertools import groupby
 
-import matplotlib.pyplot as plt
-import numpy as np
-
+from bayer import profiling
+from bayer.background import add_background_argument
+from bayer.precision import add_precision_argument, apply_precision_argument
 from bayer.extraction import FastExtraction
 from bayer.extraction import find_slit_in_images
-from bayer.to_rgb import rawpy_to_rgb, fits_to_layers
-from bayer.utils import multi_glob
+from bayer.to_rgb import rawpy_to_rgb, fits_image_indices, fits_images, open_fits
+from bayer.utils import add_prefetch_argument, lazy_import, multi_glob, prefetch
 
+np = lazy_import('numpy')
+plt = lazy_import('matplotlib.pyplot')
 
-def main_raw():
-    import rawpy
 
+def main_raw():
     parser = _create_argument_parser('one or more raw file containing bayer matrices')
 
     args = parser.parse_args()
+    apply_precision_argument(args)
 
     logging.basicConfig(level=logging.INFO)
 
-    for filename in multi_glob(args.filename):
-        with rawpy.imread(filename) as raw:
-            extractor = FastExtraction(image_layers=rawpy_to_rgb(raw), sigma=args.sigma)
-            _plot_file(filename, extractor, raw.white_level, args.store)
+    with profiling.profiled(args.profile_json, 'bayer_display_spectrum'):
+        # the next files are decoded while a plot is shown
+        for filename, future in prefetch(_read_raw, multi_glob(args.filename), args.prefetch):
+            with profiling.record(filename):
+                profiling.read(filename)
+                with profiling.stage('_read_raw'):
+                    layers, white_level = future.result()
+                extractor = FastExtraction(image_layers=layers, sigma=args.sigma,
+                                           rotation_order=args.rotation_order, roi_margin=args.roi_margin,
+                                           background=args.background)
+                _plot_file(filename, extractor, white_level, args.store)
 
 
 def main_fits():
-    from astropy.io import fits
-
     parser = _create_argument_parser('one or more fits files containing images')
 
     args = parser.parse_args()
+    apply_precision_argument(args)
 
     logging.basicConfig(level=logging.INFO)
 
-    for filename in multi_glob(args.filename):
-        with fits.open(filename) as hdu_list:
-            images = [fits_to_layers(hdu) for hdu in hdu_list if hdu]
-            if not images:
-                logging.error(f"{filename} contains no images")
+    with profiling.profiled(args.profile_json, 'fits_display_spectrum'):
+        # the next images are decoded while a plot is shown, one at a time even for cubes
+        images = prefetch(_read_fits, fits_image_indices(multi_glob(args.filename)), args.prefetch)
+        for filename, file_images in groupby(images, key=lambda image: image[0][0]):
+            with profiling.record(filename):
+                profiling.read(filename)
+                for (__, index), future in file_images:
+                    with profiling.stage('_read_fits'):
+                        layers, white_level = future.result()
+                    if index is None:
+                        logging.error(f"{filename} contains no images")
+                        continue
+
+                    extractor = FastExtraction(image_layers=layers, sigma=args.sigma,
+                                               rotation_order=args.rotation_order, roi_margin=args.roi_margin,
+                                               background=args.background)
+                    _plot_file(filename, extractor, white_level, args.store)
+
+
+def _read_raw(filename):
+    """Return the RGB layers and the white level of a raw file."""
+    from bayer import raw_cache
+
+    with raw_cache.imread(filename) as raw:
+        return rawpy_to_rgb(raw), raw.white_level
+
+
+def _read_fits(item):
+    """Return the layers and the white level of an image of a fits file, see `fits_image_indices`."""
+    filename, index = item
+    if index is None:
+        return None, None
 
-            for image in images:
-                extractor = FastExtraction(image_layers=image, sigma=args.sigma)
-                # TODO 2**BITPIX
-                _plot_file(filename, extractor, 2 ** 16, args.store)
+    with open_fits(filename) as hdu_list:
+        image = fits_images(hdu_list)[index]
+        return np.asarray(image), image.white_level
 
 
 def _create_argument_parser(filename_help):
@@ -58,9 +93,18 @@ def _create_argument_parser(filename_help):
     parser.add_argument('--sigma', '-s', default=3.0, type=float, help='sigma used for clipping')
     parser.add_argument('--clipping', default=10.0, type=float, help='clip background at mean + clipping * stddev')
     parser.add_argument('--store', metavar='output.png', help='Store plot as file.')
+    parser.add_argument('--rotation-order', default=3, type=int, choices=range(6),
+                        help='spline interpolation order used for de-rotation, default=%(default)s')
+    parser.add_argument('--roi-margin', metavar='PIXELS', type=int,
+                        help='only de-rotate the bounding box of the spectrum plus this margin')
+    profiling.add_profile_argument(parser)
+    add_background_argument(parser)
+    add_precision_argument(parser)
+    add_prefetch_argument(parser)
     return parser
 
 
+@profiling.timed
 def _plot_file(filename, extractor, white_level, store):
     rgb = extractor.de_rotated_layers
 
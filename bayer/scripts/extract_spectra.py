@@ -0,0 +1,209 @@
+"""\
+Extract spectra from fits or raw images without displaying them.
+
+All spectra, slit bounds, de-rotation angles and background statistics of a run
+are written into a single fits binary table or numpy .npz file.
+"""
+
+import logging
+import os.path
+import warnings
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from bayer import profiling
+from bayer.background import add_background_argument
+from bayer.precision import add_precision_argument, apply_precision_argument
+from bayer.extraction import FastExtraction, find_slit_in_images
+from bayer.to_rgb import fits_images, open_fits, rawpy_to_rgb
+from bayer.utils import lazy_import, multi_glob
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = _create_argument_parser()
+    args = parser.parse_args()
+    apply_precision_argument(args)
+
+    logging.basicConfig(level=logging.INFO)
+
+    filenames = multi_glob(args.filename)
+    if not filenames:
+        raise SystemExit(f'no files for any pattern in {args.filename}')
+
+    if args.chunk_rows and args.background == 'exact':
+        parser.error('--chunk-rows needs --background subsample or histogram')
+
+    extract = partial(_extract_file, profile=bool(args.profile_json), sigma=args.sigma, clipping=args.clipping,
+                      rotation_order=args.rotation_order, roi_margin=args.roi_margin, background=args.background,
+                      chunk_rows=args.chunk_rows)
+
+    with profiling.profiled(args.profile_json, 'fits_extract_spectra'):
+        if args.jobs > 1:
+            with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+                results = list(executor.map(extract, filenames))
+        else:
+            results = [extract(filename) for filename in filenames]
+
+        records = []
+        for file_records, profile_records in results:
+            records += file_records
+            profiling.add(profile_records)
+        if not records:
+            raise SystemExit('no spectra found')
+
+        _write_records(records, args.output, args.overwrite)
+    logger.info(f'wrote {len(records)} spectra to {args.output}')
+
+
+def _create_argument_parser():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('filename', nargs='+', help='one or more fits or raw files containing images')
+    parser.add_argument('--output', '-o', default='spectra.fits',
+                        help='a .fits file containing a binary table or a .npz file, default=%(default)s')
+    parser.add_argument('--overwrite', default=False, action='store_true', help='Allow overwriting output')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of files processed in parallel, default=%(default)s')
+    parser.add_argument('--sigma', '-s', default=3.0, type=float, help='sigma used for clipping')
+    parser.add_argument('--clipping', '-c', default=10.0, type=float,
+                        help='clip background at mean + clipping * stddev')
+    parser.add_argument('--rotation-order', default=3, type=int, choices=range(6),
+                        help='spline interpolation order used for de-rotation, default=%(default)s')
+    parser.add_argument('--roi-margin', metavar='PIXELS', type=int,
+                        help='only de-rotate the bounding box of the spectrum plus this margin')
+    parser.add_argument('--chunk-rows', metavar='ROWS', type=int,
+                        help='read fits images larger than memory in bands of this many rows, '
+                             'only the bounding box of the spectrum is de-rotated')
+    profiling.add_profile_argument(parser)
+    add_background_argument(parser)
+    add_precision_argument(parser)
+    return parser
+
+
+def _extract_file(filename, profile=False, **kwargs):
+    """\
+    Return the records of all images in the file and the profiling records.
+
+    The profiling records are collected here, since this may run in another process.
+    """
+    if not profile:
+        return _extract_records(filename, **kwargs), []
+
+    with profiling.collect() as profile_records:
+        with profiling.record(filename):
+            records = _extract_records(filename, **kwargs)
+    return records, profile_records
+
+
+def _extract_records(filename, **kwargs):
+    """Return a record for each image in the file."""
+    records = []
+    for image_index, layers, white_level in _read_images(filename):
+        records.append(dict(filename=filename, image=image_index, white_level=white_level,
+                            **extract_spectrum(layers, **kwargs)))
+
+    if not records:
+        logger.error(f'{filename} contains no images')
+    return records
+
+
+def extract_spectrum(layers, sigma=3.0, clipping=10.0, rotation_order=3, roi_margin=None, background='exact',
+                     chunk_rows=None):
+    """\
+    Return de-rotation angle, slit bounds, background statistics and spectra of image layers.
+
+    The spectra are the maxima of each de-rotated column within the slit, one per layer.
+    """
+    extractor = FastExtraction(image_layers=layers, sigma=sigma, clipping=clipping, rotation_order=rotation_order,
+                               roi_margin=roi_margin, background=background, chunk_rows=chunk_rows)
+    rgb = extractor.de_rotated_layers
+    miny, maxy = find_slit_in_images(rgb, extractor.background_mean)
+
+    # In some columns all values maybe nan, this can be ignored
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        spectra = np.nanmax(rgb[:, miny:maxy, :], axis=1)
+
+    return dict(
+        angle_deg=np.mean(extractor.de_rotation_angles_deg),
+        slit_min=miny,
+        slit_max=maxy,
+        background_mean=extractor.background_mean,
+        background_median=extractor.background_median,
+        background_stddev=extractor.background_stddev,
+        spectra=spectra,
+    )
+
+
+def _read_images(filename):
+    """Yield index, layers and white level of each image in a fits or raw file."""
+    profiling.read(filename)
+    if filename.upper().endswith('FIT') or filename.upper().endswith('FITS'):
+        with open_fits(filename) as hdu_list:
+            # each plane of a cube and each extension is an image, decoded one at a time or in bands
+            for index, layers in enumerate(fits_images(hdu_list)):
+                yield index, layers, layers.white_level
+    else:  # assume raw image
+        from bayer import raw_cache
+
+        with raw_cache.imread(filename) as raw:
+            yield 0, rawpy_to_rgb(raw), raw.white_level
+
+
+def _records_to_arrays(records):
+    """Pad the per layer values of all records with nan to common shapes."""
+    num_layers = max(len(r['spectra']) for r in records)
+    width = max(r['spectra'].shape[1] for r in records)
+
+    arrays = {}
+    for name in 'filename', 'image', 'white_level', 'angle_deg', 'slit_min', 'slit_max':
+        arrays[name] = np.array([r[name] for r in records])
+
+    for name in 'background_mean', 'background_median', 'background_stddev':
+        arrays[name] = np.full((len(records), num_layers), np.nan)
+        for row, record in zip(arrays[name], records):
+            row[:len(record[name])] = record[name]
+
+    arrays['spectra'] = np.full((len(records), num_layers, width), np.nan, dtype=np.float32)
+    for spectra, record in zip(arrays['spectra'], records):
+        layers, columns = record['spectra'].shape
+        spectra[:layers, :columns] = record['spectra']
+
+    return arrays
+
+
+@profiling.timed
+def _write_records(records, output_filename, overwrite):
+    if os.path.exists(output_filename) and not overwrite:
+        raise SystemExit(f'{output_filename} already exists')
+
+    arrays = _records_to_arrays(records)
+
+    if output_filename.lower().endswith('.npz'):
+        np.savez_compressed(output_filename, **arrays)
+        return
+
+    from astropy.io import fits
+
+    __, num_layers, width = arrays['spectra'].shape
+    columns = [
+        fits.Column(name='FILENAME', format=f'{max(len(fn) for fn in arrays["filename"])}A',
+                    array=arrays['filename']),
+        fits.Column(name='IMAGE', format='J', array=arrays['image']),
+        fits.Column(name='WHITE_LEVEL', format='D', array=arrays['white_level']),
+        fits.Column(name='ANGLE_DEG', format='D', unit='deg', array=arrays['angle_deg']),
+        fits.Column(name='SLIT_MIN', format='J', array=arrays['slit_min']),
+        fits.Column(name='SLIT_MAX', format='J', array=arrays['slit_max']),
+    ]
+    for name in 'background_mean', 'background_median', 'background_stddev':
+        columns.append(fits.Column(name=name.upper(), format=f'{num_layers}D', array=arrays[name]))
+    columns.append(fits.Column(name='SPECTRA', format=f'{num_layers * width}E', dim=f'({width},{num_layers})',
+                               array=arrays['spectra']))
+
+    table = fits.BinTableHDU.from_columns(columns, name='SPECTRA')
+    table.header.add_comment('spectra are the maxima of each de-rotated column within the slit, nan padded')
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(output_filename, overwrite=overwrite)
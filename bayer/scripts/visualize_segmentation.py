@@ -2,49 +2,60 @@ import logging
 import os.path
 from argparse import ArgumentParser
 
-import matplotlib.cm
-import numpy as np
-from matplotlib import pyplot as plt
-
+from bayer.background import add_background_argument
 from bayer.extraction import FastExtraction, find_slit_in_images
-from bayer.to_rgb import rawpy_to_rgb
-from bayer.utils import multi_glob
+from bayer.to_rgb import fits_image_indices, fits_images, open_fits, rawpy_to_rgb
+from bayer.utils import add_prefetch_argument, lazy_import, multi_glob, prefetch
 
+np = lazy_import('numpy')
+plt = lazy_import('matplotlib.pyplot')
+cm = lazy_import('matplotlib.cm')
 
-def main_raw():
-    import rawpy
 
+def main_raw():
     logging.basicConfig(level=logging.INFO)
 
     parser = _create_argument_parser('one or more raw files containing bayer matrices')
     args = parser.parse_args()
 
-    for filename in multi_glob(args.filename):
-        if not os.path.exists(filename):
-            continue
-
-        with rawpy.imread(filename) as raw:
-            layers = rawpy_to_rgb(raw)
-
-        fast = FastExtraction(image_layers=layers, sigma=args.sigma, clipping=args.clipping)
+    filenames = [filename for filename in multi_glob(args.filename) if os.path.exists(filename)]
+    # the next files are decoded while a plot is shown
+    for filename, future in prefetch(_read_raw, filenames, args.prefetch):
+        fast = FastExtraction(image_layers=future.result(), sigma=args.sigma, clipping=args.clipping,
+                              background=args.background)
         _plot_file(filename, fast)
 
 
 def main_fits():
-    from astropy.io import fits
-
     parser = _create_argument_parser('one or more fits files containing images')
     args = parser.parse_args()
 
-    for filename in multi_glob(args.filename):
-        with fits.open(filename) as hdu_list:
-            images = [hdu.data for hdu in hdu_list if hdu.header.get("NAXIS", 0) == 2]
-            if not images:
-                logging.error(f"{filename} contains no images")
+    # the next images are decoded while a plot is shown, one at a time even for cubes
+    images = fits_image_indices(multi_glob(args.filename), mosaic=True)
+    for (filename, index), future in prefetch(_read_fits, images, args.prefetch):
+        image = future.result()
+        if index is None:
+            logging.error(f"{filename} contains no images")
+            continue
+
+        extractor = FastExtraction(image_layers=image, sigma=args.sigma, background=args.background)
+        _plot_file(filename, extractor)
+
+
+def _read_raw(filename):
+    from bayer import raw_cache
+
+    with raw_cache.imread(filename) as raw:
+        return rawpy_to_rgb(raw)
+
+
+def _read_fits(item):
+    filename, index = item
+    if index is None:
+        return None
 
-            for image in images:
-                extractor = FastExtraction(image_layers=[image], sigma=args.sigma)
-                _plot_file(filename, extractor)
+    with open_fits(filename) as hdu_list:
+        return np.asarray(fits_images(hdu_list, mosaic=True)[index])
 
 
 def _plot_file(filename, fast):
@@ -81,7 +92,7 @@ def _plot_file(filename, fast):
 
         layer = layers[idx_layer]
 
-        layer_axis.imshow(layer, cmap=matplotlib.cm.gray)
+        layer_axis.imshow(layer, cmap=cm.gray)
         layer_axis.contour(np.arange(column_count), np.arange(row_count), layer,
                            levels=contour_levels[idx_layer], colors=contour_colors)
 
@@ -95,4 +106,6 @@ def _create_argument_parser(filename_help):
     parser.add_argument('filename', nargs='+', help=filename_help)
     parser.add_argument('--sigma', '-s', default=3.0, type=float, help='sigma used for clipping')
     parser.add_argument('--clipping', '-c', default=10.0, type=float, help='clip background at mean + clipping * stddev')
+    add_background_argument(parser)
+    add_prefetch_argument(parser)
     return parser
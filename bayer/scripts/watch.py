@@ -0,0 +1,248 @@
+"""\
+Watch folders for new raw or fits frames, e.g. written by bayer_capture_spectra.sh, and extract their spectra.
+
+Each new frame is calibrated with in-memory masters, its spectra are extracted and the results
+are appended as a json line to a running log. Modules and masters are loaded once per session.
+"""
+
+import json
+import logging
+import os.path
+import time
+from argparse import ArgumentParser
+
+from bayer import profiling
+from bayer.background import add_background_argument
+from bayer.precision import add_precision_argument, apply_precision_argument
+from bayer.library import MasterLibrary
+from bayer.scripts.darkflat import find_masters, load_master
+from bayer.scripts.extract_spectra import extract_spectrum
+from bayer.to_rgb import LazyLayers, bayer_pattern_name, bayer_to_layers, combine_layers_by_color, debayer, \
+    fits_images, open_fits, scale_to_float
+from bayer.utils import lazy_import, multi_glob
+
+np = lazy_import('numpy')
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = _create_argument_parser()
+    args = parser.parse_args()
+    apply_precision_argument(args)
+
+    logging.basicConfig(level=logging.INFO)
+
+    masters = _Masters(args.master_dark, args.master_flat, MasterLibrary(args.library) if args.library else None)
+    extraction_arguments = dict(sigma=args.sigma, clipping=args.clipping, rotation_order=args.rotation_order,
+                                roi_margin=args.roi_margin, background=args.background)
+
+    def process(filename):
+        _process_frame(filename, masters, extraction_arguments, args.log)
+
+    with profiling.profiled(args.profile_json, 'bayer_watch'):
+        if args.once:
+            for filename in sorted(multi_glob(args.pattern), key=os.path.getmtime):
+                process(filename)
+            return
+
+        poller = FolderPoller(args.pattern, args.settle, skip_existing=not args.existing)
+        logger.info(f'watching {args.pattern}, stop with Ctrl-C')
+        try:
+            while True:
+                filenames = poller.poll()
+                if args.max_backlog and len(filenames) > args.max_backlog:
+                    logger.warning(f'skip {len(filenames) - args.max_backlog} frames to catch up')
+                    filenames = filenames[-args.max_backlog:]
+                for filename in filenames:
+                    process(filename)
+                time.sleep(args.interval)
+        except KeyboardInterrupt:
+            logger.info('stopped watching')
+
+
+def _create_argument_parser():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('pattern', nargs='+', help="one or more file patterns to watch, e.g. '*.cr2' '*.fits'")
+    parser.add_argument('--log', '-o', default='spectra.jsonl',
+                        help='append a json line per frame to this file, default=%(default)s')
+    parser.add_argument('--master-dark', help='subtract this master dark from each frame')
+    parser.add_argument('--master-flat', help='divide each frame by this master flat')
+    parser.add_argument('--library', metavar='FOLDER',
+                        help='take masters matching each fits frame from this library if not given explicitly')
+    parser.add_argument('--interval', default=0.5, type=float,
+                        help='seconds between two looks into the folders, default=%(default)s')
+    parser.add_argument('--settle', default=1.0, type=float,
+                        help='seconds size and modification time of a new file must not change before it is '
+                             'processed, default=%(default)s')
+    parser.add_argument('--max-backlog', metavar='FRAMES', type=int,
+                        help='if more new frames are waiting, only process the newest ones to bound the latency')
+    parser.add_argument('--existing', default=False, action='store_true',
+                        help='also process the files existing when watching starts')
+    parser.add_argument('--once', default=False, action='store_true',
+                        help='process all existing files and exit instead of watching')
+    parser.add_argument('--sigma', '-s', default=3.0, type=float, help='sigma used for clipping')
+    parser.add_argument('--clipping', '-c', default=10.0, type=float,
+                        help='clip background at mean + clipping * stddev')
+    parser.add_argument('--rotation-order', default=3, type=int, choices=range(6),
+                        help='spline interpolation order used for de-rotation, default=%(default)s')
+    parser.add_argument('--roi-margin', metavar='PIXELS', type=int,
+                        help='only de-rotate the bounding box of the spectrum plus this margin')
+    profiling.add_profile_argument(parser)
+    add_background_argument(parser)
+    add_precision_argument(parser)
+    return parser
+
+
+class FolderPoller:
+    """\
+    Find new files matching glob patterns by polling.
+
+    Polling works on every file system, including network shares and camera mounts without inotify support.
+    A file is new once its size and modification time did not change for `settle` seconds,
+    so files still being written are not picked up.
+    """
+
+    def __init__(self, patterns, settle=1.0, skip_existing=True):
+        self.patterns = patterns
+        self.settle = settle
+        self.done = set(multi_glob(patterns)) if skip_existing else set()
+        # filename -> (size, modification time) and the time it was first seen that way
+        self.pending = {}
+
+    def poll(self):
+        """Return all new files, oldest first."""
+        now = time.monotonic()
+
+        ready = []
+        for filename in multi_glob(self.patterns):
+            if filename in self.done:
+                continue
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                continue
+
+            state = stat.st_size, stat.st_mtime_ns
+            previous = self.pending.get(filename)
+            if previous is None or previous[0] != state:
+                self.pending[filename] = state, now
+            elif now - previous[1] >= self.settle:
+                ready.append((stat.st_mtime_ns, filename))
+
+        ready.sort()
+        for __, filename in ready:
+            self.done.add(filename)
+            del self.pending[filename]
+
+        return [filename for __, filename in ready]
+
+
+class _Masters:
+    """Masters loaded once and shared by all frames."""
+
+    def __init__(self, dark_pattern, flat_pattern, library):
+        self.dark_pattern = dark_pattern
+        self.flat_pattern = flat_pattern
+        self.library = library
+        self.loaded = {}
+
+        # fail early for explicitly given masters
+        self._load(dark_pattern)
+        self._load(flat_pattern)
+
+    def for_frame(self, filename):
+        """Return master dark and master flat of a frame, each may be None."""
+        dark_pattern, flat_pattern = self.dark_pattern, self.flat_pattern
+        if self.library and _is_fits(filename):
+            try:
+                dark_pattern, flat_pattern = find_masters(filename, dark_pattern, flat_pattern, self.library)
+            except SystemExit as e:
+                logger.warning(f'{e}, {filename} is not dark-corrected')
+
+        return self._load(dark_pattern), self._load(flat_pattern)
+
+    def _load(self, pattern):
+        if not pattern:
+            return None
+        if pattern not in self.loaded:
+            logger.info(f'load master {pattern}')
+            self.loaded[pattern] = load_master(pattern)
+        return self.loaded[pattern]
+
+
+def _process_frame(filename, masters, extraction_arguments, log_filename):
+    """Extract all spectra of a frame and append them to the log, errors are logged and do not stop watching."""
+    start = time.time()
+    try:
+        with profiling.record(filename):
+            profiling.read(filename)
+            master_dark, master_flat = masters.for_frame(filename)
+            records = []
+            for image_index, layers, white_level in _read_calibrated_images(filename, master_dark, master_flat):
+                records.append(dict(filename=filename, image=image_index, white_level=white_level,
+                                    **extract_spectrum(layers, **extraction_arguments)))
+    except (Exception, SystemExit):
+        # darkflat reports missing or broken masters using SystemExit
+        logger.exception(f'cannot process {filename}')
+        return
+
+    if not records:
+        logger.error(f'{filename} contains no images')
+
+    with open(log_filename, 'a') as f:
+        for record in records:
+            record['seconds'] = time.time() - start
+            record['latency'] = time.time() - os.path.getmtime(filename)
+            f.write(json.dumps(_to_json(record)) + '\n')
+
+    for record in records:
+        logger.info(f'{filename}: angle {record["angle_deg"]:.2f} deg, slit {record["slit_min"]}-'
+                    f'{record["slit_max"]}, {record["latency"]:.1f}s after writing')
+
+
+def _is_fits(filename):
+    return filename.upper().endswith('FIT') or filename.upper().endswith('FITS')
+
+
+def _read_calibrated_images(filename, master_dark, master_flat):
+    """Yield index, calibrated layers and white level of each image in a fits or raw file."""
+    if _is_fits(filename):
+        with open_fits(filename) as hdu_list:
+            for index, layers in enumerate(fits_images(hdu_list)):
+                data = scale_to_float(layers.raw, layers.bscale, layers.bzero, layers.dtype)
+                data = _calibrate(data, master_dark, master_flat)
+                if layers.bayer_pattern:
+                    data = np.asarray(LazyLayers(data, bayer_pattern=layers.bayer_pattern))
+                yield index, data, layers.white_level
+    else:  # assume raw image
+        from bayer import raw_cache
+
+        with raw_cache.imread(filename) as raw:
+            data = _calibrate(scale_to_float(raw.raw_image_visible), master_dark, master_flat)
+            pattern = bayer_pattern_name(raw.raw_pattern, raw.color_desc)
+            if pattern:
+                layers = debayer(data, pattern)
+            else:
+                layers = combine_layers_by_color(bayer_to_layers(data, raw.raw_pattern), raw.color_desc, b'RGB',
+                                                 dtype=data.dtype)
+            yield 0, layers, raw.white_level
+
+
+def _calibrate(data, master_dark, master_flat):
+    """Apply the masters in-place, they are calibrated before de-bayering and thus have the raw frame's shape."""
+    if master_dark is not None:
+        np.subtract(data, master_dark, out=data, casting='unsafe')
+    if master_flat is not None:
+        np.true_divide(data, master_flat, out=data, casting='unsafe')
+    return data
+
+
+def _to_json(record):
+    """Replace arrays by lists and nan by None."""
+    result = {}
+    for key, value in record.items():
+        if isinstance(value, np.ndarray) or isinstance(value, np.generic):
+            value = np.where(np.isnan(value), None, value).tolist() if value.dtype.kind == 'f' else value.tolist()
+        result[key] = value
+    return result
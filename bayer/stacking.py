@@ -0,0 +1,221 @@
+from bayer.utils import lazy_import
+
+np = lazy_import('numpy')
+
+
+def sigma_clipped_mean(stack, sigma_lower=3.0, sigma_upper=3.0, max_iters=3):
+    """\
+    Average a stack of frames pixel by pixel after iteratively rejecting outliers.
+
+    Each iteration calculates mean and stddev of the accepted values and accepts all input values within
+    [mean - sigma_lower * stddev, mean + sigma_upper * stddev]. Rejected values may be accepted again in a later
+    iteration. Iterating stops early as soon as no pixel changes its state, since all further iterations would
+    yield the same result.
+
+    The rejection state is kept in a single boolean mask that is updated in-place, one frame at a time.
+    Apart from the mask, only temporaries of the size of a single frame are allocated.
+
+    Parameters
+    ----------
+    stack : array_like of shape (N, R, C)
+        N frames, nan values are ignored
+
+    sigma_lower, sigma_upper : number
+        Rejection bounds in units of stddev
+
+    max_iters : int
+        Maximum number of rejection iterations
+
+    Return
+    ------
+    array_like of shape (R, C) and at least float32 precision
+    """
+
+    stack = np.asarray(stack)
+    assert stack.ndim == 3
+    assert max_iters >= 0
+
+    dtype = np.result_type(stack.dtype, np.float32)
+
+    if np.issubdtype(stack.dtype, np.floating):
+        accepted = ~np.isnan(stack)
+    else:
+        accepted = np.ones(stack.shape, dtype=bool)
+
+    mean, stddev = _masked_mean_and_stddev(stack, accepted, dtype)
+
+    lower = np.empty_like(mean)
+    upper = np.empty_like(mean)
+    frame_accepted = np.empty(mean.shape, dtype=bool)
+
+    for __ in range(max_iters):
+        np.subtract(mean, sigma_lower * stddev, out=lower)
+        np.add(mean, sigma_upper * stddev, out=upper)
+
+        changed = False
+        for frame, frame_mask in zip(stack, accepted):
+            np.less_equal(lower, frame, out=frame_accepted)
+            np.logical_and(frame_accepted, frame <= upper, out=frame_accepted)
+            if not changed and not np.array_equal(frame_accepted, frame_mask):
+                changed = True
+            frame_mask[...] = frame_accepted
+
+        if not changed:
+            break
+
+        mean, stddev = _masked_mean_and_stddev(stack, accepted, dtype)
+
+    return mean
+
+
+def _masked_mean_and_stddev(stack, accepted, dtype):
+    """Same as nanmean and nanstd along the first axis, with the accepted mask replacing nan checks."""
+
+    __, rows, columns = stack.shape
+
+    count = np.zeros((rows, columns), dtype=np.intp)
+    mean = np.zeros((rows, columns), dtype=dtype)
+    for frame, frame_mask in zip(stack, accepted):
+        np.add(mean, frame, out=mean, where=frame_mask, casting='unsafe')
+        count += frame_mask
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.true_divide(mean, count, out=mean, casting='unsafe')
+
+        variance = np.zeros_like(mean)
+        deviation = np.empty_like(mean)
+        for frame, frame_mask in zip(stack, accepted):
+            np.subtract(frame, mean, out=deviation, casting='unsafe')
+            np.multiply(deviation, deviation, out=deviation)
+            np.add(variance, deviation, out=variance, where=frame_mask)
+
+        np.true_divide(variance, count, out=variance, casting='unsafe')
+
+    return mean, np.sqrt(variance, out=variance)
+
+
+# header keywords storing the parameters of a RunningMean
+_RUNNING_MEAN_KEYWORDS = {'SIGMALOW': 'sigma_lower', 'SIGMAUPP': 'sigma_upper', 'MINFRAME': 'min_frames'}
+
+
+class RunningMean:
+    """\
+    Mean and variance of frames added one at a time, using Welford's algorithm.
+
+    The state, i.e. count, mean and sum of squared deviations per pixel, can be saved and loaded again,
+    so frames can be added whenever they arrive instead of stacking all of them again.
+    Nan values are ignored.
+
+    With sigma_lower or sigma_upper, values outside [mean - sigma_lower * stddev, mean + sigma_upper * stddev]
+    of the frames added so far are rejected. This only approximates `sigma_clipped_mean`:
+    the first `min_frames` values of each pixel are never rejected and a rejected value is never accepted again.
+    """
+
+    def __init__(self, shape, sigma_lower=None, sigma_upper=None, min_frames=3):
+        self.sigma_lower = sigma_lower
+        self.sigma_upper = sigma_upper
+        self.min_frames = min_frames
+
+        self.count = np.zeros(shape, dtype=np.int32)
+        self.mean_ = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.rejected = np.zeros(shape, dtype=np.int32)
+        # number of frames added
+        self.frames = 0
+        # names of the added frames, if given
+        self.sources = []
+
+    @property
+    def clipping(self):
+        return self.sigma_lower is not None or self.sigma_upper is not None
+
+    def add(self, frame, source=None):
+        """Add a frame of the accumulator's shape, source is an optional name like its filename."""
+        frame = np.asarray(frame)
+        assert frame.shape == self.count.shape, f'frame shape {frame.shape} differs from {self.count.shape}'
+
+        accepted = np.isfinite(frame) if np.issubdtype(frame.dtype, np.floating) else np.ones(frame.shape, bool)
+        delta = np.subtract(frame, self.mean_, dtype=np.float64)
+
+        if self.clipping:
+            stddev = self.stddev
+            reject = np.zeros(frame.shape, dtype=bool)
+            with np.errstate(invalid='ignore'):
+                if self.sigma_lower is not None:
+                    reject |= delta < -self.sigma_lower * stddev
+                if self.sigma_upper is not None:
+                    reject |= delta > self.sigma_upper * stddev
+            reject &= accepted & (self.count >= self.min_frames)
+            self.rejected += reject
+            accepted &= ~reject
+
+        np.add(self.count, 1, out=self.count, where=accepted)
+        np.add(self.mean_, delta / np.maximum(self.count, 1), out=self.mean_, where=accepted)
+        # the second factor uses the updated mean
+        np.add(self.m2, delta * np.subtract(frame, self.mean_, dtype=np.float64), out=self.m2, where=accepted)
+        self.frames += 1
+        if source is not None:
+            self.sources.append(source)
+
+    @property
+    def mean(self):
+        """Mean of the accepted values, nan for pixels without any."""
+        return np.where(self.count > 0, self.mean_, np.nan)
+
+    @property
+    def variance(self):
+        """Population variance of the accepted values, nan for pixels without any."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 0, self.m2 / self.count, np.nan)
+
+    @property
+    def stddev(self):
+        return np.sqrt(self.variance)
+
+    def save(self, filename, header=None, overwrite=True):
+        """\
+        Store the state as a fits file with the image extensions MEAN, M2, COUNT, REJECTED and a table SOURCES.
+
+        The primary header holds the state keywords, `header`, e.g. of the first frame, is kept apart in an
+        extension HEADER.
+        """
+        from astropy.io import fits
+
+        primary = fits.PrimaryHDU()
+        primary.header['NFRAMES'] = (self.frames, 'number of frames added')
+        for key, value in _RUNNING_MEAN_KEYWORDS.items():
+            if getattr(self, value) is not None:
+                primary.header[key] = getattr(self, value)
+        hdus = [primary] + [fits.ImageHDU(data, name=name) for name, data in
+                            (('MEAN', self.mean_), ('M2', self.m2), ('COUNT', self.count), ('REJECTED', self.rejected))]
+        hdus.append(fits.BinTableHDU.from_columns(
+            [fits.Column(name='SOURCE', format=f'{max((len(s) for s in self.sources), default=1)}A',
+                         array=self.sources)], name='SOURCES'))
+        hdus.append(fits.ImageHDU(header=header, name='HEADER'))
+        fits.HDUList(hdus).writeto(filename, overwrite=overwrite)
+
+    @classmethod
+    def load(cls, filename):
+        """Return the state stored by `save` and the header given to it, without any state keywords."""
+        from astropy.io import fits
+
+        with fits.open(filename) as hdu_list:
+            header = hdu_list[0].header
+            parameters = {value: header[key] for key, value in _RUNNING_MEAN_KEYWORDS.items() if key in header}
+            result = cls(hdu_list['MEAN'].shape, **parameters)
+            result.frames = header.get('NFRAMES', 0)
+            result.mean_[...] = hdu_list['MEAN'].data
+            result.m2[...] = hdu_list['M2'].data
+            result.count[...] = hdu_list['COUNT'].data
+            result.rejected[...] = hdu_list['REJECTED'].data
+            result.sources = [str(s) for s in hdu_list['SOURCES'].data['SOURCE']]
+
+            if 'HEADER' in hdu_list:
+                header = hdu_list['HEADER'].header.copy()
+                header.remove('EXTNAME', ignore_missing=True)
+            else:
+                # states saved before the extension HEADER existed kept the header in the primary one
+                header = header.copy()
+                for key in ['NFRAMES', *_RUNNING_MEAN_KEYWORDS]:
+                    header.remove(key, ignore_missing=True)
+            return result, header
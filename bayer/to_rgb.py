@@ -1,53 +1,397 @@
 import logging
 
-import numpy as np
+from bayer.precision import working_dtype
+from bayer.utils import lazy_import
+
+np = lazy_import('numpy')
 
 logger = logging.getLogger(__name__)
 
+# 2x2 bayer patterns handled by `debayer`, colors of the pixels (0, 0), (0, 1), (1, 0) and (1, 1)
+BAYER_PATTERNS = 'RGGB', 'BGGR', 'GRBG', 'GBRG'
+
 
-def fits_to_layers(fits):
+def open_fits(filename, **kwargs):
+    """\
+    Open a fits file memory-mapped and without applying BSCALE and BZERO.
+
+    Use `fits_to_layers` or `fits_scaling` to get physical values from the raw data.
+    """
+    from astropy.io import fits
+
+    return fits.open(filename, memmap=True, do_not_scale_image_data=True, **kwargs)
+
+
+def fits_to_layers(fits, dtype=None, lazy=False):
     """\
     Having a fits image, convert it into a RGB three layer image or  a single layer gray-scale-image.
 
+    Parameters
+    ----------
+    fits : astropy.io.fits.ImageHDU
+        Preferably opened with `open_fits`, so the data stays memory-mapped and scaling is fused
+        with the conversion into dtype.
+
+    dtype : numpy.dtype
+        Floating point type of the layers, by default the working precision, see `bayer.precision`
+
+    lazy : bool
+        Return `LazyLayers` converting only when numpy asks for the data
+
     :returns None if something fails
     """
     hdr = fits.header
 
     naxis = hdr.get("NAXIS", 0)
-    data = np.asarray(fits.data, dtype=np.float32)
-    if naxis == 3:
-        return data
-
-    if naxis != 2:
+    if naxis not in (2, 3) or not fits.is_image:
         return None
 
-    # only RGB images have a bayer pattern (?)
-    bayer_pattern = hdr.get('BAYERPAT')
-    if not bayer_pattern:
-        return [data]
+    bscale, bzero = fits_scaling(fits)
+    data = fits.data
+    if naxis == 2:
+        # only RGB images have a bayer pattern (?)
+        bayer_pattern = hdr.get('BAYERPAT') or None
+        data = data[np.newaxis]
+    else:
+        bayer_pattern = None
+
+    layers = LazyLayers(data, bscale, bzero, bayer_pattern, dtype)
+    return layers if lazy else np.asarray(layers)
+
+
+def fits_images(hdu_list, dtype=None, mosaic=False):
+    """\
+    List all images of a fits file as `LazyLayers`, nothing is decoded yet.
+
+    Each 2d image hdu, e.g. of a multi-extension file, is an image.
+    A 3d cube is an image per plane, except cubes of exactly three planes without BAYERPAT unless mosaic
+    is given. These are the layers of a single RGB image, e.g. written by `fits_debayer`.
+
+    Parameters
+    ----------
+    hdu_list : astropy.io.fits.HDUList
+        Preferably opened with `open_fits`, so the data stays memory-mapped
+
+    dtype : numpy.dtype
+        Floating point type of the layers, by default the working precision, see `bayer.precision`
+
+    mosaic : bool
+        Keep bayer matrices as single layers instead of de-bayering them and split every cube into its planes,
+        e.g. to stack darks
+
+    Return
+    ------
+    list of LazyLayers
+    """
+    images = []
+    for hdu in hdu_list:
+        naxis = hdu.header.get('NAXIS', 0)
+        if naxis not in (2, 3) or not hdu.is_image:
+            continue
+
+        bscale, bzero = fits_scaling(hdu)
+        bayer_pattern = None if mosaic else hdu.header.get('BAYERPAT') or None
+        if naxis == 2:
+            images.append(LazyLayers(hdu.data[np.newaxis], bscale, bzero, bayer_pattern, dtype))
+        elif hdu.header.get('NAXIS3') == 3 and not mosaic and not hdu.header.get('BAYERPAT'):
+            images.append(LazyLayers(hdu.data, bscale, bzero, None, dtype))
+        else:
+            # slicing the memory-mapped cube does not read it
+            data = hdu.data
+            images.extend(LazyLayers(data[plane:plane + 1], bscale, bzero, bayer_pattern, dtype)
+                          for plane in range(len(data)))
+
+    return images
+
+
+def fits_image_indices(filenames, mosaic=False):
+    """\
+    Yield filename and index of each image of `fits_images` of the fits files, only the headers are read.
+
+    A file without images yields its filename and None. This allows to read and decode one image
+    at a time, e.g. ahead of time using `bayer.utils.prefetch`, instead of all images of a cube at once.
+    """
+    for filename in filenames:
+        with open_fits(filename) as hdu_list:
+            num_images = len(fits_images(hdu_list, mosaic=mosaic))
+        if not num_images:
+            yield filename, None
+        for index in range(num_images):
+            yield filename, index
+
+
+def fits_scaling(hdu):
+    """\
+    Return BSCALE and BZERO still to be applied to `hdu.data`.
+
+    Astropy applies them itself unless the file was opened with `do_not_scale_image_data`.
+    In that case the data still has the integer or floating point type given by BITPIX.
+    """
+    # astropy removes BSCALE and BZERO from the header once it has scaled the data
+    data = hdu.data
+    bscale = hdu.header.get('BSCALE', 1)
+    bzero = hdu.header.get('BZERO', 0)
+    if bscale == 1 and bzero == 0:
+        return 1, 0
+
+    raw_dtype = {8: np.uint8, 16: np.int16, 32: np.int32, 64: np.int64,
+                 -32: np.float32, -64: np.float64}.get(hdu.header.get('BITPIX'))
+    if raw_dtype is None or data is None or data.dtype.newbyteorder('=') != np.dtype(raw_dtype):
+        return 1, 0
+
+    return bscale, bzero
+
+
+def scale_to_float(raw, bscale=1, bzero=0, dtype=None, out=None):
+    """\
+    Calculate `raw * bscale + bzero` in a single allocation of dtype.
+
+    The integer data is converted chunk-wise inside the ufunc loop, there is no
+    float64 intermediate like the one astropy creates when scaling.
+    By default, dtype is the working precision, see `bayer.precision`.
+    """
+    if dtype is None:
+        dtype = working_dtype() if out is None else out.dtype
+    dtype = np.dtype(dtype)
+    if out is None:
+        out = np.empty(np.shape(raw), dtype=dtype)
+
+    if bscale == 1:
+        np.copyto(out, raw, casting='unsafe')
+    else:
+        np.multiply(raw, dtype.type(bscale), out=out, dtype=dtype, casting='unsafe')
+    if bzero != 0:
+        np.add(out, dtype.type(bzero), out=out)
+
+    return out
+
+
+class LazyLayers:
+    """\
+    Image layers backed by raw, usually memory-mapped, fits data.
+
+    Nothing is decoded before numpy asks for the data, e.g. via `np.asarray(layers)`.
+    Then scaling, de-bayering and the conversion to float happen in one go.
+    Use `raw` to access the unscaled data without any conversion.
+    """
+
+    def __init__(self, raw, bscale=1, bzero=0, bayer_pattern=None, dtype=None):
+        """\
+        Parameters
+        ----------
+        raw: array_like of shape (num_layers, rows, columns)
+            unscaled data, a single layer if bayer_pattern is given
+
+        bscale, bzero: number
+            physical values are `raw * bscale + bzero`
+
+        bayer_pattern: str
+            e.g. 'RGGB'
+        """
+        assert np.ndim(raw) == 3
+        assert bayer_pattern is None or len(raw) == 1
+
+        self.raw = raw
+        self.bscale = bscale
+        self.bzero = bzero
+        self.bayer_pattern = bayer_pattern
+        self.dtype = np.dtype(working_dtype() if dtype is None else dtype)
+
+    @property
+    def shape(self):
+        num_layers, rows, columns = np.shape(self.raw)
+        if self.bayer_pattern:
+            return 3, rows // 2, columns // 2
+        return num_layers, rows, columns
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def white_level(self):
+        """\
+        Largest physical value of the raw data type given by BITPIX, BSCALE and BZERO,
+        e.g. 65535 for unsigned 16 bit data. Floating point data is assumed to come from a 16 bit sensor.
+        """
+        if not np.issubdtype(self.raw.dtype, np.integer):
+            return 2 ** 16 - 1
+
+        info = np.iinfo(self.raw.dtype)
+        return max(info.min * self.bscale + self.bzero, info.max * self.bscale + self.bzero)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self.decode()
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def rows(self, start, stop):
+        """The rows start:stop of the layers as `LazyLayers`, e.g. to decode a large image band by band."""
+        if self.bayer_pattern:
+            # a row of de-bayered layers is made of two raw rows
+            raw = self.raw[:, 2 * start:2 * stop]
+        else:
+            raw = self.raw[:, start:stop]
+        return LazyLayers(raw, self.bscale, self.bzero, self.bayer_pattern, self.dtype)
+
+    def decode(self, out=None):
+        """Scale, de-bayer and convert the raw data into out, a new array of the layers' shape and dtype by default."""
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+
+        if self.bayer_pattern:
+            # averaging is linear, so the raw layers can be combined before scaling them in-place
+            if self.bayer_pattern.upper() in BAYER_PATTERNS:
+                debayer(self.raw[0], self.bayer_pattern, out=out)
+            else:
+                # 0123 has been validated w/ a Meade DSI IV on KStars
+                layers = bayer_to_layers(self.raw[0], [[0, 1], [2, 3]])
+                combine_layers_by_color(layers, self.bayer_pattern, b'RGB', out=out)
+            return scale_to_float(out, self.bscale, self.bzero, out=out)
+
+        return scale_to_float(self.raw, self.bscale, self.bzero, out=out)
+
+
+def decode_images(images, jobs=1, out=None):
+    """\
+    Decode `LazyLayers` of the same shape, e.g. returned by `fits_images`, into a single array.
+
+    With jobs > 1 the images are decoded by as many threads. Numpy releases the GIL while scaling and
+    de-bayering, so decoding many frames of a cube or a multi-extension file runs in parallel.
+
+    Return
+    ------
+    out, an array of shape (len(images),) + shape of the images
+    """
+    assert images, 'no images'
+    shape = images[0].shape
+    if any(image.shape != shape for image in images):
+        raise ValueError('images do not share the same shape')
+
+    if out is None:
+        out = np.empty((len(images),) + tuple(shape), dtype=images[0].dtype)
 
-    # 0123 has been validated w/ a Meade DSI IV on KStars
-    layers = bayer_to_layers(data, [[0, 1], [2, 3]])
-    return combine_layers_by_color(layers, bayer_pattern, b'RGB')
+    def decode(index):
+        images[index].decode(out=out[index])
 
+    if jobs > 1 and len(images) > 1:
+        from concurrent.futures import ThreadPoolExecutor
 
-def rawpy_to_rgb(raw):
-    """Extract RGB image from a rawpy bayer image."""
+        with ThreadPoolExecutor(max_workers=jobs) as workers:
+            list(workers.map(decode, range(len(images))))
+    else:
+        for index in range(len(images)):
+            decode(index)
+
+    return out
+
+
+def rawpy_to_rgb(raw, dtype=None):
+    """Extract RGB image from a rawpy bayer image, by default in the working precision."""
 
     assert all((c in raw.color_desc for c in b'RGB')), 'not a RBG raw image'
 
+    if dtype is None:
+        dtype = working_dtype()
+    pattern = bayer_pattern_name(raw.raw_pattern, raw.color_desc)
+    if pattern:
+        return debayer(raw.raw_image_visible, pattern, dtype=dtype)
+
     layers = bayer_to_layers(raw.raw_image_visible, raw.raw_pattern)
-    return combine_layers_by_color(layers, raw.color_desc, b'RGB')
+    return combine_layers_by_color(layers, raw.color_desc, b'RGB', dtype=dtype)
+
+
+def bayer_pattern_name(raw_pattern, color_desc):
+    """\
+    Return the name of a rawpy pattern, e.g. 'RGGB' for raw_pattern=[[0 1],[3 2]] and color_desc='RGBG'.
+
+    None, if the pattern is not one of `BAYER_PATTERNS`.
+    """
+    raw_pattern = np.asarray(raw_pattern)
+    if isinstance(color_desc, str):
+        color_desc = color_desc.encode("UTF-8")
+    if raw_pattern.shape != (2, 2) or raw_pattern.max() >= len(color_desc):
+        return None
 
+    name = ''.join(chr(color_desc[index]) for index in raw_pattern.ravel())
+    return name if name in BAYER_PATTERNS else None
 
-def combine_layers_by_color(layers, layer_color_desc, target_color_desc=b'RGB', method='mean'):
+
+def debayer(bayer, pattern, method='mean', dtype=None, out=None):
+    """\
+    Combine a 2x2 bayer mosaic into RGB layers of half its resolution, or copy a mono image.
+
+    This is the fast path of `bayer_to_layers` followed by `combine_layers_by_color` for the common patterns.
+    Red and blue are converted while copying, the two greens are summed up and halved within `out`.
+    There are no temporary copies of the mosaic. The median of two values is their mean,
+    so 'mean' and 'median' give the same result.
+
+    Parameters
+    ----------
+    bayer : array_like of shape (rows, columns)
+        The raw bayer image, a last odd row or column is ignored
+
+    pattern: str or None
+        One of `BAYER_PATTERNS` or None for a mono image
+
+    method: str
+        'mean' or 'median'
+
+    dtype: numpy.dtype
+        Floating point type of the layers, by default the working precision. Ignored if out is given.
+
+    out: array_like of shape (3, rows // 2, columns // 2) or (1, rows, columns) for mono images
+        Optional output buffer
+
+    Return
+    ------
+    out
+    """
+    assert method in ('mean', 'median'), f'unsupported method {method}'
+
+    bayer = np.asarray(bayer)
+    assert bayer.ndim == 2
+
+    if dtype is None:
+        dtype = working_dtype()
+    if pattern is None:
+        if out is None:
+            out = np.empty((1,) + bayer.shape, dtype=dtype)
+        np.copyto(out[0], bayer, casting='unsafe')
+        return out
+
+    if isinstance(pattern, bytes):
+        pattern = pattern.decode('ascii')
+    pattern = pattern.upper()
+    assert pattern in BAYER_PATTERNS, f'unsupported bayer pattern {pattern}'
+
+    rows, columns = bayer.shape[0] // 2 * 2, bayer.shape[1] // 2 * 2
+    pixels = [bayer[row:rows:2, column:columns:2] for row, column in ((0, 0), (0, 1), (1, 0), (1, 1))]
+    if out is None:
+        out = np.empty((3, rows // 2, columns // 2), dtype=dtype)
+
+    red, green, blue = out
+    np.copyto(red, pixels[pattern.index('R')], casting='unsafe')
+    np.copyto(blue, pixels[pattern.index('B')], casting='unsafe')
+
+    # dtype makes numpy convert integers chunk-wise instead of adding them with overflow
+    first_green, second_green = (pixel for pixel, color in zip(pixels, pattern) if color == 'G')
+    np.add(first_green, second_green, out=green, dtype=green.dtype, casting='unsafe')
+    np.multiply(green, green.dtype.type(0.5), out=green)
+
+    return out
+
+
+def combine_layers_by_color(layers, layer_color_desc, target_color_desc=b'RGB', method='mean', out=None, dtype=None):
     """\
     Fold layers by colors.
 
     Parameters
     ----------
-    layers : array_like of shape (N, R, C)
-        input image layers
+    layers : array_like of shape (N, R, C) or a sequence of N arrays of shape (R, C)
+        input image layers, e.g. the views returned by `bayer_to_layers`
 
     layer_color_desc : array_like of length N
         A single color for each layer, e.g. 'RGBG'
@@ -59,6 +403,14 @@ def combine_layers_by_color(layers, layer_color_desc, target_color_desc=b'RGB',
     method: str
         'mean', 'median' or any others numpy method of signature method(array, axis=...)
         It is used to combine source layers having the same color, e.g. the two green layers in a RGBG image.
+        'mean', and 'median' of up to two layers, are calculated in-place within `out` without temporary copies.
+
+    out: array_like of shape (len(target_color_desc), R, C)
+        Optional output buffer
+
+    dtype: numpy.dtype
+        Type of the output buffer, by default the layers' floating point type or float64 for integer layers.
+        Ignored if out is given.
 
     Return
     ------
@@ -68,19 +420,46 @@ def combine_layers_by_color(layers, layer_color_desc, target_color_desc=b'RGB',
 
     if isinstance(layer_color_desc, str):
         layer_color_desc = layer_color_desc.encode("UTF-8")
+    if isinstance(target_color_desc, str):
+        target_color_desc = target_color_desc.encode("UTF-8")
 
     combiner = getattr(np, method, None)
     assert callable(combiner), f'np.{method} does not exist or is not callable'
 
-    def _combine_layers_of_color(color):
-        layers_of_correct_color = layers[np.nonzero(np.array(list(layer_color_desc)) == color)]
-        return combiner(layers_of_correct_color, axis=0)
+    if out is None:
+        if dtype is None:
+            dtype = np.asarray(layers[0]).dtype
+            if not np.issubdtype(dtype, np.floating):
+                dtype = np.float64
+        out = np.empty((len(target_color_desc),) + np.shape(layers[0]), dtype=dtype)
+
+    layers_by_color = {}
+    for layer, color in zip(layers, layer_color_desc):
+        layers_by_color.setdefault(color, []).append(layer)
+
+    for target, color in zip(out, target_color_desc):
+        layers_of_correct_color = layers_by_color.get(color)
+        assert layers_of_correct_color, f'no layer of color {chr(color)}'
 
-    target = [_combine_layers_of_color(color) for color in target_color_desc]
-    return np.array(target)
+        # the median of two values is their mean
+        if method == 'mean' or method == 'median' and len(layers_of_correct_color) <= 2:
+            _mean_in_place(layers_of_correct_color, target)
+        else:
+            target[...] = combiner(np.asarray(layers_of_correct_color), axis=0)
 
+    return out
 
-def bayer_to_layers(bayer, pattern):
+
+def _mean_in_place(layers, out):
+    """Average layers within out without temporary copies."""
+    np.copyto(out, layers[0], casting='unsafe')
+    for layer in layers[1:]:
+        np.add(out, layer, out=out, dtype=out.dtype, casting='unsafe')
+    if len(layers) > 1:
+        np.true_divide(out, len(layers), out=out)
+
+
+def bayer_to_layers(bayer, pattern, copy=False):
     """\
     Extract color layers from a raw bayer image an a pattern definition.
 
@@ -89,6 +468,7 @@ def bayer_to_layers(bayer, pattern):
     four layers where each layer represents each second pixel, the first red-layer starts at (0,0), the second
     green-layer starts at (0,1) the third blue-layer starts at (1,1) and the forth layer, also green, starts at (1,0).
 
+    A last incomplete row or column of pattern cells is ignored.
 
     Parameters
     ----------
@@ -99,6 +479,13 @@ def bayer_to_layers(bayer, pattern):
     pattern: array_like
         The smallest possible Bayer pattern of the image.
 
+    copy: bool
+        By default, the layers are strided views into `bayer` and changing them changes `bayer`.
+        Use copy=True to get a single new array of shape (N, r // pattern rows, c // pattern columns).
+
+    Return
+    ------
+    list of N views or an array if copy is True
     """
 
     pattern = np.asarray(pattern)
@@ -109,13 +496,11 @@ def bayer_to_layers(bayer, pattern):
 
     row_step_size, column_step_size = pattern.shape
     rows, columns = np.shape(bayer)
-    if rows % row_step_size != 0 or columns % column_step_size != 0:
-        bayer = np.resize(bayer,
-                          (rows // row_step_size * row_step_size, columns // column_step_size * column_step_size))
+    bayer = np.asarray(bayer)[:rows // row_step_size * row_step_size, :columns // column_step_size * column_step_size]
 
     indices_y, indices_x = np.indices(pattern.shape)
     for start_row, start_column in zip(indices_y.ravel(), indices_x.ravel()):
         idx = pattern[start_row, start_column]
         layers[idx] = bayer[start_row::row_step_size, start_column::column_step_size]
 
-    return np.asarray(layers)
+    return np.array(layers) if copy else layers
@@ -1,4 +1,31 @@
 import glob
+import importlib
+import sys
+import types
+from collections import deque
+from itertools import islice
+
+# files read ahead by default, see `prefetch`
+DEFAULT_PREFETCH = 2
+
+
+class _LazyModule(types.ModuleType):
+    """Stand-in for a module that is imported on first attribute access."""
+
+    def __getattr__(self, name):
+        module = importlib.import_module(self.__name__)
+        # later accesses are plain attribute lookups
+        self.__dict__.update(module.__dict__)
+        return getattr(module, name)
+
+
+def lazy_import(name):
+    """\
+    Return a module that is only imported when one of its attributes is used.
+
+    This keeps heavy packages like numpy or astropy out of code paths not needing them, e.g. --help.
+    """
+    return sys.modules.get(name) or _LazyModule(name)
 
 
 def multi_glob(filenames):
@@ -7,3 +34,46 @@ def multi_glob(filenames):
         result.extend(glob.glob(pattern))
 
     return result
+
+
+def prefetch(function, items, depth=DEFAULT_PREFETCH):
+    """\
+    Yield each item together with a future of `function(item)`, computed by background threads ahead of time.
+
+    While the caller processes an item, the next `depth` items are already computed, e.g. files are read and
+    decoded by astropy or rawpy while the previous one is processed, hiding the latency of network storage.
+    Items are taken from the iterable only when needed, so no more than depth + 1 results are in memory as long
+    as the caller takes each result before asking for the next item. Leaving the loop cancels pending calls.
+
+    Parameters
+    ----------
+    function : callable
+        Called with a single item in another thread, numpy, astropy and rawpy release the GIL while reading
+
+    depth : int
+        Number of items computed ahead, 0 computes each item only when it is asked for
+
+    Return
+    ------
+    generator of item and `concurrent.futures.Future`, its result raises any exception of the function
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    items = iter(items)
+    depth = max(0, depth)
+    with ThreadPoolExecutor(max_workers=depth + 1) as executor:
+        pending = deque((item, executor.submit(function, item)) for item in islice(items, depth + 1))
+        try:
+            while pending:
+                yield pending.popleft()
+                pending.extend((item, executor.submit(function, item)) for item in islice(items, 1))
+        finally:
+            for __, future in pending:
+                future.cancel()
+
+
+def add_prefetch_argument(parser):
+    parser.add_argument('--prefetch', metavar='FILES', type=int, default=DEFAULT_PREFETCH,
+                        help='number of files, or images of fits cubes and multi-extension files, read ahead '
+                             'in the background, 0 disables read-ahead, '
+                             'default=%(default)s')
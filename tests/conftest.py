@@ -1,6 +1,8 @@
 import contextlib
 import os
 
+import pytest
+
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -9,6 +11,29 @@ def pytest_addoption(parser):
         default=False,
         help="Disable plotting in tests"
     )
+    parser.addoption(
+        "--benchmark",
+        action='store_true',
+        default=False,
+        help="Run the benchmarks in test_benchmarks.py and compare them with the stored baselines"
+    )
+    parser.addoption(
+        "--benchmark-sizes",
+        default='1',
+        help="Comma separated sensor sizes in megapixels used by the benchmarks, e.g. 1,16,60"
+    )
+    parser.addoption(
+        "--benchmark-save",
+        action='store_true',
+        default=False,
+        help="Store the benchmark results as new baselines instead of comparing them"
+    )
+    parser.addoption(
+        "--benchmark-tolerance",
+        default=2.0,
+        type=float,
+        help="Fail a benchmark taking more time or memory than tolerance times its baseline"
+    )
 
 
 def pytest_configure(config):
@@ -23,6 +48,13 @@ def pytest_configure(config):
         matplotlib.use('agg')
 
 
+@pytest.fixture(autouse=True)
+def isolated_raw_cache(monkeypatch):
+    """Never write into a raw cache the user may have enabled, tests enable their own, see `bayer.raw_cache`."""
+    monkeypatch.delenv('ALGOL_BAYER_CACHE_DIR', raising=False)
+    monkeypatch.delenv('ALGOL_BAYER_CACHE_MIB', raising=False)
+
+
 @contextlib.contextmanager
 def changed_environ(**changes):
     """\
@@ -41,6 +73,10 @@ def changed_environ(**changes):
 
 # Implement the pytest_generate_tests hook
 def pytest_generate_tests(metafunc):
+    if 'megapixels' in metafunc.fixturenames:
+        sizes = [float(size) for size in metafunc.config.getoption('--benchmark-sizes').split(',')]
+        metafunc.parametrize("megapixels", sizes, ids=[f'{size:g}MP' for size in sizes])
+
     if 'raw_filename' in metafunc.fixturenames:
         metafunc.parametrize("raw_filename", _get_raw_filenames())
     elif 'fits_filename' in metafunc.fixturenames:
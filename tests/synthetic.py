@@ -0,0 +1,92 @@
+"""\
+Synthetic frames for tests and benchmarks.
+
+Sizes are given in megapixels of the camera sensor, i.e. of the bayer mosaic.
+The de-bayered layers have a quarter of those pixels each.
+"""
+
+import numpy as np
+
+# aspect ratio of most astro cameras
+_ASPECT = 3 / 2
+
+
+def sensor_shape(megapixels):
+    """Even (rows, columns) of a sensor with about megapixels * 10**6 pixels."""
+    rows = int(round(np.sqrt(megapixels * 1e6 / _ASPECT) / 2)) * 2
+    columns = int(round(rows * _ASPECT / 2)) * 2
+    return rows, columns
+
+
+def slit_spectrum(rows, columns, angle_deg=1.5, background=100.0, noise=3.0, seed=0, dtype=np.float32):
+    """\
+    Three layers of a slit spectrum tilted by angle_deg on a noisy background.
+
+    The spectrum is a gaussian slit profile times a broad continuum with a few absorption lines,
+    slightly different for each color.
+
+    Return
+    ------
+    array of shape (3, rows, columns)
+    """
+    rng = np.random.default_rng(seed)
+
+    angle = np.deg2rad(angle_deg)
+    y = np.arange(rows, dtype=dtype)[:, np.newaxis] - dtype(rows / 2)
+    x = np.arange(columns, dtype=dtype)[np.newaxis, :] - dtype(columns / 2)
+
+    # coordinates along and across the spectrum
+    along = x * dtype(np.cos(angle)) + y * dtype(np.sin(angle))
+    across = y * dtype(np.cos(angle)) - x * dtype(np.sin(angle))
+
+    slit_width = max(2.0, rows / 100)
+    slit = np.exp(-0.5 * np.square(across / dtype(slit_width)))
+
+    length = columns / 2
+    layers = np.empty((3, rows, columns), dtype=dtype)
+    for layer, center in zip(layers, (0.3, 0.0, -0.3)):
+        continuum = np.exp(-0.5 * np.square(along / dtype(length / 2) - dtype(center)))
+        for line in (-0.4, -0.1, 0.25):
+            continuum *= 1 - dtype(0.6) * np.exp(-0.5 * np.square((along - dtype(line * length)) / dtype(3)))
+        np.multiply(continuum, slit, out=layer)
+        layer *= dtype(20 * background)
+        layer += rng.normal(background, noise, size=(rows, columns)).astype(dtype)
+
+    return layers
+
+
+def bayer_mosaic(rows, columns, pattern='RGGB', seed=0, dtype=np.uint16):
+    """\
+    A raw bayer mosaic of shape (rows, columns) containing a `slit_spectrum`.
+
+    pattern describes the colors of the 2x2 cell in row-major order.
+    """
+    assert rows % 2 == 0 and columns % 2 == 0
+    layers = slit_spectrum(rows // 2, columns // 2, seed=seed)
+
+    mosaic = np.empty((rows, columns), dtype=dtype)
+    for index, color in enumerate(pattern):
+        row, column = divmod(index, 2)
+        mosaic[row::2, column::2] = layers['RGB'.index(color)]
+
+    return mosaic
+
+
+def dark_stack(frames, rows, columns, offset=1000.0, noise=10.0, hot_pixels=1e-4, cosmics=1e-5, seed=0,
+               dtype=np.uint16):
+    """\
+    frames dark exposures of shape (rows, columns).
+
+    All frames share the same hot pixels, while each frame has its own cosmic ray hits
+    to be rejected by sigma clipping.
+    """
+    rng = np.random.default_rng(seed)
+
+    stack = np.empty((frames, rows, columns), dtype=dtype)
+    hot = rng.random((rows, columns)) < hot_pixels
+    for frame in stack:
+        frame[...] = rng.normal(offset, noise, size=(rows, columns))
+        frame[hot] = 20000
+        frame[rng.random((rows, columns)) < cosmics] = 60000
+
+    return stack
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from astropy.stats import sigma_clipped_stats
+
+from bayer.background import background_stats, subsample
+from bayer.extraction import FastExtraction
+from tests.synthetic import slit_spectrum
+
+pytestmark = pytest.mark.filterwarnings('ignore:Input data contains invalid values')
+
+
+@pytest.fixture(scope='module')
+def layers():
+    layers = slit_spectrum(600, 900, noise=3.0)
+    layers[0, 5, 5] = np.nan
+    layers[1, 6, 6] = np.inf
+    return layers
+
+
+@pytest.mark.parametrize('cenfunc, sigma_lower', [('median', 3.0), ('mean', 1000)])
+def test_exact_is_sigma_clipped_stats(layers, cenfunc, sigma_lower):
+    expected = sigma_clipped_stats(layers, sigma_lower=sigma_lower, sigma_upper=3.0, cenfunc=cenfunc, axis=(1, 2))
+    actual = background_stats(layers, sigma_lower=sigma_lower, sigma_upper=3.0, cenfunc=cenfunc)
+    np.testing.assert_array_equal(expected, actual)
+
+
+@pytest.mark.parametrize('cenfunc, sigma_lower', [('median', 3.0), ('mean', 1000)])
+def test_subsample_accuracy(layers, cenfunc, sigma_lower):
+    sample_size = 2 ** 14
+    mean, median, stddev = background_stats(layers, sigma_lower=sigma_lower, cenfunc=cenfunc)
+    approx = background_stats(layers, sigma_lower=sigma_lower, cenfunc=cenfunc, method='subsample',
+                              sample_size=sample_size)
+
+    # four times the documented standard errors
+    np.testing.assert_allclose(approx[0], mean, atol=4 * 3.0 / np.sqrt(sample_size))
+    np.testing.assert_allclose(approx[1], median, atol=4 * 3.0 / np.sqrt(sample_size))
+    np.testing.assert_allclose(approx[2], stddev, atol=4 * 3.0 / np.sqrt(2 * sample_size))
+
+
+@pytest.mark.parametrize('cenfunc, sigma_lower', [('median', 3.0), ('mean', 1000)])
+def test_histogram_accuracy(layers, cenfunc, sigma_lower):
+    bins = 2 ** 12
+    mean, median, stddev = background_stats(layers, sigma_lower=sigma_lower, cenfunc=cenfunc)
+    approx = background_stats(layers, sigma_lower=sigma_lower, cenfunc=cenfunc, method='histogram', bins=bins)
+
+    finite = np.where(np.isfinite(layers), layers, np.nan)
+    width = (np.nanmax(finite, axis=(1, 2)) - np.nanmin(finite, axis=(1, 2))) / (bins - 1)
+    assert np.all(np.abs(approx[0] - mean) <= width / 2)
+    assert np.all(np.abs(approx[1] - median) <= width / 2)
+    assert np.all(np.abs(approx[2] - stddev) <= width)
+
+
+def test_histogram_of_integers_is_exact():
+    data = np.random.default_rng(1).normal(1000, 10, (2, 300, 400)).round().astype(np.uint16)
+    data[0, :10, :10] = 60000
+
+    expected = sigma_clipped_stats(data, axis=(1, 2))
+    actual = background_stats(data, method='histogram', bins=2 ** 16)
+    # the bin width is slightly less than 1
+    np.testing.assert_allclose(expected, actual, atol=0.5)
+
+
+def test_subsample_size():
+    layers = np.zeros((2, 1000, 3000))
+    sample = subsample(layers, 10000)
+    assert sample.shape[0] == 2
+    assert 5000 < sample[0].size <= 10000
+
+
+@pytest.mark.parametrize('method', ['subsample', 'histogram'])
+def test_fast_extraction_with_approximate_background(layers, method):
+    exact = FastExtraction(layers)
+    approx = FastExtraction(layers, background=method)
+    np.testing.assert_allclose(exact.background_mean, approx.background_mean, atol=0.1)
+    np.testing.assert_allclose(exact.de_rotation_angles_deg, approx.de_rotation_angles_deg, atol=0.01)
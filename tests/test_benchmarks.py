@@ -0,0 +1,170 @@
+"""\
+Time and peak memory of the core kernels on synthetic frames.
+
+The benchmarks only run with `pytest --benchmark`. Use `--benchmark-sizes=1,16,60` to select the sensor sizes
+in megapixels and `--benchmark-save` to store the results as new baselines in benchmark_baselines.json.
+Baselines depend on the machine, store them again before tuning a deployment.
+"""
+
+import functools
+import gc
+import json
+import logging
+import os.path
+import time
+import tracemalloc
+
+import pytest
+
+from bayer.background import METHODS, background_stats
+from bayer.extraction import FastExtraction, find_slit_in_images
+from bayer.histogram import histogram_stats, histograms
+from bayer.scripts.darkflat import _average
+from bayer.to_rgb import bayer_to_layers, combine_layers_by_color, debayer
+from tests.synthetic import bayer_mosaic, dark_stack, sensor_shape, slit_spectrum
+
+logger = logging.getLogger(__name__)
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'benchmark_baselines.json')
+
+# below these, differences are mostly noise
+_MIN_SECONDS = 0.05
+_MIN_MIB = 1.0
+
+# FastExtraction stages in order of their dependencies
+_EXTRACTION_STAGES = '_background_stats', 'clipped_layers', 'de_rotation_angles_rad', 'de_rotated_layers'
+
+
+class _Benchmarks:
+
+    def __init__(self, config):
+        self.save = config.getoption('--benchmark-save')
+        self.tolerance = config.getoption('--benchmark-tolerance')
+        self.results = {}
+        self.baselines = {}
+        if os.path.exists(BASELINES):
+            with open(BASELINES) as f:
+                self.baselines = json.load(f)
+
+    def check(self, name, seconds, peak_mib):
+        logger.info(f'{name}: {seconds:.3f}s, {peak_mib:.1f}MiB')
+        self.results[name] = dict(seconds=round(seconds, 4), peak_mib=round(peak_mib, 2))
+
+        baseline = self.baselines.get(name)
+        if self.save or baseline is None:
+            return
+
+        assert seconds <= max(_MIN_SECONDS, self.tolerance * baseline['seconds']), \
+            f'{name} takes {seconds:.3f}s, baseline is {baseline["seconds"]:.3f}s'
+        assert peak_mib <= max(_MIN_MIB, self.tolerance * baseline['peak_mib']), \
+            f'{name} needs {peak_mib:.1f}MiB, baseline is {baseline["peak_mib"]:.1f}MiB'
+
+    def store(self):
+        baselines = dict(self.baselines, **self.results)
+        with open(BASELINES, 'w') as f:
+            json.dump(dict(sorted(baselines.items())), f, indent=2)
+            f.write('\n')
+
+
+@pytest.fixture(scope='module')
+def benchmarks(request):
+    if not request.config.getoption('--benchmark'):
+        pytest.skip('benchmarks only run with --benchmark')
+
+    benchmarks = _Benchmarks(request.config)
+    yield benchmarks
+    if benchmarks.save:
+        benchmarks.store()
+
+
+def _measure(function, *args, **kwargs):
+    """Return result, wall time and peak of the memory allocated by function."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        __, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, seconds, peak / 2 ** 20
+
+
+@functools.lru_cache(maxsize=1)
+def _mosaic(megapixels):
+    return bayer_mosaic(*sensor_shape(megapixels))
+
+
+@functools.lru_cache(maxsize=1)
+def _layers(megapixels):
+    rows, columns = sensor_shape(megapixels)
+    return slit_spectrum(rows // 2, columns // 2)
+
+
+@functools.lru_cache(maxsize=1)
+def _darks(megapixels):
+    return dark_stack(5, *sensor_shape(megapixels))
+
+
+def test_bayer_to_layers(benchmarks, megapixels):
+    __, seconds, peak = _measure(bayer_to_layers, _mosaic(megapixels), [[0, 1], [2, 3]], copy=True)
+    benchmarks.check(f'bayer_to_layers[{megapixels:g}MP]', seconds, peak)
+
+
+@pytest.mark.parametrize('method', ['mean', 'median'])
+def test_combine_layers_by_color(benchmarks, megapixels, method):
+    layers = bayer_to_layers(_mosaic(megapixels), [[0, 1], [2, 3]])
+    __, seconds, peak = _measure(combine_layers_by_color, layers, 'RGGB', 'RGB', method=method)
+    benchmarks.check(f'combine_layers_by_color[{method},{megapixels:g}MP]', seconds, peak)
+
+
+@pytest.mark.parametrize('method', ['mean', 'median'])
+def test_debayer(benchmarks, megapixels, method):
+    __, seconds, peak = _measure(debayer, _mosaic(megapixels), 'RGGB', method=method)
+    benchmarks.check(f'debayer[{method},{megapixels:g}MP]', seconds, peak)
+
+
+@pytest.mark.parametrize('stage', _EXTRACTION_STAGES)
+def test_fast_extraction(benchmarks, megapixels, stage):
+    extractor = FastExtraction(_layers(megapixels))
+    for prerequisite in _EXTRACTION_STAGES[:_EXTRACTION_STAGES.index(stage)]:
+        getattr(extractor, prerequisite)
+
+    __, seconds, peak = _measure(getattr, extractor, stage)
+    benchmarks.check(f'FastExtraction.{stage}[{megapixels:g}MP]', seconds, peak)
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_background_stats(benchmarks, megapixels, method):
+    __, seconds, peak = _measure(background_stats, _layers(megapixels), sigma_lower=1000, cenfunc='mean',
+                                 method=method)
+    benchmarks.check(f'background_stats[{method},{megapixels:g}MP]', seconds, peak)
+
+
+def test_histograms(benchmarks, megapixels):
+    mosaic = _mosaic(megapixels)
+
+    def run():
+        values, counts = histograms(mosaic, [[0, 1], [1, 2]])
+        return histogram_stats(values, counts)
+
+    __, seconds, peak = _measure(run)
+    benchmarks.check(f'histograms[{megapixels:g}MP]', seconds, peak)
+
+
+def test_find_slit_in_images(benchmarks, megapixels):
+    extractor = FastExtraction(_layers(megapixels))
+    rgb = extractor.de_rotated_layers
+
+    (miny, maxy), seconds, peak = _measure(find_slit_in_images, rgb, extractor.background_mean)
+    benchmarks.check(f'find_slit_in_images[{megapixels:g}MP]', seconds, peak)
+
+    assert miny < rgb.shape[1] / 2 < maxy
+
+
+@pytest.mark.parametrize('algorithm', ['mean', 'median', 'sigma3'])
+def test_average(benchmarks, megapixels, algorithm):
+    __, seconds, peak = _measure(_average, _darks(megapixels), algorithm)
+    benchmarks.check(f'darkflat._average[{algorithm},{megapixels:g}MP]', seconds, peak)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from bayer.compression import _tile_size, write_fits
+from bayer.to_rgb import fits_images, open_fits
+
+
+def test_integers_are_lossless(tmp_path):
+    data = np.random.default_rng(0).normal(1000, 10, size=(200, 300)).round().astype(np.uint16)
+    header = fits.Header({'EXPTIME': 60.0})
+
+    write_fits(tmp_path / 'plain.fits', data, header=header.copy())
+    write_fits(tmp_path / 'rice.fits', data, header=header.copy(), compress=True, tile_size=(16,))
+
+    assert (tmp_path / 'rice.fits').stat().st_size < (tmp_path / 'plain.fits').stat().st_size / 2
+    with fits.open(tmp_path / 'rice.fits') as hdu_list:
+        assert isinstance(hdu_list[1], fits.CompImageHDU)
+        assert hdu_list[1].header['EXPTIME'] == 60.0
+        np.testing.assert_array_equal(hdu_list[1].data, data)
+    with fits.open(tmp_path / 'rice.fits', disable_image_compression=True) as hdu_list:
+        assert (hdu_list[1].header['ZTILE1'], hdu_list[1].header['ZTILE2']) == (300, 16)
+
+
+def test_floats_are_quantized_below_noise(tmp_path):
+    data = np.random.default_rng(0).normal(1000, 10, size=(2, 30, 40)).astype(np.float32)
+
+    write_fits(tmp_path / 'rgb.fits', data[0], compress=True)
+    write_fits(tmp_path / 'rgb.fits', data, compress=True, tile_size=(8, 10), append=True)
+
+    with open_fits(tmp_path / 'rgb.fits') as hdu_list:
+        assert len(hdu_list) == 3
+        images = fits_images(hdu_list, dtype=np.float64)
+        assert [image.shape for image in images] == [(1, 30, 40), (1, 30, 40), (1, 30, 40)]
+        for image, expected in zip(images, [data[0], data[0], data[1]]):
+            np.testing.assert_allclose(image.decode()[0], expected, atol=1.0)
+
+
+def test_tile_size():
+    assert _tile_size('16') == (16,)
+    assert _tile_size('64x32') == (64, 32)
+    for text in '', '0', '1x2x3', 'ax2':
+        with pytest.raises(ValueError):
+            _tile_size(text)
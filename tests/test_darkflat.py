@@ -1,8 +1,12 @@
+import logging
+import os
 import sys
 
 import numpy as np
+import pytest
 from astropy.io import fits
 
+from bayer.precision import working_dtype
 from bayer.scripts import darkflat
 
 
@@ -138,3 +142,253 @@ def test_create_master_flat_bayer(tmp_path):
     assert out.exists()
     with fits.open(out) as hdul:
         np.testing.assert_allclose(hdul[0].data, 1.0)
+
+
+def test_average_from_pattern_is_bit_identical(tmp_path):
+    rng = np.random.default_rng(0)
+    for i in range(7):
+        _write_mono_fits(tmp_path / f'd{i}.fits', rng.normal(100, 10, size=(13, 11)))
+    pattern = str(tmp_path / 'd*.fits')
+    offset = rng.normal(5, 1, size=(13, 11)).astype(np.float32)
+
+    for algorithm in 'mean', 'median', 'sigma3':
+        expected = darkflat._average(darkflat._load_from_pattern(pattern) - offset, algorithm)
+        # a tiny limit enforces bands of a single row
+        actual = darkflat._average_from_pattern(pattern, algorithm, memory_limit=1, offset=offset)
+        np.testing.assert_array_equal(expected, actual)
+
+
+def test_create_master_dark_memory_limit(tmp_path):
+    ones = np.ones((4, 3), dtype=np.float32)
+    for i, scale in enumerate([1, 2, 6]):
+        _write_mono_fits(tmp_path / f'd{i}.fits', ones * scale)
+    out = tmp_path / 'md.fits'
+    sys.argv = ['dummy', str(tmp_path / 'd*.fits'), '-o', str(out), '--algorithm', 'mean', '--memory-limit', '0.0001']
+    darkflat.create_master_dark()
+    with fits.open(out) as hdul:
+        np.testing.assert_allclose(ones * 3, hdul[0].data)
+
+
+def test_band_rows_leave_room_for_output_and_mask(tmp_path, caplog):
+    for i in range(4):
+        _write_mono_fits(tmp_path / f'd{i}.fits', np.ones((100, 10), dtype=np.float32))
+    output_bytes = 100 * 10 * working_dtype().itemsize
+    row_bytes = 4 * 10 * (8 * darkflat._AVERAGE_TEMPORARIES + 1)
+
+    with caplog.at_level(logging.INFO):
+        darkflat._average_from_pattern(str(tmp_path / 'd*.fits'), 'sigma3', output_bytes + 5 * row_bytes)
+    assert 'average 4 images in bands of 5 rows' in caplog.text
+
+
+def test_create_master_dark_memory_limit_rejects_compressed_darks(tmp_path):
+    for i in range(3):
+        fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(np.ones((4, 3), dtype=np.float32))]).writeto(
+            tmp_path / f'd{i}.fits')
+    sys.argv = ['dummy', str(tmp_path / 'd*.fits'), '-o', str(tmp_path / 'md.fits'), '--memory-limit', '1']
+    with pytest.raises(SystemExit, match='tile-compressed'):
+        darkflat.create_master_dark()
+    assert not (tmp_path / 'md.fits').exists()
+
+
+def test_apply_master_dark_in_parallel(tmp_path):
+    dark = np.ones((4, 4), dtype=np.float32) * 10.0
+    _write_mono_fits(tmp_path / 'md.fits', dark)
+    for i in range(5):
+        _write_mono_fits(tmp_path / f'light{i}.fits', dark * (i + 2))
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    sys.argv = [
+        'dummy', str(tmp_path / 'light*.fits'),
+        '--master-dark', str(tmp_path / 'md.fits'),
+        '-o', str(outdir),
+        '--jobs', '3',
+    ]
+    darkflat.apply_darks_and_flats()
+    for i in range(5):
+        with fits.open(outdir / f'light{i}-d.fits') as hdul:
+            np.testing.assert_allclose(hdul[0].data, 10.0 * (i + 1))
+
+
+def test_master_library(tmp_path, caplog):
+    library = tmp_path / 'library'
+    for i in range(3):
+        _write_mono_fits(tmp_path / f'd{i}.fits', np.full((4, 4), 10.0), EXPTIME=60.0)
+        _write_mono_fits(tmp_path / f'fd{i}.fits', np.full((4, 4), 5.0), EXPTIME=1.0)
+        _write_mono_fits(tmp_path / f'f{i}.fits', np.full((4, 4), 105.0), EXPTIME=1.0)
+    _write_mono_fits(tmp_path / 'light.fits', np.full((4, 4), 110.0), EXPTIME=60.0)
+
+    sys.argv = ['dummy', str(tmp_path / 'd?.fits'), '--library', str(library)]
+    darkflat.create_master_dark()
+    sys.argv = ['dummy', str(tmp_path / 'fd?.fits'), '--library', str(library)]
+    darkflat.create_master_dark()
+    sys.argv = ['dummy', str(tmp_path / 'f?.fits'), '--library', str(library)]
+    darkflat.create_master_flat()
+    assert len(list(library.glob('*.fits'))) == 3
+
+    # unchanged inputs are not stacked again
+    caplog.clear()
+    caplog.set_level(logging.INFO)
+    sys.argv = ['dummy', str(tmp_path / 'd?.fits'), '--library', str(library)]
+    darkflat.create_master_dark()
+    assert 'is up to date' in caplog.text
+
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    sys.argv = ['dummy', str(tmp_path / 'light.fits'), '--library', str(library), '-o', str(outdir)]
+    darkflat.apply_darks_and_flats()
+    with fits.open(outdir / 'light-df.fits') as hdul:
+        np.testing.assert_allclose(hdul[0].data, 100.0)
+
+
+def test_master_library_keeps_output_outside(tmp_path):
+    library = tmp_path / 'library'
+    for i in range(3):
+        _write_mono_fits(tmp_path / f'd{i}.fits', np.full((4, 4), 10.0), EXPTIME=60.0)
+
+    outside = tmp_path / 'master-dark.fits'
+    sys.argv = ['dummy', str(tmp_path / 'd?.fits'), '--library', str(library), '-o', str(outside)]
+    darkflat.create_master_dark()
+
+    # changed darks replace the master in the index but the file given by --output is kept
+    _write_mono_fits(tmp_path / 'd3.fits', np.full((4, 4), 10.0), EXPTIME=60.0)
+    sys.argv = ['dummy', str(tmp_path / 'd?.fits'), '--library', str(library)]
+    darkflat.create_master_dark()
+
+    assert outside.exists()
+    assert len(list(library.glob('*.fits'))) == 1
+
+
+def test_accumulate_master_dark(tmp_path):
+    rng = np.random.default_rng(4)
+    darks = rng.normal(1000, 10, size=(6, 8, 10)).round().astype(np.uint16)
+    for i, dark in enumerate(darks):
+        fits.PrimaryHDU(dark).writeto(tmp_path / f'dark{i}.fits')
+
+    out = tmp_path / 'master.fits'
+    sys.argv = ['dummy', *(str(tmp_path / f'dark{i}.fits') for i in range(4)), '-o', str(out)]
+    darkflat.accumulate_master_dark()
+    assert (tmp_path / 'master.state.fits').exists()
+
+    # the first darks are given again but only added once
+    sys.argv = ['dummy', str(tmp_path / 'dark*.fits'), '-o', str(out)]
+    darkflat.accumulate_master_dark()
+
+    with fits.open(out) as hdul:
+        assert hdul[0].header['NCOMBINE'] == 6
+        assert hdul[0].header['BITPIX'] == -32
+        np.testing.assert_allclose(hdul[0].data, np.mean(darks, axis=0), rtol=1e-6)
+
+
+def test_accumulate_master_dark_keeps_state_keywords_out_of_the_master(tmp_path):
+    for i in range(4):
+        _write_mono_fits(tmp_path / f'dark{i}.fits', np.full((4, 6), 100.0 + i), EXPTIME=60.0)
+    out = tmp_path / 'master.fits'
+    for i in range(4):
+        sys.argv = ['dummy', str(tmp_path / f'dark{i}.fits'), '-o', str(out), '--sigma-upper', '3']
+        darkflat.accumulate_master_dark()
+
+    with fits.open(out) as hdul:
+        assert hdul[0].header['EXPTIME'] == 60.0
+        assert hdul[0].header['NCOMBINE'] == 4
+        for key in 'NFRAMES', 'SIGMALOW', 'SIGMAUPP', 'MINFRAME', 'EXTNAME':
+            assert key not in hdul[0].header
+
+
+def test_accumulate_master_dark_overwrite(tmp_path):
+    _write_mono_fits(tmp_path / 'dark.fits', np.full((4, 6), 100.0))
+    out = tmp_path / 'master.fits'
+    _write_mono_fits(out, np.zeros((4, 6)))
+
+    # an existing master was not written using the state
+    sys.argv = ['dummy', str(tmp_path / 'dark.fits'), '-o', str(out)]
+    with pytest.raises(SystemExit, match='already exists'):
+        darkflat.accumulate_master_dark()
+    assert not (tmp_path / 'master.state.fits').exists()
+
+    sys.argv = ['dummy', str(tmp_path / 'dark.fits'), '-o', str(out), '--overwrite']
+    darkflat.accumulate_master_dark()
+    with fits.open(out) as hdul:
+        np.testing.assert_allclose(hdul[0].data, 100.0)
+
+
+def test_stack_images_of_cubes_and_extensions(tmp_path):
+    darks = np.random.default_rng(2).normal(1000, 10, size=(5, 6, 8)).round().astype(np.uint16)
+    fits.PrimaryHDU(darks[:2]).writeto(tmp_path / 'd-cube.fits')
+    fits.HDUList([fits.PrimaryHDU()] + [fits.ImageHDU(dark) for dark in darks[2:]]).writeto(tmp_path / 'd-mef.fits')
+
+    stack = darkflat._load_from_pattern(str(tmp_path / 'd-*.fits'), jobs=3)
+    np.testing.assert_array_equal(np.sort(stack, axis=0), np.sort(darks, axis=0))
+
+    out = tmp_path / 'md.fits'
+    sys.argv = ['dummy', str(tmp_path / 'd-*.fits'), '-o', str(out), '--algorithm', 'median', '--jobs', '2']
+    darkflat.create_master_dark()
+    with fits.open(out) as hdul:
+        np.testing.assert_array_equal(hdul[0].data, np.median(darks, axis=0))
+
+    sys.argv = ['dummy', str(tmp_path / 'd-*.fits'), '-o', str(tmp_path / 'md-banded.fits'), '--algorithm', 'median',
+                '--memory-limit', '0.0001']
+    darkflat.create_master_dark()
+    with fits.open(tmp_path / 'md-banded.fits') as hdul:
+        np.testing.assert_array_equal(hdul[0].data, np.median(darks, axis=0))
+
+    sys.argv = ['dummy', str(tmp_path / 'd-mef.fits'), '-o', str(tmp_path / 'md-running.fits')]
+    darkflat.accumulate_master_dark()
+    with fits.open(tmp_path / 'md-running.fits') as hdul:
+        assert hdul[0].header['NCOMBINE'] == 3
+        np.testing.assert_allclose(hdul[0].data, np.mean(darks[2:], axis=0), rtol=1e-6)
+
+
+def test_stack_cube_of_three_darks(tmp_path):
+    darks = np.random.default_rng(5).normal(1000, 10, size=(3, 6, 8)).round().astype(np.uint16)
+    fits.PrimaryHDU(darks).writeto(tmp_path / 'darks3.fits')
+
+    sys.argv = ['dummy', str(tmp_path / 'darks3.fits'), '-o', str(tmp_path / 'md.fits')]
+    darkflat.create_master_dark()
+    with fits.open(tmp_path / 'md.fits') as hdul:
+        np.testing.assert_allclose(hdul[0].data, np.mean(darks, axis=0), rtol=1e-6)
+
+    sys.argv = ['dummy', str(tmp_path / 'darks3.fits'), '-o', str(tmp_path / 'md-running.fits')]
+    darkflat.accumulate_master_dark()
+    with fits.open(tmp_path / 'md-running.fits') as hdul:
+        assert hdul[0].header['NCOMBINE'] == 3
+        np.testing.assert_allclose(hdul[0].data, np.mean(darks, axis=0), rtol=1e-6)
+
+
+def test_compressed_masters_and_lights(tmp_path, monkeypatch):
+    rng = np.random.default_rng(3)
+    darks = rng.normal(1000, 10, size=(3, 20, 30)).round().astype(np.uint16)
+    for i, dark in enumerate(darks):
+        fits.PrimaryHDU(dark, header=fits.Header({'EXPTIME': 60.0})).writeto(tmp_path / f'd{i}.fits')
+    light = rng.normal(3000, 30, size=(20, 30)).round().astype(np.uint16)
+    fits.PrimaryHDU(light, header=fits.Header({'EXPTIME': 60.0})).writeto(tmp_path / 'light.fits')
+
+    sys.argv = ['dummy', str(tmp_path / 'd*.fits'), '-o', str(tmp_path / 'md.fits'), '--algorithm', 'median',
+                '--output-format', 'u2', '--compress', '--tile-size', '4']
+    darkflat.create_master_dark()
+    with fits.open(tmp_path / 'md.fits') as hdul:
+        assert isinstance(hdul[1], fits.CompImageHDU)
+        assert hdul[1].header['EXPTIME'] == 60.0
+        np.testing.assert_array_equal(hdul[1].data, np.median(darks, axis=0).astype(np.uint16))
+        master_dark = hdul[1].data.astype(np.float32)
+
+    # each light is opened only once, also to copy its header
+    opened = []
+
+    def open_fits(filename, **kwargs):
+        opened.append(os.path.basename(filename))
+        return darkflat_open_fits(filename, **kwargs)
+
+    darkflat_open_fits = darkflat.open_fits
+    monkeypatch.setattr(darkflat, 'open_fits', open_fits)
+
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    sys.argv = ['dummy', str(tmp_path / 'light.fits'), '--master-dark', str(tmp_path / 'md.fits'), '-o', str(outdir),
+                '--compress']
+    darkflat.apply_darks_and_flats()
+    assert opened.count('light.fits') == 1
+
+    with fits.open(outdir / 'light-d.fits') as hdul:
+        assert hdul[1].header['EXPTIME'] == 60.0
+        # quantized to a fraction of the noise
+        np.testing.assert_allclose(hdul[1].data, light - master_dark, atol=10.0)
@@ -2,6 +2,9 @@ import os
 import sys
 import tempfile
 
+import numpy as np
+from astropy.io import fits
+
 from bayer.scripts import debayer
 
 
@@ -21,3 +24,74 @@ def test_debayer_wo_output(fits_bayer_filename):
         debayer.main()
     finally:
         os.remove(output)
+
+
+def test_debayer_in_parallel(tmp_path):
+    bayer = np.arange(6 * 8, dtype=np.uint16).reshape(6, 8)
+    for i in range(5):
+        hdu = fits.PrimaryHDU(bayer + i)
+        hdu.header['BAYERPAT'] = 'RGGB'
+        hdu.writeto(tmp_path / f'raw{i}.fits')
+
+    sys.argv = ['dummy', str(tmp_path / 'raw*.fits'), '--jobs', '2']
+    debayer.main()
+
+    for i in range(5):
+        with fits.open(tmp_path / f'raw{i}-rgb.fits') as hdu_list:
+            rgb = hdu_list[0].data
+            assert 'BAYERPAT' not in hdu_list[0].header
+        assert rgb.shape == (3, 3, 4)
+        np.testing.assert_array_equal(rgb[2], bayer[1::2, 1::2] + i)
+
+    # a second run would fail to overwrite the outputs
+    sys.argv = ['dummy', str(tmp_path / 'raw?.fits'), '--jobs', '2', '--skip-existing']
+    debayer.main()
+
+
+def test_debayer_cube_and_extensions(tmp_path):
+    bayer = np.arange(4 * 6 * 4, dtype=np.uint16).reshape(4, 6, 4) * 500
+    header = fits.Header({'BAYERPAT': 'RGGB'})
+    fits.PrimaryHDU(bayer, header=header).writeto(tmp_path / 'cube.fits')
+    fits.HDUList([fits.PrimaryHDU()] + [fits.ImageHDU(frame, header=header) for frame in bayer[:2]]).writeto(
+        tmp_path / 'extensions.fits')
+
+    sys.argv = ['dummy', str(tmp_path / 'cube.fits'), str(tmp_path / 'extensions.fits'), '--jobs', '3']
+    debayer.main()
+
+    for name, frames in ('cube', bayer), ('extensions', bayer[:2]):
+        with fits.open(tmp_path / f'{name}-rgb.fits') as hdu_list:
+            assert len(hdu_list) == len(frames)
+            for hdu, frame in zip(hdu_list, frames):
+                assert hdu.data.shape == (3, 3, 2)
+                np.testing.assert_array_equal(hdu.data[0], frame[0::2, 0::2])
+                np.testing.assert_array_equal(hdu.data[2], frame[1::2, 1::2])
+
+
+def test_debayer_cube_of_three_bayer_frames(tmp_path):
+    bayer = np.arange(3 * 6 * 4, dtype=np.uint16).reshape(3, 6, 4) * 500
+    fits.PrimaryHDU(bayer, header=fits.Header({'BAYERPAT': 'RGGB'})).writeto(tmp_path / 'cube3.fits')
+
+    sys.argv = ['dummy', str(tmp_path / 'cube3.fits')]
+    debayer.main()
+
+    with fits.open(tmp_path / 'cube3-rgb.fits') as hdu_list:
+        assert len(hdu_list) == 3
+        for hdu, frame in zip(hdu_list, bayer):
+            assert hdu.data.shape == (3, 3, 2)
+            np.testing.assert_array_equal(hdu.data[0], frame[0::2, 0::2])
+            np.testing.assert_array_equal(hdu.data[2], frame[1::2, 1::2])
+
+
+def test_debayer_compressed(tmp_path):
+    bayer = np.arange(2 * 8 * 10, dtype=np.uint16).reshape(2, 8, 10) * 100
+    fits.PrimaryHDU(bayer, header=fits.Header({'BAYERPAT': 'RGGB'})).writeto(tmp_path / 'cube.fits')
+
+    sys.argv = ['dummy', str(tmp_path / 'cube.fits'), '--compress', '--tile-size', '2x3']
+    debayer.main()
+
+    with fits.open(tmp_path / 'cube-rgb.fits') as hdu_list:
+        assert len(hdu_list) == 3
+        for hdu, frame in zip(hdu_list[1:], bayer):
+            assert isinstance(hdu, fits.CompImageHDU)
+            assert hdu.data.shape == (3, 4, 5)
+            np.testing.assert_allclose(hdu.data[2], frame[1::2, 1::2], atol=1.0)
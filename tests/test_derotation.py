@@ -1,8 +1,12 @@
 import numpy as np
+import pytest
+from astropy.io import fits
 from pytest import approx
 from scipy.ndimage import rotate
 
-from bayer.extraction import FastExtraction
+from bayer.extraction import FastExtraction, image_moments
+from bayer.to_rgb import fits_images, open_fits
+from tests.synthetic import bayer_mosaic, slit_spectrum
 
 
 def test_de_rotation():
@@ -20,3 +24,92 @@ def test_de_rotation():
         assert (actual == approx(expected, abs=2) or
                 actual == approx(expected - 180, abs=2) or
                 actual == approx(expected + 180, abs=2))
+
+
+def test_image_moments():
+    rng = np.random.default_rng(0)
+    layers = rng.random((2, 7, 9))
+    layers[0, 3, 4] = np.nan
+
+    indices_y, indices_x = np.indices(layers.shape[1:])
+    x = indices_x - 4.0
+    y = indices_y - 3.0
+    expected = [[np.nansum(layer * w) for w in (1, x, y, x * y, x * x, y * y)] for layer in layers]
+
+    np.testing.assert_allclose(image_moments(layers), expected, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(image_moments(layers.astype(np.float32)), expected, rtol=1e-5, atol=1e-4)
+
+
+def test_roi_de_rotation():
+    slit = 1000 * np.exp(-0.5 * (np.arange(0, 30.0 + 1) - 15) ** 2 / 3 ** 2)
+    spectrum = 10 * np.exp(-0.5 * (np.arange(0, 200.0 + 1) - 100) ** 2 / 40 ** 2)
+
+    image = np.random.default_rng(0).normal(100, 1, size=(400, 600)).astype(np.float32)
+    image[150:150 + 31, 200:200 + 201] += np.outer(slit, spectrum)
+    image[10, 10] = 60000  # hot pixel
+
+    full = FastExtraction(image_layers=[image])
+    roi = FastExtraction(image_layers=[image], roi_margin=10, rotation_order=1)
+
+    rows, columns = roi.roi
+    assert rows.start <= 150 + 10 and 150 + 20 <= rows.stop <= 150 + 31 + 10
+    assert columns.start <= 200 + 100 - 40 and 200 + 100 + 40 <= columns.stop <= 200 + 201 + 10
+
+    assert roi.de_rotated_layers.dtype == np.float32
+    assert roi.de_rotated_layers.size < full.de_rotated_layers.size / 10
+    # the spectrum's flux is preserved
+    assert np.nansum(roi.de_rotated_layers - 100) == approx(np.nansum(full.de_rotated_layers - 100), rel=0.02)
+
+
+@pytest.mark.parametrize('background', ['subsample', 'histogram'])
+def test_chunked_extraction_of_memory_mapped_layers(tmp_path, background):
+    np.save(tmp_path / 'layers.npy', slit_spectrum(300, 450))
+    layers = np.load(tmp_path / 'layers.npy', mmap_mode='r')
+
+    expected = FastExtraction(np.array(layers), roi_margin=5, background=background)
+    actual = FastExtraction(layers, roi_margin=5, background=background, chunk_rows=37)
+
+    for e, a in zip(expected._background_stats, actual._background_stats):
+        np.testing.assert_array_equal(e, a)
+    np.testing.assert_allclose(actual.de_rotation_angles_rad, expected.de_rotation_angles_rad, rtol=1e-6)
+    assert actual.roi == expected.roi
+    np.testing.assert_allclose(actual.de_rotated_layers, expected.de_rotated_layers, rtol=1e-5, atol=1e-3)
+    # neither the whole layers nor their clipped copy were converted
+    assert np.shares_memory(actual.layers, layers)
+    assert 'clipped_layers' not in vars(actual)
+
+
+def test_chunked_extraction_of_lazy_bayer_layers(tmp_path):
+    fits.PrimaryHDU(bayer_mosaic(240, 360), header=fits.Header({'BAYERPAT': 'RGGB'})).writeto(tmp_path / 'raw.fits')
+
+    with open_fits(tmp_path / 'raw.fits') as hdu_list:
+        [image] = fits_images(hdu_list)
+        expected = FastExtraction(np.asarray(image), roi_margin=0, background='histogram')
+        actual = FastExtraction(image, roi_margin=0, background='histogram', chunk_rows=16)
+
+        np.testing.assert_allclose(actual.background_mean, expected.background_mean, rtol=1e-6)
+        assert actual.roi == expected.roi
+        np.testing.assert_allclose(actual.de_rotated_layers, expected.de_rotated_layers, rtol=1e-5, atol=1e-3)
+
+    with pytest.raises(AssertionError):
+        FastExtraction(image, chunk_rows=16)
+
+
+def test_chunked_extraction_keeps_the_ends_of_a_tilted_spectrum():
+    slit = 1000 * np.exp(-0.5 * (np.arange(0, 30.0 + 1) - 15) ** 2 / 3 ** 2)
+    spectrum = 10 * np.exp(-0.5 * (np.arange(0, 200.0 + 1) - 100) ** 2 / 40 ** 2)
+
+    image = np.zeros((400, 600))
+    image[150:150 + 31, 200:200 + 201] = np.outer(slit, spectrum)
+    image = rotate(image, 15, reshape=False) + np.random.default_rng(0).normal(100, 1, size=image.shape)
+    image = image.astype(np.float32)
+
+    full = FastExtraction(image_layers=[image], background='histogram')
+    chunked = FastExtraction(image_layers=[image], background='histogram', chunk_rows=32)
+    box = FastExtraction(image_layers=[image], background='histogram', chunk_rows=32, roi_margin=0)
+
+    # without roi_margin, the margin grows with the angle
+    assert chunked.roi[0].stop - chunked.roi[0].start > box.roi[0].stop - box.roi[0].start + 50
+    flux = np.nansum(full.de_rotated_layers - 100)
+    assert np.nansum(chunked.de_rotated_layers - 100) == approx(flux, rel=0.002)
+    assert np.nansum(box.de_rotated_layers - 100) < 0.995 * flux
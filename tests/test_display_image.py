@@ -1,6 +1,8 @@
 import sys
 
+import numpy as np
 import pytest
+from astropy.io import fits
 
 from bayer.scripts import display_image
 
@@ -16,3 +18,15 @@ def test_help():
     with pytest.raises(SystemExit, match='0'):
         sys.argv = ['dummy', '--help']
         display_image.main()
+
+
+def test_display_images_of_a_cube_one_at_a_time(tmp_path, monkeypatch):
+    cube = np.arange(4 * 4 * 6, dtype=np.uint16).reshape(4, 4, 6)
+    fits.PrimaryHDU(cube).writeto(tmp_path / 'cube.fits')
+
+    shown = []
+    monkeypatch.setattr(display_image, '_plot_file', lambda filename, image, *args: shown.append(image))
+    sys.argv = ['dummy', str(tmp_path / 'cube.fits'), '--prefetch', '1']
+    display_image.main()
+
+    np.testing.assert_array_equal(shown, cube[:, np.newaxis])
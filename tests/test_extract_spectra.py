@@ -0,0 +1,69 @@
+import sys
+
+import numpy as np
+from astropy.io import fits
+
+from bayer.scripts import extract_spectra
+
+
+def _write_spectrum(path, angle, **cards):
+    from scipy.ndimage import rotate
+
+    slit = 1000 * np.exp(-0.5 * (np.arange(0, 30.0 + 1) - 15) ** 2 / 3 ** 2)
+    spectrum = 10 * np.exp(-0.5 * (np.arange(0, 200.0 + 1) - 100) ** 2 / 40 ** 2)
+    image = np.random.default_rng(0).normal(100, 1, size=(300, 400))
+    image[100:100 + 31, 100:100 + 201] += np.outer(slit, spectrum)
+    image = rotate(image, angle, reshape=False, mode='nearest')
+
+    hdu = fits.PrimaryHDU(np.asarray(image, dtype=np.uint16))
+    hdu.header.update(cards)
+    hdu.writeto(path)
+
+
+def test_extract_spectra(tmp_path):
+    _write_spectrum(tmp_path / 'mono.fits', 5)
+    _write_spectrum(tmp_path / 'color.fits', -5, BAYERPAT='RGGB')
+
+    out = tmp_path / 'out'
+    out.mkdir()
+    for output, jobs in ('spectra.fits', '2'), ('spectra.npz', '1'):
+        sys.argv = ['dummy', str(tmp_path / '*.fits'), '-o', str(out / output), '--jobs', jobs, '--roi-margin', '10']
+        extract_spectra.main()
+
+    with np.load(out / 'spectra.npz') as npz:
+        arrays = dict(npz)
+    with fits.open(out / 'spectra.fits') as hdu_list:
+        table = hdu_list['SPECTRA'].data
+        np.testing.assert_array_equal(table['SPECTRA'], arrays['spectra'])
+        np.testing.assert_array_equal(table['ANGLE_DEG'], arrays['angle_deg'])
+
+    assert sorted(arrays['filename']) == sorted(str(tmp_path / fn) for fn in ('color.fits', 'mono.fits'))
+    for filename, angle, num_layers, spectra in zip(arrays['filename'], arrays['angle_deg'],
+                                                    np.sum(~np.isnan(arrays['background_mean']), axis=1),
+                                                    arrays['spectra']):
+        if filename.endswith('mono.fits'):
+            assert num_layers == 1
+            assert abs(angle + 5) < 1
+        else:
+            assert num_layers == 3
+            assert abs(angle - 5) < 1
+        assert np.nanmax(spectra[:num_layers]) > 1000
+
+
+def test_extract_spectra_in_chunks(tmp_path):
+    _write_spectrum(tmp_path / 'mono.fits', 5)
+    _write_spectrum(tmp_path / 'color.fits', -5, BAYERPAT='RGGB')
+
+    results = {}
+    for name, chunk_rows in ('whole', []), ('chunked', ['--chunk-rows', '16']):
+        sys.argv = ['dummy', str(tmp_path / '*.fits'), '-o', str(tmp_path / f'{name}.npz'), '--roi-margin', '0',
+                    '--background', 'histogram', *chunk_rows]
+        extract_spectra.main()
+        with np.load(tmp_path / f'{name}.npz') as npz:
+            order = np.argsort(npz['filename'])
+            results[name] = {key: npz[key][order] for key in ('angle_deg', 'slit_min', 'slit_max', 'spectra')}
+
+    np.testing.assert_allclose(results['chunked']['angle_deg'], results['whole']['angle_deg'], rtol=1e-6)
+    np.testing.assert_array_equal(results['chunked']['slit_min'], results['whole']['slit_min'])
+    np.testing.assert_array_equal(results['chunked']['slit_max'], results['whole']['slit_max'])
+    np.testing.assert_allclose(results['chunked']['spectra'], results['whole']['spectra'], rtol=1e-4)
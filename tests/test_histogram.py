@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+from astropy.stats import sigma_clipped_stats
+
+from bayer.histogram import clipped_histogram, histogram_stats, histograms, saturated_fraction
+from tests.synthetic import bayer_mosaic
+
+
+@pytest.fixture(scope='module')
+def mosaic():
+    mosaic = bayer_mosaic(60, 80)
+    mosaic[:2, :4] = 2 ** 16 - 1
+    return mosaic
+
+
+def _channels(mosaic):
+    """Pixels of an RGGB mosaic by channel."""
+    return [mosaic[0::2, 0::2].ravel(),
+            np.concatenate([mosaic[0::2, 1::2].ravel(), mosaic[1::2, 0::2].ravel()]),
+            mosaic[1::2, 1::2].ravel()]
+
+
+def test_mosaic_channels_are_counted_per_value(mosaic):
+    assert mosaic.dtype == np.uint16
+
+    values, counts = histograms(mosaic, [[0, 1], [1, 2]])
+
+    assert counts.shape == (3, 2 ** 16)
+    np.testing.assert_array_equal(values, np.arange(2 ** 16))
+    for channel_counts, pixels in zip(counts, _channels(mosaic)):
+        np.testing.assert_array_equal(channel_counts, np.bincount(pixels, minlength=2 ** 16))
+
+
+def test_integer_stats_are_exact(mosaic):
+    values, counts = histograms(mosaic, [[0, 1], [1, 2]])
+    actual = histogram_stats(values, counts)
+
+    for channel, pixels in enumerate(_channels(mosaic)):
+        expected = sigma_clipped_stats(pixels)
+        np.testing.assert_allclose([a[channel] for a in actual], expected, rtol=1e-12)
+
+
+def test_layers_and_wide_integers():
+    layers = np.random.default_rng(0).integers(-100000, 100000, size=(2, 30, 40), dtype=np.int32)
+    values, counts = histograms(layers)
+
+    assert values[0] == layers.min() and values[-1] == layers.max()
+    for layer, layer_counts in zip(layers, counts):
+        assert layer_counts.sum() == layer.size
+        np.testing.assert_array_equal(values[layer_counts > 0], np.unique(layer))
+
+
+def test_floats_ignore_nan():
+    layer = np.random.default_rng(0).normal(100, 5, size=(50, 60))
+    layer[0, 0] = np.nan
+    layer[1, 1] = -np.inf
+
+    values, counts = histograms(layer, bins=1000)
+
+    assert counts.shape == (1, 1000)
+    assert counts.sum() == layer.size - 2
+    assert values[0] == np.nanmin(layer[np.isfinite(layer)])
+
+
+def test_saturation_and_clipped_histogram(mosaic):
+    values, counts = histograms(mosaic, [[0, 1], [1, 2]])
+
+    np.testing.assert_allclose(saturated_fraction(values, counts, 2 ** 16 - 1),
+                               [np.mean(pixels == 2 ** 16 - 1) for pixels in _channels(mosaic)])
+
+    for channel_counts, pixels in zip(counts, _channels(mosaic)):
+        threshold = np.median(pixels)
+        expected = np.histogram(pixels[pixels >= threshold], bins=100)
+        actual = clipped_histogram(values, channel_counts, threshold, bins=100)
+        np.testing.assert_array_equal(expected[0], actual[0])
+        np.testing.assert_allclose(expected[1], actual[1])
@@ -0,0 +1,67 @@
+import os
+
+from astropy.io import fits
+
+from bayer.library import DARK, FLAT, MasterLibrary, fingerprint
+
+
+def _header(**cards):
+    header = fits.Header()
+    header.update(cards)
+    return header
+
+
+def test_find_matches_keywords_and_temperature(tmp_path):
+    library = MasterLibrary(str(tmp_path))
+    for temperature in -10, -20:
+        path = library.path_for(DARK, f'{temperature:+}' * 8)
+        open(path, 'w').close()
+        library.add(DARK, _header(EXPTIME=60.0, **{'CCD-TEMP': temperature}), f'{temperature:+}' * 8, path)
+
+    found = MasterLibrary(str(tmp_path)).find(DARK, _header(EXPTIME=60.0, **{'CCD-TEMP': -19.5}))
+    assert found == library.path_for(DARK, '-20' * 8)
+
+    assert library.find(DARK, _header(EXPTIME=30.0, **{'CCD-TEMP': -20})) is None
+    assert library.find(DARK, _header(EXPTIME=60.0, **{'CCD-TEMP': -15})) is None
+    assert library.find(FLAT, _header(EXPTIME=60.0)) is None
+
+
+def test_add_replaces_master_with_same_keywords(tmp_path):
+    library = MasterLibrary(str(tmp_path))
+    old_path = library.path_for(FLAT, 'old')
+    new_path = library.path_for(FLAT, 'new')
+    for path, fp in (old_path, 'old'), (new_path, 'new'):
+        open(path, 'w').close()
+        library.add(FLAT, _header(BAYERPAT='RGGB'), fp, path)
+
+    assert not os.path.exists(old_path)
+    assert library.up_to_date(FLAT, 'old') is None
+    assert library.up_to_date(FLAT, 'new') == new_path
+
+
+def test_add_keeps_masters_outside_the_library(tmp_path):
+    library = MasterLibrary(str(tmp_path / 'library'))
+    outside = str(tmp_path / 'master-flat.fits')
+    new_path = library.path_for(FLAT, 'new')
+    for path, fp in (outside, 'old'), (new_path, 'new'):
+        open(path, 'w').close()
+        library.add(FLAT, _header(BAYERPAT='RGGB'), fp, path)
+
+    assert os.path.exists(outside)
+    assert library.up_to_date(FLAT, 'old') is None
+    assert library.up_to_date(FLAT, 'new') == new_path
+
+
+def test_fingerprint_changes_with_inputs(tmp_path):
+    a = tmp_path / 'a.fits'
+    b = tmp_path / 'b.fits'
+    a.write_bytes(b'a')
+    b.write_bytes(b'b')
+
+    assert fingerprint([a, b], algorithm='mean') == fingerprint([b, a], algorithm='mean')
+    assert fingerprint([a, b], algorithm='mean') != fingerprint([a], algorithm='mean')
+    assert fingerprint([a, b], algorithm='mean') != fingerprint([a, b], algorithm='median')
+
+    before = fingerprint([a])
+    a.write_bytes(b'changed')
+    assert fingerprint([a]) != before
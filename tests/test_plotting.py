@@ -1,8 +1,11 @@
 import os
 import sys
 
+import numpy as np
 import pytest
+from astropy.io import fits
 
+from bayer.histogram import saturated_fraction
 from bayer.scripts import display_histogram, display_spectrum, visualize_segmentation
 
 
@@ -22,6 +25,29 @@ def test_help_fits_histogram():
     _test_help(display_histogram.main_fits)
 
 
+def test_fits_histograms_count_saturated_pixels(tmp_path):
+    data = np.full((4, 6), 1000, dtype=np.uint16)
+    data[0, :3] = 2 ** 16 - 1
+    fits.PrimaryHDU(data).writeto(tmp_path / 'saturated.fits')
+
+    [(values, counts, white_level)] = display_histogram._fits_histograms(str(tmp_path / 'saturated.fits'))
+
+    assert white_level == 2 ** 16 - 1
+    np.testing.assert_allclose(saturated_fraction(values, counts, white_level), [3 / 24])
+
+
+def test_display_fits_histogram_accepts_background(tmp_path, monkeypatch, caplog):
+    fits.PrimaryHDU(np.full((4, 6), 1000, dtype=np.uint16)).writeto(tmp_path / 'image.fits')
+    plotted = []
+    monkeypatch.setattr(display_histogram, '_plot_histogram', lambda title, *args: plotted.append(title))
+
+    sys.argv = ['dummy', str(tmp_path / 'image.fits'), '--background', 'subsample']
+    display_histogram.main_fits()
+
+    assert plotted == ['image.fits']
+    assert '--background is deprecated' in caplog.text
+
+
 def test_display_raw_spectrum(raw_filename):
     _test_method(raw_filename, display_spectrum.main_raw)
 
@@ -0,0 +1,118 @@
+import logging
+import os
+import sys
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from bayer.extraction import FastExtraction
+from bayer.precision import PRECISION_VARIABLE, set_working_dtype, working_dtype
+from bayer.scripts import darkflat
+from bayer.to_rgb import fits_to_layers, open_fits
+from tests.conftest import changed_environ
+from tests.synthetic import slit_spectrum
+
+
+def test_working_dtype():
+    with changed_environ():
+        os.environ.pop(PRECISION_VARIABLE, None)
+        assert working_dtype() == np.float32
+
+        set_working_dtype(np.float64)
+        assert working_dtype() == np.float64
+
+        with pytest.raises(AssertionError):
+            set_working_dtype('float16')
+
+    with changed_environ(**{PRECISION_VARIABLE: 'float64'}):
+        assert working_dtype() == np.float64
+
+
+def _write_uint16(path, data):
+    fits.PrimaryHDU(np.asarray(data, dtype=np.uint16)).writeto(path, overwrite=True)
+
+
+@pytest.mark.parametrize('precision', ['float32', 'float64'])
+def test_fits_to_layers(tmp_path, precision):
+    _write_uint16(tmp_path / 'light.fits', np.full((4, 6), 40000))
+    with changed_environ(**{PRECISION_VARIABLE: precision}), open_fits(tmp_path / 'light.fits') as hdu_list:
+        layers = fits_to_layers(hdu_list[0])
+    assert layers.dtype == np.dtype(precision)
+    np.testing.assert_array_equal(layers, 40000)
+
+
+def test_fast_extraction_within_tolerance_of_float64():
+    layers = slit_spectrum(300, 450, dtype=np.float64)
+
+    with changed_environ(**{PRECISION_VARIABLE: 'float64'}):
+        expected = FastExtraction(layers)
+        expected_rotated = expected.de_rotated_layers
+    actual = FastExtraction(layers)
+
+    assert actual.layers.dtype == np.float32
+    assert actual.de_rotated_layers.dtype == np.float32
+    np.testing.assert_allclose(actual.background_mean, expected.background_mean, rtol=1e-5)
+    np.testing.assert_allclose(actual.background_stddev, expected.background_stddev, rtol=1e-4)
+    np.testing.assert_allclose(actual.de_rotation_angles_deg, expected.de_rotation_angles_deg, atol=1e-4)
+    np.testing.assert_allclose(actual.de_rotated_layers, expected_rotated, rtol=1e-5, atol=1e-3)
+
+
+def test_calibration_within_tolerance_of_float64(tmp_path):
+    rng = np.random.default_rng(0)
+    for i in range(3):
+        _write_uint16(tmp_path / f'dark{i}.fits', rng.normal(1000, 10, size=(12, 16)))
+    _write_uint16(tmp_path / 'light.fits', rng.normal(30000, 100, size=(12, 16)))
+
+    results = {}
+    for precision in 'float32', 'float64':
+        output = tmp_path / precision
+        output.mkdir()
+        sys.argv = ['dummy', str(tmp_path / 'dark*.fits'), '-o', str(output / 'md.fits'), '--precision', precision]
+        with changed_environ():
+            darkflat.create_master_dark()
+            assert darkflat._load_from_pattern(str(tmp_path / 'light.fits')).dtype == np.dtype(precision)
+
+        sys.argv = ['dummy', str(tmp_path / 'light.fits'), '--master-dark', str(output / 'md.fits'),
+                    '-o', str(output), '--output-format', 'f4']
+        with changed_environ(**{PRECISION_VARIABLE: precision}):
+            darkflat.apply_darks_and_flats()
+        with fits.open(output / 'light-d.fits') as hdu_list:
+            results[precision] = hdu_list[0].data
+
+    np.testing.assert_allclose(results['float32'], results['float64'], rtol=1e-6)
+
+
+def test_library_stacks_again_in_another_precision(tmp_path, caplog):
+    library = tmp_path / 'library'
+    for i in range(3):
+        _write_uint16(tmp_path / f'dark{i}.fits', np.full((4, 6), 1000 + i))
+        _write_uint16(tmp_path / f'flat{i}.fits', np.full((4, 6), 20000 + i))
+
+    caplog.set_level(logging.INFO)
+    up_to_date = []
+    with changed_environ():
+        os.environ.pop(PRECISION_VARIABLE, None)
+        for precision in 'float32', 'float32', 'float64':
+            caplog.clear()
+            sys.argv = ['dummy', str(tmp_path / 'dark*.fits'), '--library', str(library), '--precision', precision]
+            darkflat.create_master_dark()
+            sys.argv = ['dummy', str(tmp_path / 'flat*.fits'), '--library', str(library),
+                        '--master-flat-dark', str(tmp_path / 'dark0.fits'), '--precision', precision]
+            darkflat.create_master_flat()
+            up_to_date.append(caplog.text.count('is up to date'))
+
+    # only the second run in float32 reused both masters
+    assert up_to_date == [0, 2, 0]
+
+
+def test_average_from_pattern_of_scaled_integers(tmp_path):
+    rng = np.random.default_rng(1)
+    for i in range(5):
+        _write_uint16(tmp_path / f'd{i}.fits', rng.normal(40000, 10, size=(9, 7)))
+    pattern = str(tmp_path / 'd*.fits')
+
+    expected = darkflat._average(darkflat._load_from_pattern(pattern), 'sigma3')
+    actual = darkflat._average_from_pattern(pattern, 'sigma3', memory_limit=1)
+    assert actual.dtype == np.float32
+    np.testing.assert_array_equal(expected, actual)
@@ -0,0 +1,99 @@
+import json
+import sys
+import time
+
+import numpy as np
+from astropy.io import fits
+
+from bayer import profiling
+from bayer.extraction import FastExtraction
+from bayer.scripts import darkflat, extract_spectra
+from tests.test_extract_spectra import _write_spectrum
+
+
+@profiling.timed
+def _sleep(seconds):
+    time.sleep(seconds)
+
+
+def test_nothing_measured_without_collecting():
+    with profiling.record('dummy') as record:
+        _sleep(0)
+        profiling.read(__file__)
+    assert record is None
+
+
+def test_nested_stages_are_exclusive():
+    with profiling.collect() as records:
+        with profiling.record('dummy', extra=1):
+            profiling.read(__file__)
+            with profiling.stage('outer'):
+                _sleep(0.05)
+                time.sleep(0.02)
+            _sleep(0.01)
+
+    [record] = records
+    assert record['file'] == 'dummy' and record['extra'] == 1
+    assert set(record['stages']) == {'outer', '_sleep'}
+    assert 0.02 <= record['stages']['outer'] < 0.05
+    assert record['stages']['_sleep'] >= 0.06
+    assert sum(record['stages'].values()) <= record['seconds']
+    assert record['bytes_read'] > 0
+    assert record['peak_rss'] is None or record['peak_rss'] > 2 ** 20
+
+
+def test_fast_extraction_stages():
+    layers = np.random.default_rng(0).normal(100, 1, size=(1, 50, 60))
+    layers[0, 20:25, 10:50] += 1000
+
+    with profiling.collect() as records:
+        with profiling.record('dummy'):
+            FastExtraction(layers).de_rotated_layers
+
+    [record] = records
+    assert set(record['stages']) == {'FastExtraction._background_stats', 'FastExtraction.clipped_layers',
+                                     'FastExtraction.de_rotation_angles_rad', 'FastExtraction.de_rotated_layers'}
+
+
+def test_darkflat_profile_json(tmp_path):
+    for i in range(3):
+        fits.PrimaryHDU(np.full((4, 4), i, dtype=np.float32)).writeto(tmp_path / f'dark{i}.fits')
+        fits.PrimaryHDU(np.full((4, 4), 10, dtype=np.float32)).writeto(tmp_path / f'light{i}.fits')
+
+    profile = tmp_path / 'profile.json'
+    sys.argv = ['dummy', str(tmp_path / 'dark*.fits'), '-o', str(tmp_path / 'master.fits'),
+                '--profile-json', str(profile)]
+    darkflat.create_master_dark()
+    sys.argv = ['dummy', str(tmp_path / 'light*.fits'), '--master-dark', str(tmp_path / 'master.fits'),
+                '-o', str(tmp_path), '--jobs', '2', '--profile-json', str(profile)]
+    darkflat.apply_darks_and_flats()
+
+    records = [json.loads(line) for line in profile.read_text().splitlines()]
+    assert [r['command'] for r in records] == ['fits_create_master_dark'] + 4 * ['fits_apply_darks_and_flats']
+
+    master, loading, *lights = records
+    assert master['inputs'] == 3
+    assert master['bytes_read'] == sum((tmp_path / f'dark{i}.fits').stat().st_size for i in range(3))
+    assert {'_load_from_pattern', '_average', '_write_fits_using_header'} <= set(master['stages'])
+    assert loading['master'] is True
+
+    assert sorted(r['file'] for r in lights) == sorted(str(tmp_path / f'light{i}.fits') for i in range(3))
+    for light in lights:
+        assert {'_calibrate_light.read', '_calibrate_light.calibrate', '_write_fits_using_header'} <= \
+               set(light['stages'])
+
+
+def test_extract_spectra_profile_json_in_parallel(tmp_path):
+    _write_spectrum(tmp_path / 'a.fits', 5)
+    _write_spectrum(tmp_path / 'b.fits', -5)
+
+    profile = tmp_path / 'profile.json'
+    sys.argv = ['dummy', str(tmp_path / '*.fits'), '-o', str(tmp_path / 'spectra.npz'), '--jobs', '2',
+                '--profile-json', str(profile)]
+    extract_spectra.main()
+
+    records = [json.loads(line) for line in profile.read_text().splitlines()]
+    assert sorted(r['file'] for r in records) == [str(tmp_path / 'a.fits'), str(tmp_path / 'b.fits')]
+    for record in records:
+        assert 'FastExtraction.de_rotated_layers' in record['stages']
+        assert 'find_slit_in_images' in record['stages']
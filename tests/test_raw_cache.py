@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import pytest
+
+from bayer import raw_cache
+from tests.conftest import changed_environ
+
+
+@pytest.fixture
+def decoded(monkeypatch):
+    """Replace LibRaw by a fake decoder and return the names of decoded files."""
+    decoded = []
+
+    def decode(filename):
+        decoded.append(os.path.basename(filename))
+        image = np.arange(40 * 60, dtype=np.uint16).reshape(40, 60)
+        return raw_cache.DecodedRaw(image, [[0, 1], [3, 2]], b'RGBG', 16383)
+
+    monkeypatch.setattr(raw_cache, '_decode', decode)
+    return decoded
+
+
+def _raw_file(tmp_path, name):
+    filename = tmp_path / name
+    filename.write_bytes(b'raw data of ' + name.encode())
+    return str(filename)
+
+
+def _sidecars(folder):
+    return sorted(name for name in os.listdir(folder) if name.endswith('.npy'))
+
+
+def test_second_read_is_cached(tmp_path, decoded):
+    filename = _raw_file(tmp_path, 'a.cr2')
+    with changed_environ(ALGOL_BAYER_CACHE_DIR=str(tmp_path / 'cache')):
+        first = raw_cache.imread(filename)
+        with raw_cache.imread(filename) as second:
+            assert isinstance(second.raw_image_visible, np.memmap)
+            np.testing.assert_array_equal(first.raw_image_visible, second.raw_image_visible)
+            np.testing.assert_array_equal(first.raw_pattern, second.raw_pattern)
+            assert second.color_desc == b'RGBG'
+            assert second.white_level == 16383
+
+    assert decoded == ['a.cr2']
+
+
+def test_modified_file_is_decoded_again(tmp_path, decoded):
+    filename = _raw_file(tmp_path, 'a.cr2')
+    with changed_environ(ALGOL_BAYER_CACHE_DIR=str(tmp_path / 'cache')):
+        raw_cache.imread(filename)
+        stat = os.stat(filename)
+        os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        raw_cache.imread(filename)
+
+    assert decoded == ['a.cr2', 'a.cr2']
+
+
+def test_least_recently_used_is_evicted(tmp_path, decoded):
+    folder = tmp_path / 'cache'
+    a, b, c = (_raw_file(tmp_path, name) for name in ('a.cr2', 'b.cr2', 'c.cr2'))
+
+    with changed_environ(ALGOL_BAYER_CACHE_DIR=str(folder)):
+        raw_cache.imread(a)
+        raw_cache.imread(b)
+
+        entry_size = sum(os.path.getsize(folder / name) for name in os.listdir(folder)) / 2
+        for name in os.listdir(folder):
+            os.utime(folder / name, (1000, 1000))
+
+        # reading a again makes b the least recently used
+        raw_cache.imread(a)
+        with changed_environ(ALGOL_BAYER_CACHE_MIB=str(2.5 * entry_size / 2 ** 20)):
+            raw_cache.imread(c)
+
+        assert decoded == ['a.cr2', 'b.cr2', 'c.cr2']
+        assert len(_sidecars(folder)) == 2
+
+        raw_cache.imread(a)
+        raw_cache.imread(b)
+        assert decoded == ['a.cr2', 'b.cr2', 'c.cr2', 'b.cr2']
+
+
+def test_disabled_cache(tmp_path, decoded):
+    filename = _raw_file(tmp_path, 'a.cr2')
+    with changed_environ(ALGOL_BAYER_CACHE_DIR=str(tmp_path / 'cache'), ALGOL_BAYER_CACHE_MIB='0'):
+        raw_cache.imread(filename)
+        raw_cache.imread(filename)
+
+    assert decoded == ['a.cr2', 'a.cr2']
+    assert not (tmp_path / 'cache').exists()
+
+
+def test_cache_is_opt_in(tmp_path, decoded):
+    filename = _raw_file(tmp_path, 'a.cr2')
+    with changed_environ(XDG_CACHE_HOME=str(tmp_path / 'home-cache')):
+        raw_cache.imread(filename)
+        raw_cache.imread(filename)
+
+    assert decoded == ['a.cr2', 'a.cr2']
+    assert not (tmp_path / 'home-cache').exists()
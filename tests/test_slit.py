@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from bayer import extraction
+from bayer.extraction import _find_smallest_interval, find_slit_in_images, find_slits_in_profiles, slit_profile
+
+
+def _reference_smallest_interval(data, area_percentage=0.95):
+    target_sum = np.nansum(data) * area_percentage
+    cumulative_data_sum = np.nancumsum(data)
+
+    smallest_interval_size = len(data)
+    smallest_interval = None, None
+    a, b = 0, 1
+    while a < b < len(data):
+        if cumulative_data_sum[b] - cumulative_data_sum[a] < target_sum:
+            b += 1
+        else:
+            if b - a < smallest_interval_size:
+                smallest_interval_size = b - a
+                smallest_interval = a, b
+            a += 1
+    # no interval found, the whole profile is used
+    return (0, len(data) - 1) if smallest_interval == (None, None) else smallest_interval
+
+
+def test_find_smallest_interval_matches_reference():
+    rng = np.random.default_rng(0)
+    profiles = rng.random((50, 80)) ** 4
+    profiles[::7, 5] = np.nan
+
+    starts, ends = _find_smallest_interval(profiles)
+    for profile, start, end in zip(profiles, starts, ends):
+        assert _reference_smallest_interval(profile) == (start, end)
+        assert _find_smallest_interval(profile) == (start, end)
+
+
+def test_find_smallest_interval_in_blocks_with_ties(monkeypatch):
+    monkeypatch.setattr(extraction, '_SEARCH_SIZE', 100)
+    profiles = np.random.default_rng(1).integers(0, 4, size=(30, 40)).astype(float)
+
+    starts, ends = _find_smallest_interval(profiles)
+    for profile, start, end in zip(profiles, starts, ends):
+        assert _reference_smallest_interval(profile) == (start, end)
+
+
+def test_find_smallest_interval_keeps_negative_values():
+    rng = np.random.default_rng(2)
+    profiles = rng.normal(0, 1, size=(20, 60))
+    profiles[:, 20:30] += 5
+
+    starts, ends = _find_smallest_interval(profiles)
+    for profile, start, end in zip(profiles, starts, ends):
+        assert _reference_smallest_interval(profile) == (start, end)
+
+
+def test_find_smallest_interval_of_negative_tails():
+    # the bounds of the two-pointer search before the vectorization
+    profile = np.array([-1, 2, -1, 0, 1, 5, 8, 6, 1, -2, 0, 3, -3, 0], dtype=float)
+    assert _find_smallest_interval(profile) == (4, 7)
+    assert _find_smallest_interval(profile, clip_negative=True) == (0, 11)
+
+    miny, maxy = find_slits_in_profiles([profile, np.clip(profile, 0, None)], scale=1.0)
+    np.testing.assert_array_equal(miny, [4, 0])
+    np.testing.assert_array_equal(maxy, [7, 11])
+
+
+def test_find_smallest_interval_subpixel():
+    data = np.array([0, 1, 2, 2, 1, 0], dtype=float)
+    assert _find_smallest_interval(data, 0.6) == (1, 3)
+    # the rows 2 and 3 contain 4 instead of 3.6, the surplus is trimmed from both ends
+    start, end = _find_smallest_interval(data, 0.6, subpixel=True)
+    np.testing.assert_allclose([start, end], [1.1, 2.9])
+
+
+def test_slit_profile():
+    rng = np.random.default_rng(0)
+    rgb = rng.normal(10, 1, size=(3, 20, 30))
+    rgb[:, 8:12, :] += 100
+    rgb[rng.random(rgb.shape) < 0.1] = np.nan
+    rgb[:, 0, :] = np.nan
+    background = np.array([10, 9, 11])
+
+    with pytest.warns(RuntimeWarning, match='Mean of empty slice'):
+        expected = np.nanmean(rgb - background.reshape(-1, 1, 1), axis=(0, 2))
+    np.testing.assert_allclose(slit_profile(rgb, background), expected)
+
+    assert find_slit_in_images(rgb, background, scale=1.0) == (7, 11)
+
+
+def test_find_slits_in_profiles_batch():
+    profiles = np.zeros((3, 50))
+    for i in range(3):
+        profiles[i, 10 * i + 5:10 * i + 15] = 1
+
+    miny, maxy = find_slits_in_profiles(profiles, scale=1.0)
+    np.testing.assert_array_equal(miny, [4, 14, 24])
+    np.testing.assert_array_equal(maxy, [14, 24, 34])
@@ -0,0 +1,88 @@
+import numpy as np
+from astropy.io import fits
+
+from bayer.stacking import RunningMean, sigma_clipped_mean
+
+
+def _reference_sigma_clipped_mean(stack, sigma_lower, sigma_upper, max_iters):
+    clipped = stack
+    for i in range(max_iters):
+        mean = np.nanmean(clipped, axis=0)
+        stddev = np.nanstd(clipped, axis=0)
+        accepted = np.logical_and(mean - sigma_lower * stddev <= stack, stack <= mean + sigma_upper * stddev)
+        clipped = np.where(accepted, stack, np.nan)
+    return np.nanmean(clipped, axis=0)
+
+
+def test_sigma_clipped_mean_matches_reference():
+    rng = np.random.default_rng(1)
+    stack = rng.normal(100, 10, size=(15, 20, 30)).astype(np.float32)
+    stack[rng.random(stack.shape) < 0.02] = 1e4
+    stack[rng.random(stack.shape) < 0.02] = np.nan
+
+    for sigma_lower, sigma_upper, max_iters in (3, 3, 3), (2, 1.5, 5), (3, 3, 0):
+        expected = _reference_sigma_clipped_mean(stack, sigma_lower, sigma_upper, max_iters)
+        actual = sigma_clipped_mean(stack, sigma_lower, sigma_upper, max_iters)
+        assert actual.dtype == np.float32
+        np.testing.assert_array_equal(expected, actual)
+
+
+def test_sigma_clipped_mean_of_integers_uses_float32():
+    stack = np.full((3, 2, 2), 7, dtype=np.uint16)
+    actual = sigma_clipped_mean(stack)
+    assert actual.dtype == np.float32
+    np.testing.assert_array_equal(actual, 7)
+
+
+def test_sigma_clipped_mean_rejects_outliers():
+    stack = np.zeros((9, 1, 1))
+    stack[0] = 1000
+    np.testing.assert_array_equal(sigma_clipped_mean(stack, sigma_upper=2), 0)
+
+
+def test_running_mean_matches_mean_and_variance(tmp_path):
+    rng = np.random.default_rng(2)
+    stack = rng.normal(100, 10, size=(10, 20, 30)).astype(np.float32)
+    stack[rng.random(stack.shape) < 0.05] = np.nan
+
+    running_mean = RunningMean(stack.shape[1:])
+    for frame in stack[:4]:
+        running_mean.add(frame)
+
+    # continue after saving and loading the state
+    running_mean.save(tmp_path / 'state.fits')
+    running_mean, __ = RunningMean.load(tmp_path / 'state.fits')
+    for frame in stack[4:]:
+        running_mean.add(frame)
+
+    assert running_mean.frames == 10
+    stack = stack.astype(np.float64)
+    np.testing.assert_allclose(running_mean.mean, np.nanmean(stack, axis=0), rtol=1e-12)
+    np.testing.assert_allclose(running_mean.variance, np.nanvar(stack, axis=0), rtol=1e-9)
+    np.testing.assert_array_equal(running_mean.count, np.sum(~np.isnan(stack), axis=0))
+
+
+def test_running_mean_without_values_is_nan():
+    running_mean = RunningMean((1, 2))
+    running_mean.add(np.array([[np.nan, 1.0]]))
+    np.testing.assert_array_equal(running_mean.mean, [[np.nan, 1.0]])
+
+
+def test_running_mean_rejects_outliers(tmp_path):
+    rng = np.random.default_rng(3)
+    stack = rng.normal(100, 1, size=(12, 5, 5))
+    stack[6, 2, 2] = 1000
+
+    running_mean = RunningMean(stack.shape[1:], sigma_upper=3, min_frames=3)
+    for i, frame in enumerate(stack):
+        running_mean.add(frame, source=f'dark{i}.fits')
+
+    running_mean.save(tmp_path / 'state.fits', fits.Header({'EXPTIME': 60.0}))
+    loaded, header = RunningMean.load(tmp_path / 'state.fits')
+    assert header['EXPTIME'] == 60.0
+    assert 'SIGMAUPP' not in header and 'NFRAMES' not in header
+    assert (loaded.sigma_lower, loaded.sigma_upper, loaded.min_frames) == (None, 3, 3)
+    assert loaded.sources == [f'dark{i}.fits' for i in range(12)]
+
+    assert loaded.rejected[2, 2] == 1
+    assert abs(loaded.mean[2, 2] - 100) < 1
@@ -0,0 +1,50 @@
+import configparser
+import json
+import os.path
+import subprocess
+import sys
+
+import pytest
+
+# modules that must only be imported when a code path needs them
+HEAVY_MODULES = 'numpy', 'astropy', 'matplotlib', 'scipy', 'rawpy'
+
+# generous limits, `--help` of each entry point currently needs about 0.05s and 130 modules
+STARTUP_SECONDS = 0.5
+STARTUP_MODULES = 250
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PROBE = """\
+import importlib, json, sys, time
+start = time.perf_counter()
+module, function = sys.argv[1].split(':')
+main = getattr(importlib.import_module(module), function)
+sys.argv[1:] = ['--help']
+try:
+    main()
+except SystemExit:
+    pass
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(seconds=elapsed, modules=sorted(sys.modules))), file=sys.stderr)
+"""
+
+
+def _console_scripts():
+    config = configparser.ConfigParser()
+    config.read(os.path.join(_ROOT, 'setup.cfg'))
+    lines = config['options.entry_points']['console_scripts'].strip().splitlines()
+    return dict(line.replace(' ', '').split('=') for line in lines)
+
+
+@pytest.mark.parametrize('name, entry_point', sorted(_console_scripts().items()))
+def test_startup_budget(name, entry_point):
+    # python -X importtime or timing the subprocess itself would include the interpreter's own startup
+    result = subprocess.run([sys.executable, '-c', _PROBE, entry_point], cwd=_ROOT,
+                            capture_output=True, text=True, check=True)
+    stats = json.loads(result.stderr.strip().splitlines()[-1])
+
+    heavy = {m for m in stats['modules'] if m.split('.')[0] in HEAVY_MODULES}
+    assert not heavy, f'{name} --help imports {sorted(heavy)}'
+    assert len(stats['modules']) < STARTUP_MODULES, f'{name} --help imports {len(stats["modules"])} modules'
+    assert stats['seconds'] < STARTUP_SECONDS, f'{name} --help takes {stats["seconds"]:.2f}s'
@@ -0,0 +1,194 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from bayer.to_rgb import BAYER_PATTERNS, LazyLayers, bayer_pattern_name, bayer_to_layers, combine_layers_by_color, \
+    debayer, decode_images, fits_image_indices, fits_images, fits_to_layers, open_fits
+
+
+def _write(path, data, **cards):
+    hdu = fits.PrimaryHDU(data)
+    hdu.header.update(cards)
+    hdu.writeto(path, overwrite=True)
+
+
+def test_fits_to_layers_fuses_scaling(tmp_path):
+    rng = np.random.default_rng(0)
+    unsigned = rng.integers(0, 2 ** 16, size=(6, 8), dtype=np.uint16)
+    _write(tmp_path / 'unsigned.fits', unsigned)
+
+    hdu = fits.PrimaryHDU(rng.integers(-100, 100, size=(6, 8), dtype=np.int16))
+    hdu.header['BSCALE'] = 0.5
+    hdu.header['BZERO'] = 10.0
+    hdu.writeto(tmp_path / 'scaled.fits')
+
+    hdu = fits.PrimaryHDU(rng.normal(0, 100, size=(6, 8)).astype(np.float32))
+    hdu.header['BSCALE'] = 0.5
+    hdu.header['BZERO'] = 10.0
+    hdu.writeto(tmp_path / 'float.fits')
+
+    for name in 'unsigned', 'scaled', 'float':
+        with fits.open(tmp_path / f'{name}.fits') as hdu_list:
+            expected = np.asarray(hdu_list[0].data, dtype=np.float32)
+        with open_fits(tmp_path / f'{name}.fits') as hdu_list:
+            assert hdu_list[0].data.dtype.kind == ('f' if name == 'float' else 'i')
+            actual = fits_to_layers(hdu_list[0])
+        assert actual.dtype == np.float32
+        np.testing.assert_array_equal([expected], actual)
+
+
+def test_fits_to_layers_lazy_bayer(tmp_path):
+    bayer = np.arange(4 * 6, dtype=np.uint16).reshape(4, 6) + 40000
+    _write(tmp_path / 'bayer.fits', bayer, BAYERPAT='RGGB')
+
+    with fits.open(tmp_path / 'bayer.fits') as hdu_list:
+        expected = fits_to_layers(hdu_list[0])
+
+    with open_fits(tmp_path / 'bayer.fits') as hdu_list:
+        lazy = fits_to_layers(hdu_list[0], lazy=True)
+        assert isinstance(lazy, LazyLayers)
+        assert lazy.shape == (3, 2, 3)
+        assert lazy.white_level == 2 ** 16 - 1
+        np.testing.assert_array_equal(lazy.raw[0, 0::2, 0::2] + np.int32(32768), bayer[0::2, 0::2])
+        actual = np.asarray(lazy)
+
+    np.testing.assert_array_equal(expected, actual)
+    np.testing.assert_array_equal(actual[0], bayer[0::2, 0::2])
+    np.testing.assert_array_equal(actual[1], (bayer[0::2, 1::2] / 2 + bayer[1::2, 0::2] / 2))
+
+
+def test_white_level():
+    assert LazyLayers(np.zeros((1, 2, 2), dtype=np.uint8)).white_level == 255
+    assert LazyLayers(np.zeros((1, 2, 2), dtype=np.int16)).white_level == 2 ** 15 - 1
+    assert LazyLayers(np.zeros((1, 2, 2), dtype=np.int16), bscale=0.5, bzero=100).white_level == 16483.5
+    assert LazyLayers(np.zeros((1, 2, 2), dtype=np.float32)).white_level == 2 ** 16 - 1
+
+
+def test_bayer_to_layers_returns_views_and_crops_odd_sizes():
+    bayer = np.arange(5 * 7).reshape(5, 7)
+    layers = bayer_to_layers(bayer, [[0, 1], [3, 2]])
+
+    assert all(np.shares_memory(layer, bayer) for layer in layers)
+    np.testing.assert_array_equal(layers[0], bayer[0:4:2, 0:6:2])
+    np.testing.assert_array_equal(layers[1], bayer[0:4:2, 1:6:2])
+    np.testing.assert_array_equal(layers[2], bayer[1:4:2, 1:6:2])
+    np.testing.assert_array_equal(layers[3], bayer[1:4:2, 0:6:2])
+
+    copied = bayer_to_layers(bayer, [[0, 1], [3, 2]], copy=True)
+    assert copied.shape == (4, 2, 3)
+    assert not np.shares_memory(copied, bayer)
+    np.testing.assert_array_equal(copied, layers)
+
+
+def test_combine_layers_by_color():
+    rng = np.random.default_rng(0)
+    layers = bayer_to_layers(rng.integers(0, 4096, size=(6, 8), dtype=np.uint16), [[0, 1], [3, 2]])
+
+    for method in 'mean', 'median', 'max':
+        expected = [getattr(np, method)(np.asarray(layers)[indices], axis=0) for indices in ([0], [1, 3], [2])]
+        actual = combine_layers_by_color(layers, 'RGBG', 'RGB', method=method)
+        assert actual.dtype == np.float64
+        np.testing.assert_array_equal(expected, actual)
+
+    out = np.empty((3, 3, 4), dtype=np.float32)
+    assert combine_layers_by_color(layers, 'RGBG', 'RGB', out=out) is out
+    np.testing.assert_array_equal(out[1], (layers[1] / 2 + layers[3] / 2))
+
+
+@pytest.mark.parametrize('pattern', BAYER_PATTERNS)
+@pytest.mark.parametrize('method', ['mean', 'median'])
+def test_debayer_is_combine_layers_by_color(pattern, method):
+    bayer = np.random.default_rng(0).integers(60000, 2 ** 16, size=(7, 9), dtype=np.uint16)
+
+    expected = combine_layers_by_color(bayer_to_layers(bayer, [[0, 1], [2, 3]]), pattern, 'RGB', method=method)
+    actual = debayer(bayer, pattern, method=method)
+
+    assert actual.dtype == np.float32
+    assert actual.shape == (3, 3, 4)
+    np.testing.assert_array_equal(expected.astype(np.float32), actual)
+
+
+def test_debayer_mono_and_out():
+    bayer = np.arange(12, dtype=np.int16).reshape(3, 4)
+    np.testing.assert_array_equal(debayer(bayer, None, dtype=np.float64), [bayer])
+
+    out = np.empty((3, 1, 2), dtype=np.float64)
+    assert debayer(bayer, b'gbrg', out=out) is out
+    np.testing.assert_array_equal(out[0], bayer[1:2, 0::2])
+
+
+def test_bayer_pattern_name():
+    assert bayer_pattern_name([[0, 1], [3, 2]], b'RGBG') == 'RGGB'
+    assert bayer_pattern_name([[2, 3], [1, 0]], 'RGBG') == 'BGGR'
+    assert bayer_pattern_name([[0, 1], [3, 2]], b'CMYG') is None
+    assert bayer_pattern_name(np.zeros((6, 6), dtype=int), b'RGBG') is None
+
+
+def test_combine_layers_by_color_dtype():
+    layers = bayer_to_layers(np.full((4, 4), 2 ** 16 - 1, dtype=np.uint16), [[0, 1], [3, 2]])
+    actual = combine_layers_by_color(layers, 'RGBG', 'RGB', dtype=np.float32)
+    assert actual.dtype == np.float32
+    np.testing.assert_array_equal(actual, 2 ** 16 - 1)
+
+
+def test_fits_images_of_cubes_and_extensions(tmp_path):
+    rng = np.random.default_rng(0)
+    bayer = rng.integers(0, 2 ** 16, size=(4, 6), dtype=np.uint16)
+    cube = rng.integers(0, 2 ** 16, size=(2, 4, 6), dtype=np.uint16)
+    rgb = rng.integers(0, 2 ** 16, size=(3, 2, 3), dtype=np.uint16)
+
+    primary = fits.PrimaryHDU(bayer)
+    primary.header['BAYERPAT'] = 'RGGB'
+    table = fits.BinTableHDU.from_columns([fits.Column(name='x', format='E', array=np.zeros(2))])
+    fits.HDUList([primary, fits.ImageHDU(cube), table, fits.ImageHDU(rgb)]).writeto(tmp_path / 'mef.fits')
+
+    with open_fits(tmp_path / 'mef.fits') as hdu_list:
+        images = fits_images(hdu_list)
+        assert [image.shape for image in images] == [(3, 2, 3), (1, 4, 6), (1, 4, 6), (3, 2, 3)]
+        np.testing.assert_array_equal(images[0], fits_to_layers(hdu_list[0]))
+        np.testing.assert_array_equal(images[1], cube[:1])
+        np.testing.assert_array_equal(images[2], cube[1:])
+        np.testing.assert_array_equal(images[3], rgb)
+
+        mosaics = fits_images(hdu_list, dtype=np.float64, mosaic=True)
+        assert [image.shape for image in mosaics] == [(1, 4, 6)] * 3 + [(1, 2, 3)] * 3
+        np.testing.assert_array_equal(mosaics[0], [bayer])
+        assert np.asarray(mosaics[0]).dtype == np.float64
+
+
+def test_fits_images_of_a_cube_of_three_bayer_frames(tmp_path):
+    cube = np.random.default_rng(0).integers(0, 2 ** 16, size=(3, 4, 6), dtype=np.uint16)
+    _write(tmp_path / 'rgb.fits', cube)
+    _write(tmp_path / 'bayer.fits', cube, BAYERPAT='RGGB')
+
+    with open_fits(tmp_path / 'rgb.fits') as hdu_list:
+        assert [image.shape for image in fits_images(hdu_list)] == [(3, 4, 6)]
+
+    with open_fits(tmp_path / 'bayer.fits') as hdu_list:
+        images = fits_images(hdu_list)
+        assert [image.shape for image in images] == [(3, 2, 3)] * 3
+        for image, frame in zip(images, cube):
+            np.testing.assert_array_equal(np.asarray(image)[2], frame[1::2, 1::2])
+
+
+def test_decode_images_in_parallel(tmp_path):
+    cube = np.random.default_rng(0).integers(0, 2 ** 16, size=(5, 4, 6), dtype=np.uint16)
+    fits.PrimaryHDU(cube).writeto(tmp_path / 'cube.fits')
+
+    with open_fits(tmp_path / 'cube.fits') as hdu_list:
+        images = fits_images(hdu_list)
+        np.testing.assert_array_equal(decode_images(images, jobs=3), cube[:, np.newaxis])
+        np.testing.assert_array_equal(decode_images(images), decode_images(images, jobs=3))
+
+        with pytest.raises(ValueError):
+            decode_images(images + [LazyLayers(cube[:1, :2])])
+
+
+def test_fits_image_indices(tmp_path):
+    fits.PrimaryHDU(np.zeros((3, 4, 6), dtype=np.uint16)).writeto(tmp_path / 'cube.fits')
+    fits.PrimaryHDU().writeto(tmp_path / 'empty.fits')
+    filenames = [str(tmp_path / 'cube.fits'), str(tmp_path / 'empty.fits')]
+
+    assert list(fits_image_indices(filenames)) == [(filenames[0], 0), (filenames[1], None)]
+    assert list(fits_image_indices(filenames, mosaic=True)) == [(filenames[0], 0), (filenames[0], 1),
+                                                                (filenames[0], 2), (filenames[1], None)]
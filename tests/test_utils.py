@@ -0,0 +1,53 @@
+import threading
+import time
+
+import pytest
+
+from bayer.utils import prefetch
+
+
+def test_prefetch_keeps_order_and_reads_ahead():
+    started = []
+    release = threading.Event()
+
+    def read(item):
+        started.append(item)
+        if item > 0:
+            release.wait(5)
+        return item * 10
+
+    items = prefetch(read, range(10), depth=3)
+    item, future = next(items)
+    assert (item, future.result()) == (0, 0)
+    # the next depth items are read, but not more
+    deadline = time.monotonic() + 5
+    while len(started) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert sorted(started) == [0, 1, 2, 3]
+
+    release.set()
+    assert [(item, future.result()) for item, future in items] == [(i, i * 10) for i in range(1, 10)]
+
+
+def test_prefetch_raises_when_the_result_is_taken():
+    def read(item):
+        if item == 2:
+            raise ValueError(item)
+        return item
+
+    results = []
+    with pytest.raises(ValueError):
+        for item, future in prefetch(read, range(5), depth=1):
+            results.append(future.result())
+    assert results == [0, 1]
+
+
+def test_prefetch_without_depth_and_early_exit():
+    calls = []
+    for item, future in prefetch(calls.append, iter(range(100)), depth=0):
+        future.result()
+        assert calls == list(range(item + 1))
+        if item == 3:
+            break
+    assert calls == [0, 1, 2, 3]
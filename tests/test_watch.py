@@ -0,0 +1,77 @@
+import json
+import os
+import sys
+
+import numpy as np
+from astropy.io import fits
+
+from bayer.scripts import watch
+from bayer.scripts.watch import FolderPoller
+from tests.test_extract_spectra import _write_spectrum
+
+
+def test_folder_poller(tmp_path):
+    pattern = [str(tmp_path / '*.fits')]
+    (tmp_path / 'old.fits').write_bytes(b'old')
+
+    poller = FolderPoller(pattern, settle=0.0)
+    assert poller.poll() == []
+
+    new = tmp_path / 'new.fits'
+    new.write_bytes(b'new')
+    assert poller.poll() == []  # seen the first time
+
+    new.write_bytes(b'still writing')
+    assert poller.poll() == []  # size changed
+
+    assert poller.poll() == [str(new)]
+    assert poller.poll() == []
+
+
+def test_folder_poller_oldest_first(tmp_path):
+    for i, name in enumerate(['b.fits', 'a.fits']):
+        (tmp_path / name).write_bytes(b'x')
+        os.utime(tmp_path / name, ns=(i * 10 ** 9, i * 10 ** 9))
+
+    poller = FolderPoller([str(tmp_path / '*.fits')], settle=0.0, skip_existing=False)
+    poller.poll()
+    assert poller.poll() == [str(tmp_path / 'b.fits'), str(tmp_path / 'a.fits')]
+
+
+def test_watch_once_with_master_dark(tmp_path):
+    frames = tmp_path / 'frames'
+    frames.mkdir()
+    _write_spectrum(frames / 'mono.fits', 5)
+    _write_spectrum(frames / 'color.fits', -5, BAYERPAT='RGGB')
+    (frames / 'broken.fits').write_bytes(b'no fits file')
+    fits.PrimaryHDU(np.full((300, 400), 90, dtype=np.float32)).writeto(tmp_path / 'master-dark.fits')
+
+    log = tmp_path / 'spectra.jsonl'
+    sys.argv = ['dummy', str(frames / '*.fits'), '--once', '--log', str(log),
+                '--master-dark', str(tmp_path / 'master-dark.fits'), '--background', 'subsample']
+    watch.main()
+
+    records = [json.loads(line) for line in log.read_text().splitlines()]
+    assert sorted(r['filename'] for r in records) == [str(frames / 'color.fits'), str(frames / 'mono.fits')]
+    for record in records:
+        # the synthetic background of 100 minus the dark
+        np.testing.assert_allclose(record['background_mean'], 10, atol=1)
+        assert abs(abs(record['angle_deg']) - 5) < 1
+        assert record['slit_min'] < record['slit_max']
+        assert np.nanmax(np.array(record['spectra'], dtype=float)) > 1000
+        assert record['latency'] >= 0
+
+
+def test_watch_skips_frames_whose_master_cannot_be_loaded(tmp_path, monkeypatch, caplog):
+    frames = tmp_path / 'frames'
+    frames.mkdir()
+    _write_spectrum(frames / 'mono.fits', 5)
+
+    masters = watch._Masters(None, None, None)
+    monkeypatch.setattr(masters, 'for_frame', lambda filename: watch.load_master(str(tmp_path / 'deleted.fits')))
+
+    log = tmp_path / 'spectra.jsonl'
+    watch._process_frame(str(frames / 'mono.fits'), masters, {}, str(log))
+
+    assert 'cannot process' in caplog.text
+    assert not log.exists()